@@ -0,0 +1,591 @@
+# Student name: Michael Hrenko
+# Student OSU ID: 934396070
+# Course: CS 372
+# Programming Project: Client-Server Chat
+
+#==
+#| Sources
+#|
+#==
+
+# "asyncio — Streams", python.org, https://docs.python.org/3/library/asyncio-stream.html
+# "subprocess — Subprocess management", python.org, https://docs.python.org/3/library/subprocess.html
+# "proc(5) — /proc/[pid]/status", Linux manual page, https://man7.org/linux/man-pages/man5/proc.5.html
+
+#==
+#| Import packages
+#|
+#==
+
+# Asyncio drives every simulated client from one event loop
+import asyncio
+
+# Argparse reads the benchmark options
+import argparse
+
+# Json writes the report
+import json
+
+# Os and sys find the server script and the python interpreter used to run it (os also lists the server's
+#   worker processes in /proc)
+import os
+import sys
+
+# Platform records which python the benchmark ran on
+import platform
+
+# Subprocess starts server.py
+import subprocess
+
+# Time takes the timestamps used for rates and latencies
+import time
+
+# Tempfile holds the self-signed certificate of a --tls run
+import tempfile
+
+# Socket finds a free port for the server's metrics endpoint
+import socket
+
+# Urllib reads the server's throttle counters from its metrics endpoint
+import urllib.request
+
+# Resource raises the open file limit so thousands of clients can be opened (Unix only)
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Protocol holds the length-prefixed frame format shared by the client and the server
+from protocol import (MSG_CHAT, MSG_HELLO, MSG_JOIN, MSG_PING, MSG_PONG, MSG_ROOM, ROOM_HEADER, encodeFrame,
+                      encodeHello, encodeJoin, encodeRoomMessage, frameDecoder)
+
+# Tls makes the test certificate and the client's SSLContext for --tls
+from tls import clientContext, makeSelfSigned
+
+#==
+#| chatBenchmark
+#|
+#| Description:
+#| Starts server.py locally and measures it with simulated clients.
+#|
+#| My approach:
+#| (1) Start server.py (threaded or async mode) in a subprocess and wait until it accepts connections.
+#| (2) Open the clients (at most connectConcurrency at a time) and measure the connect rate. The server's RSS is
+#|     read before and after, giving the memory used per connection.
+#| (3) Every client sends messages of messageSize bytes at rate messages/sec for duration seconds. Each message
+#|     starts with the time it was sent, so the receiving client can compute the end-to-end latency.
+#|   - Async mode: the server broadcasts every message to the other clients, or with rooms > 0 the clients are
+#|     spread over that many rooms and each message only goes to the sender's room.
+#|   - Threaded mode: the server only holds one client and does not forward its messages, so the latency is
+#|     measured on messages written to the server's console (stdin) and delivered to the client.
+#| (4) Report messages/sec, bytes/sec, latency percentiles, connect rate and RSS per connection as JSON, plus the
+#|     server's throttle counters (read from its metrics endpoint).
+#|
+#| Notes:
+#| The server's rate limits are turned off, since they would cap a --rate above them and the numbers would measure
+#|   the limits instead of the server. Pass them with --server-arg to measure a limited server (e.g.
+#|   --server-arg=--rate-messages=100): the throttle counters then show how often clients were held back.
+#| The clients and the server run on the same host, so the benchmark measures the server plus the loopback.
+#| With --tls (async mode) the server gets a self-signed certificate made for the run, and the connect rate then
+#|   includes the TLS handshakes.
+#| RSS is read from /proc (the hub and its workers together in the prefork mode) and is null on systems without it.
+#|
+#==
+class chatBenchmark:
+
+    #==
+    #| __init__()
+    #|
+    #==
+    def __init__(self, args):
+
+        self.host = args.host
+        self.port = args.port
+        self.mode = args.mode
+        self.clients = 1 if args.mode == 'threaded' else args.clients
+        self.rate = args.rate
+        self.rooms = 0 if args.mode == 'threaded' else args.rooms
+        self.messageSize = max(args.size, 32)
+        self.duration = args.duration
+        self.connectConcurrency = args.connect_concurrency
+        self.serverArgs = list(args.server_arg)
+        self.tls = None
+
+        # Limits passed with --server-arg come later on the command line, so they win over these.
+        self.metricsPort = freePort(self.host)
+        self.serverDefaults = ['--rate-messages', '0', '--rate-bytes', '0', '--metrics-port', str(self.metricsPort)]
+        for arg, value in zip(self.serverArgs, self.serverArgs[1:]):
+            if arg == '--metrics-port':
+                self.metricsPort = int(value)
+        for arg in self.serverArgs:
+            if arg.startswith('--metrics-port='):
+                self.metricsPort = int(arg.split('=', 1)[1])
+
+        if args.tls:
+            certDir = tempfile.mkdtemp(prefix='chat-tls-')
+            certFile, keyFile = makeSelfSigned(certDir, self.host)
+            self.tls = clientContext(certFile)
+            self.serverArgs += ['--tls-cert', certFile, '--tls-key', keyFile]
+
+        self.server = None
+        self.sent = 0
+        self.sentBytes = 0
+        self.received = 0
+        self.receivedBytes = 0
+        self.latencies = []
+        self.measuring = False
+
+    #==
+    #| startServer()
+    #|
+    #| Description:
+    #| Starts server.py in quiet mode and waits until it accepts connections.
+    #|
+    #| Notes:
+    #| The threaded server only accepts one connection, so readiness is checked by waiting for its listening
+    #|   message instead of connecting.
+    #|
+    #==
+    async def startServer(self):
+
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+        command = [sys.executable, '-u', script, '--mode', self.mode, '--host', self.host, '--port', str(self.port),
+                   '--quiet'] + self.serverDefaults + self.serverArgs
+
+        self.server = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                       stderr=subprocess.DEVNULL, text=True)
+
+        # Wait for "Server listening on ..." in a thread so the event loop is not blocked.
+        # Other lines (e.g. "Enter a message ...") may come first.
+        line = "\n"
+        while 'listening' not in line and 'Cannot' not in line:
+            line = await asyncio.to_thread(self.server.stdout.readline)
+            if not line:
+                break
+
+        if 'listening' not in line:
+            raise RuntimeError(f"server did not start: {line.strip() or 'no output'}")
+
+        # Keep draining the server's output so it never blocks on a full pipe.
+        asyncio.get_running_loop().run_in_executor(None, self.server.stdout.read)
+
+    #==
+    #| stopServer()
+    #|
+    #| Description:
+    #| Asks the server to quit ('/q'), then terminates it if it is still running.
+    #|
+    #==
+    def stopServer(self):
+
+        if self.server is None:
+            return
+
+        try:
+            self.server.stdin.write("/q\n")
+            self.server.stdin.flush()
+            self.server.wait(2)
+        except (OSError, subprocess.TimeoutExpired):
+            self.server.terminate()
+            self.server.wait()
+
+    #==
+    #| readThrottles()
+    #|
+    #| Description:
+    #| Returns the server's throttle counters, summed over its worker processes: how often a client's reads were
+    #|   paused (throttled) and how many clients were disconnected for being throttled too often (rate_limited).
+    #|
+    #| Notes:
+    #| Prefork workers serve their metrics on metricsPort + their worker number, so the ports are read until one does
+    #|   not answer.
+    #|
+    #==
+    def readThrottles(self):
+
+        names = {'chat_throttled_total': 'throttled', 'chat_rate_limited_total': 'rate_limited'}
+        counters = {'throttled': 0, 'rate_limited': 0}
+
+        for worker in range(1024):
+            try:
+                url = f"http://{self.host}:{self.metricsPort + worker}/metrics"
+                with urllib.request.urlopen(url, timeout=2) as response:
+                    text = response.read().decode('utf-8')
+            except OSError:
+                break
+
+            # A sample is "name value" or "name{labels} value".
+            for line in text.splitlines():
+                name = line.split('{', 1)[0].split(' ', 1)[0]
+                if name in names:
+                    counters[names[name]] += int(float(line.rsplit(' ', 1)[1]))
+
+        return counters
+
+    #==
+    #| readRss()
+    #|
+    #| Description:
+    #| Returns the resident set size of the server in bytes, or None if /proc is not available. In the prefork mode
+    #|   (--server-arg=--workers=N) the server process is the hub, so its worker processes are added to it.
+    #|
+    #==
+    def readRss(self):
+
+        total = processRss(self.server.pid)
+        if total is None:
+            return None
+
+        for pid in childPids(self.server.pid):
+            total += processRss(pid) or 0
+
+        return total
+
+    #==
+    #| makeMessage()
+    #|
+    #| Description:
+    #| Returns a message of messageSize bytes that starts with the current time (ns) and the client number.
+    #|
+    #==
+    def makeMessage(self, clientId):
+
+        header = f"{time.perf_counter_ns()} {clientId} "
+        return (header + 'x' * (self.messageSize - len(header))).encode('utf-8')
+
+    #==
+    #| recordMessage()
+    #|
+    #| Description:
+    #| Counts a received message and records its latency.
+    #|
+    #==
+    def recordMessage(self, payload, textStart=0):
+
+        now = time.perf_counter_ns()
+        if not self.measuring:
+            return
+
+        self.received += 1
+        self.receivedBytes += len(payload)
+
+        # perf_counter_ns() has at most 20 digits, so only the start of the text is copied.
+        sentAt = bytes(payload[textStart:textStart + 21]).split(b' ', 1)[0]
+        if sentAt.isdigit():
+            self.latencies.append(now - int(sentAt))
+
+    #==
+    #| receiveLoop()
+    #|
+    #| Description:
+    #| Reads and decodes the frames sent to one client until the connection closes, and answers the server's
+    #|   heartbeats (MSG_PING).
+    #|
+    #==
+    async def receiveLoop(self, reader, writer):
+
+        decoder = frameDecoder()
+
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                return
+
+            decoder.feed(data)
+            for msgType, payload in decoder.frames():
+                if msgType == MSG_CHAT:
+                    self.recordMessage(payload)
+                elif msgType == MSG_ROOM:
+                    seq, roomLength, senderLength = ROOM_HEADER.unpack_from(payload)
+                    self.recordMessage(payload, ROOM_HEADER.size + roomLength + senderLength)
+                elif msgType == MSG_PING:
+                    writer.write(encodeFrame(MSG_PONG, payload))
+
+    #==
+    #| sendLoop()
+    #|
+    #| Description:
+    #| Sends rate messages/sec from one client until stopAt (perf_counter seconds).
+    #|
+    #| Notes:
+    #| Send times are scheduled from the start time instead of sleeping a fixed interval, so a slow send does not
+    #|   lower the rate for the rest of the run.
+    #|
+    #==
+    async def sendLoop(self, clientId, writer, stopAt):
+
+        interval = 1.0 / self.rate
+        nextSend = time.perf_counter()
+        room = self.roomOf(clientId)
+
+        while nextSend < stopAt:
+            delay = nextSend - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            message = self.makeMessage(clientId)
+            if room is None:
+                writer.write(encodeFrame(MSG_CHAT, message))
+            else:
+                writer.write(encodeFrame(MSG_ROOM, encodeRoomMessage(room, '', message.decode('utf-8'))))
+            await writer.drain()
+
+            if self.measuring:
+                self.sent += 1
+                self.sentBytes += len(message)
+
+            nextSend += interval
+
+    #==
+    #| roomOf()
+    #|
+    #| Description:
+    #| Returns the room of a client, or None when the benchmark does not use rooms.
+    #|
+    #==
+    def roomOf(self, clientId):
+
+        if self.rooms <= 0:
+            return None
+
+        return f"room{clientId % self.rooms}"
+
+    #==
+    #| consoleLoop()
+    #|
+    #| Description:
+    #| Threaded mode: writes rate messages/sec to the server's console so they are sent to the client.
+    #|
+    #==
+    async def consoleLoop(self, stopAt):
+
+        interval = 1.0 / self.rate
+        nextSend = time.perf_counter()
+
+        while nextSend < stopAt:
+            delay = nextSend - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            self.server.stdin.write(self.makeMessage('console').decode('utf-8') + "\n")
+            self.server.stdin.flush()
+            nextSend += interval
+
+    #==
+    #| connectClients()
+    #|
+    #| Description:
+    #| Opens every client connection, at most connectConcurrency at a time, and returns the (reader, writer) pairs.
+    #|
+    #==
+    async def connectClients(self):
+
+        limit = asyncio.Semaphore(self.connectConcurrency)
+
+        async def connectOne(clientId):
+            async with limit:
+                reader, writer = await asyncio.open_connection(self.host, self.port, ssl=self.tls)
+
+                # The server disconnects clients that send nothing within its handshake timeout.
+                writer.write(encodeFrame(MSG_HELLO, encodeHello(0)))
+
+                room = self.roomOf(clientId)
+                if room is not None:
+                    writer.write(encodeFrame(MSG_JOIN, encodeJoin(room)))
+
+                return reader, writer
+
+        return await asyncio.gather(*(connectOne(clientId) for clientId in range(self.clients)))
+
+    #==
+    #| percentiles()
+    #|
+    #| Description:
+    #| Returns the p50/p99/p999 latencies (and min/max/mean) in milliseconds.
+    #|
+    #==
+    def percentiles(self):
+
+        if not self.latencies:
+            return None
+
+        values = sorted(self.latencies)
+
+        def at(fraction):
+            return round(values[min(len(values) - 1, int(fraction * len(values)))] / 1e6, 3)
+
+        return {'min': round(values[0] / 1e6, 3), 'p50': at(0.50), 'p99': at(0.99), 'p999': at(0.999),
+                'max': round(values[-1] / 1e6, 3), 'mean': round(sum(values) / len(values) / 1e6, 3)}
+
+    #==
+    #| run()
+    #|
+    #| Description:
+    #| Runs the whole benchmark and returns the report (a dictionary).
+    #|
+    #==
+    async def run(self):
+
+        # Each client uses one file descriptor, so raise the soft limit up to the hard limit.
+        if resource is not None:
+            try:
+                soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+                resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            except (ValueError, OSError):
+                pass
+
+        try:
+            await self.startServer()
+            rssBefore = self.readRss()
+
+            connectStart = time.perf_counter()
+            connections = await self.connectClients()
+            connectTime = time.perf_counter() - connectStart
+
+            # Give the server a moment to finish setting up every connection before reading its memory.
+            await asyncio.sleep(0.5)
+            rssAfter = self.readRss()
+
+            receivers = [asyncio.create_task(self.receiveLoop(reader, writer)) for reader, writer in connections]
+
+            start = time.perf_counter()
+            stopAt = start + self.duration
+            self.measuring = True
+
+            if self.mode == 'threaded':
+                senders = [self.sendLoop(0, connections[0][1], stopAt), self.consoleLoop(stopAt)]
+            else:
+                senders = [self.sendLoop(clientId, writer, stopAt)
+                           for clientId, (reader, writer) in enumerate(connections)]
+            await asyncio.gather(*senders)
+
+            # Let the messages still in flight arrive.
+            await asyncio.sleep(0.5)
+            self.measuring = False
+            elapsed = time.perf_counter() - start
+
+            throttles = await asyncio.to_thread(self.readThrottles)
+
+            for reader, writer in connections:
+                writer.close()
+            for receiver in receivers:
+                receiver.cancel()
+            await asyncio.gather(*receivers, return_exceptions=True)
+
+        finally:
+            self.stopServer()
+
+        rssPerConnection = None
+        if rssBefore is not None and rssAfter is not None:
+            rssPerConnection = (rssAfter - rssBefore) // self.clients
+
+        return {
+            'mode': self.mode,
+            'python': platform.python_version(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'config': {'clients': self.clients, 'rooms': self.rooms, 'rate': self.rate, 'size': self.messageSize,
+                       'duration': self.duration, 'tls': self.tls is not None,
+                       'server_args': self.serverDefaults + self.serverArgs},
+            'connect': {'seconds': round(connectTime, 4), 'per_sec': round(self.clients / connectTime, 1)},
+            'sent': {'messages': self.sent, 'bytes': self.sentBytes,
+                     'messages_per_sec': round(self.sent / elapsed, 1),
+                     'bytes_per_sec': round(self.sentBytes / elapsed, 1)},
+            'received': {'messages': self.received, 'bytes': self.receivedBytes,
+                         'messages_per_sec': round(self.received / elapsed, 1),
+                         'bytes_per_sec': round(self.receivedBytes / elapsed, 1)},
+            'latency_ms': self.percentiles(),
+            'throttles': throttles,
+            'rss': {'before': rssBefore, 'after': rssAfter, 'per_connection': rssPerConnection},
+        }
+
+#==
+#| processRss()
+#|
+#| Description:
+#| Returns the resident set size of a process in bytes (from /proc), or None if it cannot be read.
+#|
+#==
+def processRss(pid):
+
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+
+    return None
+
+#==
+#| childPids()
+#|
+#| Description:
+#| Returns the ids of the processes whose parent is pid, found in /proc (empty if it is not available).
+#|
+#==
+def childPids(pid):
+
+    children = []
+    try:
+        names = os.listdir('/proc')
+    except OSError:
+        return children
+
+    for name in names:
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/stat") as stat:
+                # The command name (in parentheses) may hold spaces, the parent id is the second field after it.
+                fields = stat.read().rsplit(')', 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        if int(fields[1]) == pid:
+            children.append(int(name))
+
+    return children
+
+#==
+#| freePort()
+#|
+#| Description:
+#| Returns a TCP port that is free on host (for the server's metrics endpoint).
+#|
+#==
+def freePort(host):
+
+    with socket.socket() as probe:
+        probe.bind((host, 0))
+        return probe.getsockname()[1]
+
+#==
+#| Run program
+#|
+#==
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Client-Server Chat benchmark (prints a JSON report)")
+    parser.add_argument('--mode', choices=['threaded', 'async'], default='async')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=15778)
+    parser.add_argument('--clients', type=int, default=50, help="number of clients (always 1 in threaded mode)")
+    parser.add_argument('--rooms', type=int, default=0, help="spread the clients over this many rooms (0: no rooms)")
+    parser.add_argument('--rate', type=float, default=10.0, help="messages/sec sent by each client")
+    parser.add_argument('--size', type=int, default=128, help="bytes per message")
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds to send for")
+    parser.add_argument('--connect-concurrency', type=int, default=100, help="connections opened at the same time")
+    parser.add_argument('--tls', action='store_true', help="async mode: connect with TLS (self-signed certificate)")
+    parser.add_argument('--server-arg', action='append', default=[], help="extra argument passed to server.py")
+    parser.add_argument('--output', help="write the report to this file instead of stdout")
+    args = parser.parse_args()
+    if args.tls and args.mode != 'async':
+        parser.error("--tls needs --mode async")
+
+    report = asyncio.run(chatBenchmark(args).run())
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
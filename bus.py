@@ -0,0 +1,380 @@
+# Student name: Michael Hrenko
+# Student OSU ID: 934396070
+# Course: CS 372
+# Programming Project: Client-Server Chat
+
+#==
+#| Sources
+#|
+#==
+
+# "socket.SO_REUSEPORT", Linux manual page socket(7), https://man7.org/linux/man-pages/man7/socket.7.html
+# "os.fork", python.org, https://docs.python.org/3/library/os.html#os.fork
+# "loop.connect_accepted_socket", python.org, https://docs.python.org/3/library/asyncio-eventloop.html
+
+#==
+#| Import packages
+#|
+#==
+
+# Asyncio runs the hub's event loop and the bus connections of the workers
+import asyncio
+
+# Struct packs the connection ids and sequence numbers of the bus messages
+import struct
+
+# Os reads the console without the buffering of sys.stdin (see consoleReader)
+import os
+
+# Sys gives the hub access to the server user's console input (stdin)
+import sys
+
+# Protocol holds the frame format, which the bus uses as well
+from protocol import (BUS_CHAT, BUS_DELIVER, BUS_PUBLISH, BUS_REPLAY, BUS_SUBSCRIBE, BUS_UNSUBSCRIBE, MAX_PAYLOAD,
+                      MSG_CHAT, MSG_ROOM, decodeRoomHeader, decodeRoomName, encodeFrame, encodeRoomName, frameDecoder,
+                      protocolError, setRoomSeq)
+
+# Outbound queues the frames to send so pending frames go out together
+from outbound import outboundQueue
+
+#==
+#| Bus messages
+#|
+#| Description:
+#| In the prefork mode (server.py --workers N) every worker process accepts its own clients on the same port
+#|   (SO_REUSEPORT) and the parent process (the hub) relays room messages between the workers over a Unix socket
+#|   pair per worker. The hub is the only process that numbers room messages and keeps the room history, so every
+#|   worker sees the messages of a room in the same order.
+#|
+#| BUS_PUBLISH:     worker -> hub, a MSG_ROOM payload from one of the worker's clients (sequence number 0).
+#| BUS_DELIVER:     hub -> worker, the numbered MSG_ROOM frame, sent to every worker with members in the room.
+#| BUS_SUBSCRIBE:   worker -> hub, a client of the worker joined a room (see encodeSubscribe()). The hub sends the
+#|                  worker the room's messages from now on and replays the history the client asked for.
+#| BUS_UNSUBSCRIBE: worker -> hub, the worker has no members left in a room (the payload is the room name).
+#| BUS_REPLAY:      hub -> worker, a connection id (8 bytes) followed by a MSG_ROOM frame for that client.
+#| BUS_CHAT:        a MSG_CHAT frame for every client. The hub relays it to the other workers.
+#|
+#==
+
+SUBSCRIBE_HEADER = struct.Struct('!QQ')
+CONNECTION_ID = struct.Struct('!Q')
+
+# Bus frames carry a whole client frame, so they may be a little larger than a client payload.
+MAX_BUS_PAYLOAD = MAX_PAYLOAD + 1024
+
+#==
+#| encodeSubscribe()
+#|
+#| Description:
+#| Returns the BUS_SUBSCRIBE payload: connection id and since (8 bytes each) followed by the room name.
+#|
+#==
+def encodeSubscribe(connId, since, room):
+
+    return SUBSCRIBE_HEADER.pack(connId, since) + encodeRoomName(room)
+
+#==
+#| decodeSubscribe()
+#|
+#| Description:
+#| Returns (connId, since, room) from a BUS_SUBSCRIBE payload.
+#|
+#==
+def decodeSubscribe(payload):
+
+    if len(payload) < SUBSCRIBE_HEADER.size:
+        raise protocolError("subscribe message is too short")
+
+    connId, since = SUBSCRIBE_HEADER.unpack_from(payload)
+    return connId, since, decodeRoomName(payload[SUBSCRIBE_HEADER.size:])
+
+#==
+#| watchConsole()
+#|
+#| Description:
+#| Has the event loop read the server user's console (see consoleReader below). Used by the hub and by an async
+#|   server without workers.
+#|
+#| Notes:
+#| add_reader() only accepts a file descriptor that supports select(), so the console is not watched where it does
+#|   not (e.g. Windows consoles).
+#|
+#==
+def watchConsole(loop, owner):
+
+    reader = consoleReader(loop, owner)
+    try:
+        loop.add_reader(reader.fd, reader.read)
+    except (OSError, NotImplementedError, ValueError):
+        pass
+
+#==
+#| consoleReader
+#|
+#| Description:
+#| Reads the lines typed by the server user: '/q' calls owner.stop(), anything else calls
+#|   owner.consoleMessage(text).
+#|
+#| My approach:
+#| (1) read() reads what stdin holds with one os.read(), so it never blocks the event loop.
+#| (2) Every complete line read is handled, the part of a line that follows is kept for the next read.
+#|
+#| Notes:
+#| sys.stdin.readline() would block the event loop on a partial line, and would read several lines into its own
+#|   buffer where the event loop does not see them (they would wait for the next input).
+#|
+#==
+class consoleReader:
+
+    #==
+    #| __init__()
+    #|
+    #==
+    def __init__(self, loop, owner):
+
+        self.loop = loop
+        self.owner = owner
+        self.fd = sys.stdin.fileno()
+        self.buffer = b''
+
+    #==
+    #| read()
+    #|
+    #| Description:
+    #| Called by the event loop when stdin is readable (see My approach above).
+    #|
+    #==
+    def read(self):
+
+        try:
+            data = os.read(self.fd, 4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+
+        # An empty read means stdin was closed (e.g. the server runs in the background), so stop watching it.
+        if not data:
+            self.loop.remove_reader(self.fd)
+            return
+
+        lines = (self.buffer + data).split(b'\n')
+        self.buffer = lines.pop()
+
+        for line in lines:
+            serverMessage = str(line, 'utf-8', 'replace').strip()
+
+            if serverMessage == "/q":
+                self.owner.stop()
+                return
+            elif serverMessage:
+                self.owner.consoleMessage(serverMessage)
+
+#==
+#| busLink
+#|
+#| Description:
+#| One end of the Unix socket between the hub and a worker.
+#|
+#| Notes:
+#| Frames received are passed to owner.busFrame(link, type, payload), and owner.busClosed(link) is called when the
+#|   other process goes away (or sent a bad frame, which closes the link). Like chatConnection, frames sent are
+#|   queued and written once per event loop iteration.
+#|
+#==
+class busLink(asyncio.BufferedProtocol):
+
+    __slots__ = ('owner', 'loop', 'transport', 'decoder', 'outbound', 'flushScheduled')
+
+    def __init__(self, owner):
+
+        self.owner = owner
+        self.loop = None
+        self.transport = None
+        self.decoder = frameDecoder(MAX_BUS_PAYLOAD, 64 * 1024)
+        self.outbound = outboundQueue()
+        self.flushScheduled = False
+
+    def connection_made(self, transport):
+
+        self.loop = asyncio.get_running_loop()
+        self.transport = transport
+
+    def get_buffer(self, sizehint):
+
+        return self.decoder.writableView()
+
+    def buffer_updated(self, nbytes):
+
+        self.decoder.commit(nbytes)
+
+        # A bad frame (e.g. an oversized one) means the two processes no longer agree, so the link is closed.
+        try:
+            for msgType, payload in self.decoder.frames():
+                self.owner.busFrame(self, msgType, payload)
+        except protocolError as error:
+            print(f"Bad bus message: {error}", file=sys.stderr)
+            self.transport.close()
+
+    def connection_lost(self, exc):
+
+        self.outbound.drain()
+        self.owner.busClosed(self)
+
+    def send(self, frame):
+
+        if self.transport is None or self.transport.is_closing():
+            return
+
+        self.outbound.put(frame)
+        if not self.flushScheduled:
+            self.flushScheduled = True
+            self.loop.call_soon(self.flush)
+
+    def flush(self):
+
+        self.flushScheduled = False
+        if self.outbound.buffers and not self.transport.is_closing():
+            self.transport.writelines(self.outbound.drain())
+
+#==
+#| busHub
+#|
+#| Description:
+#| Runs in the parent process of the prefork mode and relays messages between the workers.
+#|
+#| My approach:
+#| (1) subscribers maps a room to the links of the workers that have members in it, so a room message is only sent
+#|     to those workers.
+#| (2) history is the parent's serverChat. Its nextSeq(), recordHistory() and replayFrames() number the room
+#|     messages and keep the ring buffers and the messageLog, exactly like in the single process mode.
+#| (3) The server user's console is read here: '/q' stops the hub (and with it the workers), other lines are
+#|     sent to every client of every worker.
+#|
+#==
+class busHub:
+
+    #==
+    #| __init__()
+    #|
+    #==
+    def __init__(self, history):
+
+        self.history = history
+        self.links = set()
+        self.subscribers = {}
+        self.loop = None
+        self.stopped = None
+
+    #==
+    #| busFrame()
+    #|
+    #| Description:
+    #| Handles a message from a worker (see Bus messages above).
+    #|
+    #==
+    def busFrame(self, link, msgType, payload):
+
+        if msgType == BUS_PUBLISH:
+            seq, room, sender, textStart = decodeRoomHeader(payload)
+            seq = self.history.nextSeq(room)
+            payload = setRoomSeq(payload, seq)
+            frame = encodeFrame(MSG_ROOM, payload)
+            self.history.recordHistory(room, seq, payload, frame)
+
+            deliver = encodeFrame(BUS_DELIVER, frame)
+            for subscriber in self.subscribers.get(room, ()):
+                subscriber.send(deliver)
+
+        elif msgType == BUS_SUBSCRIBE:
+            connId, since, room = decodeSubscribe(payload)
+            self.subscribers.setdefault(room, set()).add(link)
+
+            prefix = CONNECTION_ID.pack(connId)
+            for frame in self.history.replayFrames(room, since):
+                link.send(encodeFrame(BUS_REPLAY, prefix + frame))
+
+        elif msgType == BUS_UNSUBSCRIBE:
+            room = decodeRoomName(payload)
+            subscribers = self.subscribers.get(room)
+            if subscribers is not None:
+                subscribers.discard(link)
+                if not subscribers:
+                    del self.subscribers[room]
+
+        elif msgType == BUS_CHAT:
+            relay = encodeFrame(BUS_CHAT, payload)
+            for other in self.links:
+                if other is not link:
+                    other.send(relay)
+
+    #==
+    #| busClosed()
+    #|
+    #| Description:
+    #| Forgets a worker that exited. The hub stops once every worker is gone.
+    #|
+    #==
+    def busClosed(self, link):
+
+        self.links.discard(link)
+        for room in [room for room, subscribers in self.subscribers.items() if link in subscribers]:
+            self.subscribers[room].discard(link)
+            if not self.subscribers[room]:
+                del self.subscribers[room]
+
+        if not self.links:
+            self.stop()
+
+    #==
+    #| stop()
+    #|
+    #| Description:
+    #| Stops the hub ('/q' on the console, or every worker is gone).
+    #|
+    #==
+    def stop(self):
+
+        if not self.stopped.done():
+            self.stopped.set_result(None)
+
+    #==
+    #| consoleMessage()
+    #|
+    #| Description:
+    #| Sends a line typed on the console (see watchConsole()) to every client of every worker.
+    #|
+    #==
+    def consoleMessage(self, serverMessage):
+
+        relay = encodeFrame(BUS_CHAT, encodeFrame(MSG_CHAT, serverMessage.encode('utf-8')))
+        for link in self.links:
+            link.send(relay)
+
+    #==
+    #| run()
+    #|
+    #| Description:
+    #| Connects to every worker's socket and relays messages until '/q' or until every worker has exited.
+    #|
+    #==
+    async def run(self, sockets):
+
+        self.loop = asyncio.get_running_loop()
+        self.stopped = self.loop.create_future()
+        self.history.loop = self.loop
+
+        for sock in sockets:
+            transport, link = await self.loop.connect_accepted_socket(lambda: busLink(self), sock)
+            self.links.add(link)
+
+        print("Enter a message or /q to quit")
+        watchConsole(self.loop, self)
+
+        try:
+            await self.stopped
+        finally:
+            for link in list(self.links):
+                link.transport.close()
+            if self.history.log is not None:
+                self.history.log.close()
@@ -1,177 +1,1225 @@
-# Student name: Michael Hrenko
-# Student OSU ID: 934396070
-# Course: CS 372
-# Programming Project: Client-Server Chat
-
-# #################################################################################################################### #
-# Sources                                                                                                              #
-#                                                                                                                      #
-# #################################################################################################################### #
-
-# "Computer Networking: A Top-down Approach", 7th edition by James Kurose and Keith Ross, Section 2.71 - "TCPClient.py"
-# "socket — Low-level networking interface", python.org, https://docs.python.org/3/library/socket.html
-# "threading — Thread-based parallelism", python.org, https://docs.python.org/3/library/threading.html
-# "An Intro to Threading in Python", Jim Anderson, Real Python, https://realpython.com/intro-to-python-threading/
-
-# #################################################################################################################### #
-# Import packages                                                                                                      #
-#                                                                                                                      #
-# #################################################################################################################### #
-
-# Socket is the python package that provides a "Low-level networking interface" (see source above)
-from socket import *
-
-# Threading is the python package that provides parallelism "Low-level networking interface" (see source above)
-import threading
-
-# #################################################################################################################### #
-# clientChat                                                                                                           #
-#                                                                                                                      #
-# Description:                                                                                                         #
-# Runs the client side of the chat with the server.                                                                    #
-#                                                                                                                      #
-# My approach:                                                                                                         #
-# (1) Initialize (a) a connection to the server using the same host and port and (b) a send message thread.            #
-#   -  Threading is used because we need the ability to send and receive multiple messages. To accommodate this,       #
-#      each send and receive function needs to remain open at the same time. This can best be done using               #
-#      parallelism.                                                                                                    #
-# (2) Call receive message in the main function.                                                                       #
-#   - Both the send and receive functions are while loops that continue to run while the client and server             #
-#     connections are open.                                                                                            #
-# (3) The programs ends when the client enters '/q' (stopping the thread), or the server quits and the receive         #
-#       message detects this.                                                                                          #                                                                                                       #
-#   - Neither the client nor the server send a quit message.                                                           #
-#                                                                                                                      #
-# #################################################################################################################### #
-class clientChat:
-
-    # ################################################################################################################ #
-    # __init__()                                                                                                       #
-    #                                                                                                                  #
-    # ################################################################################################################ #
-    def __init__(self):
-
-        self.host = 'localhost'
-        self.port = 15777
-        self.clientSocket = None
-        self.clientAddress = None
-        self.threadSend = None
-        self.connected = False
-
-    # ################################################################################################################ #
-    # sendMessage()                                                                                                    #
-    #                                                                                                                  #
-    # Description:                                                                                                     #
-    # (1) Receives a message input by the client.                                                                      #
-    # (2) If the message is 'q', calls closeChat() to stops the thread.                                                #
-    # (3) Else tries to send the message to the server. If the server closed the connection, sets                      #
-    #   self.connected to False to indicate that receiveMessage() should also stop.                                    #
-    #                                                                                                                  #
-    # Notes:                                                                                                           #
-    # Remains active while client and server are still connected.                                                      #
-    #                                                                                                                  #
-    # ################################################################################################################ #
-    def sendMessage(self):
-
-        while self.connected:
-
-            # Get the message from the user.
-            clientMessage = (input()).strip()
-
-            # '/q' quits the program by calling closeChat() and setting self.connected to False 
-            #   so receiveMessage() also stops.
-            if clientMessage == "/q":
-                self.connected = False
-                self.closeChat()
-            else:
-                # Use a try function b/c the server may have closed the connection.
-                # If that occurs call closeChat() and set self.connected to False so 
-                #   receiveMessage() also stops. 
-                try:
-                    self.clientSocket.send(clientMessage.encode('utf-8'))           
-                except:
-                    self.connected = False
-                    self.closeChat()
-
-    # ################################################################################################################ #
-    # receiveMessage()                                                                                                 #
-    #                                                                                                                  #
-    # Description:                                                                                                     #
-    # Receives and prints messages from the server.                                                                    #
-    #                                                                                                                  #  
-    # Notes:                                                                                                           #
-    # Remains active while client and server are still connected.                                                      #
-    #                                                                                                                  #
-    # ################################################################################################################ #
-    def receiveMessage(self):
-        while self.connected:
-
-            # Use a try function b/c the server may have closed the connection before this was able to run.
-            #  If that happens, break the loop. 
-            try:
-                # Receive data from the server socket as a bytes object.
-                # 1024 is the size of the buffer
-                serverMessage = self.clientSocket.recv(1024).decode('utf-8')
-                print(f"Server: {serverMessage}")
-            
-            except:
-                self.connected = False
-                break
-
-    # ################################################################################################################ #
-    # connect()                                                                                                        #
-    #                                                                                                                  #
-    # Description:                                                                                                     #
-    # (1) Connects to the client socket.                                                                               #
-    # (2) Initializes and starts threading for the sendMessage function.                                               #
-    #                                                                                                                  #
-    # Notes:                                                                                                           #
-    # Threading is used because we need the ability to send and receive multiple messages. To accommodate  this,       #
-    #   each send and receive function needs to remain open at the same time. This can best be done using              #
-    #   parallelism.                                                                                                   #
-    #                                                                                                                  #
-    # ################################################################################################################ #
-    def connect(self):
-
-        try:
-            # Create the socket for the client.
-            # AF_INET: underlying network is using IPv4.
-            # SOCK_STREAM: use the TCP socket. 
-            # Use TCP because we're sending/receiving data which needs to be accurate. 
-            self.clientSocket = socket(AF_INET, SOCK_STREAM)
-
-            # Initiate the TCP connection (aka the three-way handshake) between the client 
-            #   and server (at the server address and port above);
-            self.clientSocket.connect((self.host, self.port))
-            print(f"\nConnected to {self.host} on port {self.port}")
-            print("Enter a message or /q to quit")
-
-            self.connected = True
-
-            # Initialize and start threading the sendMessage function.
-            self.threadSend = threading.Thread(target=self.sendMessage, daemon=True)
-            self.threadSend.start()
-
-        except:
-           print("Cannot connect to server") 
-
-    # ################################################################################################################ #
-    # closeChat()                                                                                                      #
-    #                                                                                                                  #
-    # Description:                                                                                                     #
-    # Closes the client socket.                                                                                         #
-    #                                                                                                                  #
-    # ################################################################################################################ #
-    def closeChat(self):
-
-        self.clientSocket.close()
-
-# #################################################################################################################### #
-# Run program                                                                                                          #
-#                                                                                                                      #
-# #################################################################################################################### #
-if __name__ == '__main__':
-
-    chat = clientChat()
-    chat.connect()
-    chat.receiveMessage()
\ No newline at end of file
+# Student name: Michael Hrenko
+# Student OSU ID: 934396070
+# Course: CS 372
+# Programming Project: Client-Server Chat
+
+#==
+#| Sources
+#|
+#==
+
+# "Computer Networking: A Top-down Approach", 7th edition by James Kurose and Keith Ross, Section 2.71 - "TCPClient.py"
+# "socket — Low-level networking interface", python.org, https://docs.python.org/3/library/socket.html
+# "threading — Thread-based parallelism", python.org, https://docs.python.org/3/library/threading.html
+# "An Intro to Threading in Python", Jim Anderson, Real Python, https://realpython.com/intro-to-python-threading/
+# "selectors — High-level I/O multiplexing", python.org, https://docs.python.org/3/library/selectors.html
+# "Exponential Backoff And Jitter", Marc Brooker, AWS Architecture Blog,
+#   https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/
+# "Notes on non-blocking sockets", python.org, https://docs.python.org/3/library/ssl.html#notes-on-non-blocking-sockets
+
+#==
+#| Import packages
+#|
+#==
+
+# Socket is the python package that provides a "Low-level networking interface" (see source above)
+from socket import *
+
+# Threading is the python package that provides parallelism "Low-level networking interface" (see source above)
+import threading
+
+# Selectors waits for the console and the server socket at the same time on one thread (see source above)
+import selectors
+
+# Errno tells a connect that is still in progress apart from one that failed
+import errno
+
+# Os reads the console without Python's line buffering, so select() and the reads agree on what is pending
+import os
+
+# Random adds the jitter to the reconnect delays
+import random
+
+# Json reads the transcripts to replay and writes the received messages in batch mode
+import json
+
+# Sys gives access to the console input (stdin)
+import sys
+
+# Time schedules the reconnect attempts
+import time
+
+# Protocol holds the length-prefixed frame format shared by the client and the server
+from protocol import (HEADER, MSG_CHAT, MSG_HELLO, MSG_JOIN, MSG_LEAVE, MSG_PING, MSG_PONG, MSG_RECONNECT, MSG_ROOM,
+                      decodeJoin, decodeReconnect, decodeRoomMessage, decodeRoomName, encodeFrame, encodeJoin,
+                      encodeRoomMessage, encodeRoomName, frameDecoder, protocolError)
+
+# Outbound queues the frames to send so partial sends never lose data and pending frames go out together
+from outbound import HIGH_WATER, LOW_WATER, MAX_QUEUED, outboundQueue
+
+# Compression compresses large payloads once the server accepted it (see MSG_HELLO in protocol.py)
+from compression import COMPRESS_THRESHOLD, compressionOptions, decompressFrame, loadDictionary
+
+# Tls holds the TLS settings shared with the server (see tls.py)
+from tls import WOULD_BLOCK, clientContext, ssl
+
+# Argparse reads the command line options
+import argparse
+
+#==
+#| Reconnect
+#|
+#| Description:
+#| RECONNECT_BASE / RECONNECT_MAX: the delay before reconnect attempt n is a random number of seconds between 0 and
+#|   min(RECONNECT_MAX, RECONNECT_BASE * 2 ** n) ("full jitter"). When a server restarts, its clients then come
+#|   back spread over the whole delay instead of all at the same moment.
+#| RECONNECT_STABLE: a connection that lasted at least this many seconds resets n to 0. A server that accepts and
+#|   drops connections right away keeps its clients backing off.
+#| OFFLINE_QUEUE: messages typed while disconnected are kept (up to this many) and sent after reconnecting.
+#| CLOSE_TIMEOUT: seconds '/q' waits for the messages that were not sent yet.
+#|
+#==
+
+RECONNECT_BASE = 0.5
+RECONNECT_MAX = 30.0
+RECONNECT_STABLE = 10.0
+OFFLINE_QUEUE = 1000
+CLOSE_TIMEOUT = 2.0
+
+#==
+#| Batch mode
+#|
+#| Description:
+#| CONSOLE_CHUNK: bytes read from the input at once. Every complete line in a chunk is queued before anything is
+#|   written, so the lines of a piped file go out together instead of one send per line.
+#| OUTPUT_BUFFER: bytes of received messages buffered before they are written to the --output file.
+#| OUTPUT_FLUSH: seconds a received message may wait in that buffer at most.
+#| BATCH_CLOSE_TIMEOUT: seconds a batch client waits at the end for the server to confirm it handled every message
+#|   (a server that throttles the client may still have many to read).
+#| CLOSE_TOKEN: payload of the MSG_PING that asks for that confirmation.
+#|
+#==
+
+CONSOLE_CHUNK = 65536
+OUTPUT_BUFFER = 1024 * 1024
+OUTPUT_FLUSH = 1.0
+BATCH_CLOSE_TIMEOUT = 60.0
+CLOSE_TOKEN = b'close'
+
+#==
+#| clientChat
+#|
+#| Description:
+#| Runs the client side of the chat with the server.
+#|
+#| My approach:
+#| (1) One thread waits on a selector for both the console (stdin) and the server socket, which is non-blocking.
+#|   -  Lines typed by the client are sent as soon as they are complete, and messages from the server are printed as
+#|      soon as they arrive, without a thread blocked in input() or recv().
+#|   -  Frames are queued on an outboundQueue and written whenever the socket can take them, so a slow server
+#|      never blocks the console.
+#| (2) If the connection is lost (or cannot be made), the client reconnects after a jittered exponential delay (see
+#|     Reconnect above).
+#|   - After reconnecting it joins its rooms again, asking for the messages after the last sequence number it
+#|     received (lastSeqs), so nothing sent to its rooms meanwhile is missed.
+#| (3) The program ends when the client enters '/q' or the console input ends.
+#|   - Neither the client nor the server send a quit message.
+#| (4) '/join ROOM' joins a room (async server mode) and sends the following messages to it, '/leave' leaves it.
+#| (5) The client sends a MSG_HELLO right after it connects (the server disconnects clients that stay silent). With
+#|     --compress it offers compression in it, and compresses large messages once the server accepted it.
+#| (6) A MSG_PING from the server (sent when the client has been quiet for a while) is answered with a MSG_PONG.
+#| (7) With --tls the connection is encrypted. The TLS handshake runs on the selector like the rest (see
+#|     tlsHandshake()), and the session of the last connection is offered when reconnecting, so the server can
+#|     resume it instead of doing a full handshake.
+#| (8) A MSG_RECONNECT means the server is shutting down or restarting (see serverRestarting()): the client answers
+#|     it, reads what the server still sends, then reconnects at a random moment within the window the server gave,
+#|     so the clients of a restarted server do not all come back at once.
+#|
+#| Batch mode (input from a file or a pipe, --replay or --output):
+#| (1) The input is read in chunks and every line of a chunk is sent with one write. Reading stops while more than
+#|     HIGH_WATER bytes wait to be sent, or while the client is disconnected, so a large file is streamed at the
+#|     speed of the connection and nothing is dropped.
+#| (2) --replay FILE sends the messages of a JSONL transcript (e.g. an --output file) at the pace they were
+#|     recorded ('t' in seconds), --speed times faster, or as fast as possible with --speed 0. Lines that are not
+#|     a valid record are skipped with a warning, and counted at the end.
+#| (3) --output FILE writes every message received as a JSON line (t, type, room, seq, sender, text) through a
+#|     large buffer instead of printing it, flushed at least every OUTPUT_FLUSH seconds.
+#| (4) At the end the client sends a MSG_PING and waits for its MSG_PONG before closing (see quit()). The
+#|     server handles the frames of a connection in order, so the answer means every message was handled.
+#| (5) Messages that may not have reached the server (the connection was lost with frames queued, or the server
+#|     did not confirm them) are reported, and the program then exits with status 1.
+#| (6) --linger keeps the client receiving for that many seconds after the input or the transcript ended.
+#|
+#| Notes:
+#| Where stdin cannot be watched by the selector (Windows consoles, regular files on Linux) a thread forwards it over
+#|   a socket pair, which can.
+#| Messages sent to everyone (MSG_CHAT) are not numbered, so the ones sent while the client was disconnected are
+#|   not replayed.
+#|
+#==
+class clientChat:
+
+    #==
+    #| __init__()
+    #|
+    #==
+    def __init__(self):
+
+        self.host = 'localhost'
+        self.port = 15777
+        self.clientSocket = None
+        self.connected = False
+        self.running = False
+        self.decoder = frameDecoder()
+        self.outbound = outboundQueue()
+        self.selector = None
+
+        # The room the client is talking in, None to talk to everyone.
+        # joined holds every room the client is in, so they can be joined again after a reconnect.
+        # lastSeqs holds the sequence number of the last message received from each room, so joining the room
+        #   again only replays the messages that were missed.
+        self.room = None
+        self.joined = set()
+        self.lastSeqs = {}
+
+        # compression holds what the client offers in its MSG_HELLO, compressor is the connection's
+        #   messageCompressor once the server accepted it (None until then).
+        self.compression = compressionOptions()
+        self.compressor = None
+
+        # tlsContext is the client's SSLContext, None without TLS. tlsSession is the session of the last connection,
+        #   offered to the server when reconnecting.
+        self.tlsContext = None
+        self.tlsSession = None
+
+        # Reconnect state (see Reconnect above).
+        # reconnect is False to quit when the connection is lost instead.
+        # attempts counts the failed attempts since the last stable connection, reconnectAt is when the next
+        #   attempt starts (None while connected or connecting).
+        self.reconnect = True
+        self.reconnectMax = RECONNECT_MAX
+        self.attempts = 0
+        self.reconnectAt = None
+        self.connectedAt = None
+        self.everConnected = False
+        self.offline = []
+
+        # draining is True from the server's MSG_RECONNECT until the connection is closed: new messages are kept for
+        #   the next connection. reconnectWindow is the window the server gave (None: the connection was lost).
+        self.draining = False
+        self.reconnectWindow = None
+
+        # quitting is True once '/q' was entered while a connection attempt was still in progress.
+        self.quitting = False
+
+        # Console input: what the selector watches (stdin or a socket pair), the function that reads the next chunk
+        #   from it and the part of a line read so far.
+        self.console = None
+        self.consoleRead = None
+        self.consoleBuffer = b''
+        self.consolePaused = False
+
+        # confirmBy is when a batch client that is quitting stops waiting for the server to answer its last
+        #   MSG_PING (see quit()). incomplete is True if messages may not have reached the server (exit status 1).
+        self.confirmBy = None
+        self.incomplete = False
+
+        # Batch mode (see Batch mode above).
+        # headless is True when the input is not typed by a person (a file, a pipe or a transcript): it is then
+        #   paused while the client is disconnected instead of being dropped after OFFLINE_QUEUE messages.
+        # corked holds back writes while a batch of frames is queued.
+        # replayRecords yields the records of the transcript (None once it ended), replayNext is the next one to send
+        #   and replayAt when (None while waiting for the connection or for the queue to drain). replayStart is the
+        #   time the replay started, replayFirst the 't' of its first record and replaySkipped the number of lines
+        #   that were not a valid record.
+        # output is the file the received messages are written to (None: print them), outputFlushAt the time its
+        #   buffer has to be written at the latest.
+        # linger is how long to keep receiving after the input ended, finishAt when to quit then.
+        self.headless = False
+        self.corked = False
+        self.replayRecords = None
+        self.replayNext = None
+        self.replayAt = None
+        self.replayStart = None
+        self.replayFirst = 0.0
+        self.replaySkipped = 0
+        self.speed = 1.0
+        self.replaying = False
+        self.output = None
+        self.outputFlushAt = None
+        self.linger = 0.0
+        self.finishAt = None
+
+    #==
+    #| handleLine()
+    #|
+    #| Description:
+    #| (1) Handles a line typed by the client.
+    #| (2) If the message is '/q', calls quit() to stop the client.
+    #| (3) Else sends the message to the server, or keeps it until the client is connected again.
+    #|
+    #==
+    def handleLine(self, clientMessage):
+
+        if clientMessage == "/q":
+            self.quit()
+            return
+
+        try:
+            frame = self.makeFrame(clientMessage)
+        except protocolError as error:
+            print(f"Cannot send message: {error}")
+            return
+
+        if frame is not None:
+            self.sendFrame(frame)
+
+    #==
+    #| sendFrame()
+    #|
+    #| Description:
+    #| Sends a frame, or keeps it until the client is connected again.
+    #|
+    #| Notes:
+    #| Joins and leaves are kept with the messages, so a room message typed after '/join' still goes out after the
+    #|   join and one typed before '/leave' before the leave (see connectReady()).
+    #|
+    #==
+    def sendFrame(self, frame):
+
+        if self.connected and not self.draining:
+            self.send(frame)
+        elif self.headless or len(self.offline) < OFFLINE_QUEUE:
+            self.offline.append(frame)
+        else:
+            print("Not connected, message dropped")
+
+    #==
+    #| makeFrame()
+    #|
+    #| Description:
+    #| Returns the frame to send for a line typed by the client:
+    #| (1) '/join ROOM' joins ROOM and makes it the current room. The server replays the messages missed since the
+    #|     client was last in the room (or its latest messages the first time).
+    #| (2) '/leave' leaves the current room.
+    #| (3) Anything else is a message for the current room, or for everyone if the client is not in a room.
+    #|
+    #| Notes:
+    #| Returns None when there is nothing to send (e.g. '/leave' outside of a room).
+    #|
+    #==
+    def makeFrame(self, clientMessage):
+
+        if clientMessage.startswith("/join "):
+            room = clientMessage[len("/join "):].strip()
+            frame = encodeFrame(MSG_JOIN, encodeJoin(room, self.lastSeqs.get(room, 0)))
+            self.room = room
+            self.joined.add(room)
+            return frame
+
+        if clientMessage == "/leave":
+            if self.room is None:
+                return None
+            frame = encodeFrame(MSG_LEAVE, encodeRoomName(self.room))
+            self.joined.discard(self.room)
+            self.room = None
+            return frame
+
+        return self.textFrame(clientMessage)
+
+    #==
+    #| textFrame()
+    #|
+    #| Description:
+    #| Returns the frame of a message for the current room, or for everyone if the client is not in a room.
+    #|
+    #==
+    def textFrame(self, text):
+
+        if self.room is not None:
+            return encodeFrame(MSG_ROOM, encodeRoomMessage(self.room, '', text))
+
+        return encodeFrame(MSG_CHAT, text.encode('utf-8'))
+
+    #==
+    #| handleFrame()
+    #|
+    #| Description:
+    #| Prints a message from the server (or writes it to the output file), and records the sequence number of room
+    #|   messages.
+    #|
+    #==
+    def handleFrame(self, msgType, payload):
+
+        msgType, payload = decompressFrame(self.compressor, msgType, payload)
+
+        if msgType == MSG_CHAT:
+            serverMessage = str(payload, 'utf-8', 'replace')
+            if self.output is not None:
+                self.writeOutput({'t': time.time(), 'type': 'chat', 'text': serverMessage})
+            else:
+                print(f"Server: {serverMessage}")
+        elif msgType == MSG_ROOM:
+            seq, room, sender, text = decodeRoomMessage(payload)
+            self.lastSeqs[room] = max(seq, self.lastSeqs.get(room, 0))
+            if self.output is not None:
+                self.writeOutput({'t': time.time(), 'type': 'room', 'room': room, 'seq': seq, 'sender': sender,
+                                  'text': text})
+            else:
+                print(f"[{room}] {sender}: {text}")
+        elif msgType == MSG_HELLO:
+            self.compressor = self.compression.accepted(payload)
+            if self.compressor is not None:
+                print("Compression on")
+        elif msgType == MSG_PING:
+            self.send(encodeFrame(MSG_PONG, payload))
+        elif msgType == MSG_PONG:
+            if payload == CLOSE_TOKEN and self.confirmBy is not None:
+                self.confirmBy = None
+                self.closeChat()
+        elif msgType == MSG_RECONNECT:
+            self.serverRestarting(decodeReconnect(payload))
+
+    #==
+    #| serverRestarting()
+    #|
+    #| Description:
+    #| (1) Answers the server's MSG_RECONNECT with a MSG_RECONNECT, the last frame sent on this connection.
+    #| (2) Keeps reading until the server closes the connection, so no message sent before the shutdown is lost.
+    #|     connectionLost() then reconnects within window seconds.
+    #|
+    #==
+    def serverRestarting(self, window):
+
+        if self.draining:
+            return
+
+        print(f"The server is restarting, reconnecting within {window:.0f}s")
+        self.send(encodeFrame(MSG_RECONNECT, b''))
+        self.draining = True
+        self.reconnectWindow = window
+
+    #==
+    #| send()
+    #|
+    #| Description:
+    #| Queues a frame for the server and writes as much of the queue as the socket takes right away (unless a batch
+    #|   is being queued, see corked). The rest is written by writeSocket() when the socket is writable again.
+    #|
+    #==
+    def send(self, frame):
+
+        if not self.connected or self.draining:
+            return
+
+        if self.compressor is not None:
+            frame = self.compressor.compressFrame(frame)
+
+        self.outbound.put(frame)
+
+        # A server that stopped reading would make the queue grow without limit, so drop the connection instead.
+        if self.outbound.size > MAX_QUEUED:
+            print("The server is not reading its messages")
+            self.connectionLost()
+            return
+
+        if not self.corked:
+            self.writeSocket()
+
+    #==
+    #| readSocket()
+    #|
+    #| Description:
+    #| Called by the selector when the server socket is readable: receives straight into the decoder's buffer and
+    #|   handles every complete frame.
+    #|
+    #| Notes:
+    #| A TLS socket may hold decrypted data the selector does not know about (pending()), so it is read until that
+    #|   is empty too.
+    #|
+    #==
+    def readSocket(self):
+
+        while True:
+            try:
+                # recv_into() returns 0 once the server has closed the connection.
+                nbytes = self.clientSocket.recv_into(self.decoder.writableView())
+            except WOULD_BLOCK:
+                return
+            except OSError:
+                self.connectionLost()
+                return
+
+            if nbytes == 0:
+                self.connectionLost()
+                return
+
+            self.decoder.commit(nbytes)
+
+            # One recv may hold part of a message or several messages, so handle every complete frame.
+            try:
+                for msgType, payload in self.decoder.frames():
+                    self.handleFrame(msgType, payload)
+                    if not self.connected:
+                        return
+            except protocolError as error:
+                print(f"Bad message from the server: {error}")
+                self.connectionLost()
+                return
+
+            if self.tlsContext is None or not self.clientSocket.pending():
+                return
+
+    #==
+    #| writeSocket()
+    #|
+    #| Description:
+    #| Writes queued frames until the queue is empty or the socket is full, and only asks the selector for
+    #|   writability while frames are waiting.
+    #|
+    #==
+    def writeSocket(self):
+
+        try:
+            while self.outbound.buffers:
+                self.outbound.sendTo(self.clientSocket)
+        except WOULD_BLOCK:
+            pass
+        except OSError:
+            self.connectionLost()
+            return
+
+        events = selectors.EVENT_READ
+        if self.outbound.buffers:
+            events |= selectors.EVENT_WRITE
+        self.selector.modify(self.clientSocket, events, self.socketReady)
+
+        if self.outbound.size < LOW_WATER:
+            self.inputDrained()
+
+    #==
+    #| socketReady()
+    #|
+    #| Description:
+    #| Selector callback of a connected server socket.
+    #|
+    #==
+    def socketReady(self, events):
+
+        if events & selectors.EVENT_WRITE:
+            self.writeSocket()
+        if events & selectors.EVENT_READ and self.connected:
+            self.readSocket()
+
+    #==
+    #| connect()
+    #|
+    #| Description:
+    #| Starts a non-blocking connection to the server. connectDone() is called once it has been made (or failed).
+    #|
+    #==
+    def connect(self):
+
+        self.reconnectAt = None
+
+        # Create the socket for the client.
+        # AF_INET: underlying network is using IPv4.
+        # SOCK_STREAM: use the TCP socket.
+        # Use TCP because we're sending/receiving data which needs to be accurate.
+        self.clientSocket = socket(AF_INET, SOCK_STREAM)
+        self.clientSocket.setblocking(False)
+
+        # Initiate the TCP connection (aka the three-way handshake) between the client and server. It completes in
+        #   the background and the socket becomes writable when it is done.
+        try:
+            error = self.clientSocket.connect_ex((self.host, self.port))
+        except OSError as exc:
+            error = exc.errno
+
+        if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+            self.clientSocket.close()
+            self.connectFailed()
+            return
+
+        self.selector.register(self.clientSocket, selectors.EVENT_WRITE, lambda events: self.connectDone())
+
+    #==
+    #| connectDone()
+    #|
+    #| Description:
+    #| Checks whether the connection was made, then starts the TLS handshake (with --tls) or calls connectReady().
+    #|
+    #==
+    def connectDone(self):
+
+        if self.clientSocket.getsockopt(SOL_SOCKET, SO_ERROR) != 0:
+            self.selector.unregister(self.clientSocket)
+            self.clientSocket.close()
+            self.connectFailed()
+            return
+
+        if self.tlsContext is None:
+            self.connectReady()
+            return
+
+        # wrap_socket() replaces the socket object, so the selector has to watch the new one.
+        self.selector.unregister(self.clientSocket)
+        try:
+            self.clientSocket = self.tlsContext.wrap_socket(self.clientSocket, server_hostname=self.host,
+                                                            do_handshake_on_connect=False, session=self.tlsSession)
+        except (ssl.SSLError, ValueError):
+            # A session the context does not accept (e.g. expired) is dropped and the next attempt starts fresh.
+            self.tlsSession = None
+            self.clientSocket.close()
+            self.connectFailed()
+            return
+
+        self.selector.register(self.clientSocket, selectors.EVENT_WRITE, lambda events: self.tlsHandshake())
+        self.tlsHandshake()
+
+    #==
+    #| tlsHandshake()
+    #|
+    #| Description:
+    #| Runs the next step of the TLS handshake, waiting on the selector for the server's answer, and calls
+    #|   connectReady() once it is done. A failed handshake (e.g. a certificate that is not trusted) counts as a
+    #|   failed connection attempt.
+    #|
+    #==
+    def tlsHandshake(self):
+
+        try:
+            self.clientSocket.do_handshake()
+        except ssl.SSLWantReadError:
+            self.selector.modify(self.clientSocket, selectors.EVENT_READ, lambda events: self.tlsHandshake())
+            return
+        except ssl.SSLWantWriteError:
+            self.selector.modify(self.clientSocket, selectors.EVENT_WRITE, lambda events: self.tlsHandshake())
+            return
+        except OSError as error:
+            print(f"TLS handshake failed: {error}")
+            self.selector.unregister(self.clientSocket)
+            self.clientSocket.close()
+            self.connectFailed()
+            return
+
+        self.connectReady()
+
+    #==
+    #| connectReady()
+    #|
+    #| Description:
+    #| (1) Offers compression (MSG_HELLO) and joins the client's rooms again from their last sequence numbers.
+    #| (2) Sends the messages, joins and leaves typed while the client was disconnected, in order.
+    #|
+    #| Notes:
+    #| Only the rooms the client was in before it was disconnected are joined in (1): going back through the queued
+    #|   frames, a queued join means the room was not joined yet and a queued leave that it was.
+    #|
+    #==
+    def connectReady(self):
+
+        if self.tlsContext is not None:
+            resumed = " (TLS session resumed)" if self.clientSocket.session_reused else " (TLS)"
+        else:
+            resumed = ""
+
+        if self.everConnected:
+            print(f"Reconnected to {self.host} on port {self.port}{resumed}")
+        else:
+            print(f"\nConnected to {self.host} on port {self.port}{resumed}")
+            print("Enter a message, /join ROOM, /leave or /q to quit")
+
+        self.connected = True
+        self.draining = False
+        self.everConnected = True
+        self.connectedAt = time.monotonic()
+        self.decoder = frameDecoder()
+        self.compressor = None
+        self.selector.modify(self.clientSocket, selectors.EVENT_READ, self.socketReady)
+
+        # Everything below goes out with one write.
+        self.corked = True
+        self.send(self.compression.hello())
+
+        rooms = set(self.joined)
+        for frame in reversed(self.offline):
+            length, msgType = HEADER.unpack_from(frame)
+            if msgType == MSG_JOIN:
+                rooms.discard(decodeJoin(frame[HEADER.size:])[0])
+            elif msgType == MSG_LEAVE:
+                rooms.add(decodeRoomName(frame[HEADER.size:]))
+
+        for room in sorted(rooms):
+            self.send(encodeFrame(MSG_JOIN, encodeJoin(room, self.lastSeqs.get(room, 0))))
+
+        # A connection lost meanwhile (the server stopped reading) keeps the rest for the next one.
+        offline = self.offline
+        self.offline = []
+        for index, frame in enumerate(offline):
+            if not self.connected:
+                self.offline = offline[index:] + self.offline
+                break
+            self.send(frame)
+
+        self.corked = False
+        if self.connected:
+            self.writeSocket()
+
+        if self.quitting:
+            self.closeChat()
+
+    #==
+    #| connectFailed()
+    #|
+    #| Description:
+    #| Schedules the next connection attempt, or stops the client if it does not reconnect.
+    #|
+    #==
+    def connectFailed(self):
+
+        self.clientSocket = None
+
+        if not self.reconnect or not self.running or self.quitting:
+            print("Cannot connect to server")
+            self.running = False
+            return
+
+        delay = self.nextDelay()
+        print(f"Cannot connect to server, retrying in {delay:.1f}s")
+        self.reconnectAt = time.monotonic() + delay
+
+    #==
+    #| nextDelay()
+    #|
+    #| Description:
+    #| Returns the delay before the next reconnect attempt (see Reconnect above).
+    #|
+    #==
+    def nextDelay(self):
+
+        delay = random.uniform(0, min(self.reconnectMax, RECONNECT_BASE * 2 ** self.attempts))
+        self.attempts = min(self.attempts + 1, 32)
+        return delay
+
+    #==
+    #| connectionLost()
+    #|
+    #| Description:
+    #| Closes the server socket and schedules a reconnect (or stops the client if it does not reconnect).
+    #|
+    #| Notes:
+    #| Frames that were still queued are dropped: the server may or may not have received them. Room messages
+    #|   missed meanwhile are replayed after the reconnect.
+    #|
+    #==
+    def connectionLost(self):
+
+        if not self.connected:
+            return
+
+        self.connected = False
+        self.draining = False
+        self.keepSession()
+        self.selector.unregister(self.clientSocket)
+        self.clientSocket.close()
+        self.clientSocket = None
+
+        # A batch client reports what it could not send (see Batch mode above).
+        if self.outbound.size and self.headless:
+            print(f"Connection lost, {self.outbound.size} bytes of messages were not sent")
+            self.incomplete = True
+        elif self.confirmBy is not None:
+            print("Connection lost before the server confirmed the last messages")
+            self.incomplete = True
+        self.confirmBy = None
+        self.outbound.drain()
+
+        if not self.reconnect or not self.running or self.quitting:
+            print("Disconnected from server")
+            self.running = False
+            return
+
+        # A server that asked the client to reconnect is replaced by a new one, the window spreads the clients out.
+        if self.reconnectWindow is not None:
+            self.attempts = 0
+            delay = random.uniform(0, self.reconnectWindow)
+            self.reconnectWindow = None
+        else:
+            if time.monotonic() - self.connectedAt >= RECONNECT_STABLE:
+                self.attempts = 0
+            delay = self.nextDelay()
+        print(f"Disconnected from server, reconnecting in {delay:.1f}s")
+        self.reconnectAt = time.monotonic() + delay
+
+    #==
+    #| keepSession()
+    #|
+    #| Description:
+    #| Keeps the TLS session of the connection for the next one. The server sends its session tickets after the
+    #|   handshake, so the session is only complete once the client has read something.
+    #|
+    #==
+    def keepSession(self):
+
+        if self.tlsContext is not None and self.clientSocket.session is not None:
+            self.tlsSession = self.clientSocket.session
+
+    #==
+    #| watchConsole()
+    #|
+    #| Description:
+    #| Registers the input (the file descriptor fd, normally stdin) with the selector, or starts forwardConsole()
+    #|   where the selector cannot watch it.
+    #|
+    #==
+    def watchConsole(self, fd):
+
+        if os.name != 'nt':
+            try:
+                self.selector.register(fd, selectors.EVENT_READ, lambda events: self.readConsole())
+                self.console = fd
+                self.consoleRead = lambda: os.read(fd, CONSOLE_CHUNK)
+                return
+            except (ValueError, OSError):
+                pass
+
+        reader, writer = socketpair()
+        threading.Thread(target=self.forwardConsole, args=(fd, writer), daemon=True).start()
+        self.selector.register(reader, selectors.EVENT_READ, lambda events: self.readConsole())
+        self.console = reader
+        self.consoleRead = lambda: reader.recv(CONSOLE_CHUNK)
+
+    #==
+    #| forwardConsole()
+    #|
+    #| Description:
+    #| Copies the input to a socket pair until it ends (runs on its own thread, see watchConsole()).
+    #|
+    #==
+    def forwardConsole(self, fd, writer):
+
+        try:
+            while True:
+                data = os.read(fd, CONSOLE_CHUNK)
+                if not data:
+                    break
+                writer.sendall(data)
+        except (OSError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    #==
+    #| readConsole()
+    #|
+    #| Description:
+    #| Reads what the client typed (or the next chunk of the input file) and handles every complete line, then
+    #|   writes them with one send. The end of the input quits like '/q' (see inputEnded()).
+    #|
+    #==
+    def readConsole(self):
+
+        data = self.consoleRead()
+        if not data:
+            self.selector.unregister(self.console)
+            self.console = None
+            if self.consoleBuffer:
+                self.handleLine(self.consoleBuffer.decode('utf-8', 'replace').strip())
+            self.inputEnded()
+            return
+
+        *lines, self.consoleBuffer = (self.consoleBuffer + data).split(b'\n')
+        self.corked = True
+        for line in lines:
+            if not self.running or self.quitting:
+                break
+            self.handleLine(line.decode('utf-8', 'replace').strip())
+        self.corked = False
+
+        if not self.running:
+            return
+        if self.connected:
+            self.writeSocket()
+
+        # The next chunk waits until the server took this one (see Batch mode above).
+        if self.outbound.size >= HIGH_WATER or (self.headless and (not self.connected or self.draining)):
+            self.pauseConsole()
+
+    #==
+    #| pauseConsole() / resumeConsole()
+    #|
+    #| Description:
+    #| Stop and start reading the input (see Batch mode above).
+    #|
+    #==
+    def pauseConsole(self):
+
+        if self.console is not None and not self.consolePaused:
+            self.selector.unregister(self.console)
+            self.consolePaused = True
+
+    def resumeConsole(self):
+
+        if self.console is not None and self.consolePaused:
+            self.selector.register(self.console, selectors.EVENT_READ, lambda events: self.readConsole())
+            self.consolePaused = False
+
+    #==
+    #| inputDrained()
+    #|
+    #| Description:
+    #| Called by writeSocket() once less than LOW_WATER bytes wait to be sent: reads the input again, or lets the
+    #|   run loop send the next records of the transcript.
+    #|
+    #==
+    def inputDrained(self):
+
+        self.resumeConsole()
+        if self.replayRecords is not None and self.replayAt is None and not self.replaying:
+            self.replayAt = time.monotonic()
+
+    #==
+    #| inputEnded()
+    #|
+    #| Description:
+    #| Quits once the input or the transcript ended, after lingering for linger seconds if asked to.
+    #|
+    #==
+    def inputEnded(self):
+
+        if self.linger and self.running:
+            self.finishAt = time.monotonic() + self.linger
+        else:
+            self.quit()
+
+    #==
+    #| startReplay()
+    #|
+    #| Description:
+    #| Opens a JSONL transcript to replay (see Batch mode above). Each line is a JSON object with the message's
+    #|   'text', and optionally its 'room' and its time 't' in seconds. The records are read one at a time, so a
+    #|   transcript of any size uses little memory.
+    #|
+    #==
+    def startReplay(self, path, speed):
+
+        replayFile = open(path, encoding='utf-8')
+        self.replayRecords = self.readRecords(replayFile)
+        self.replayNext = next(self.replayRecords, None)
+        self.replayFirst = self.replayNext.get('t', 0.0) if self.replayNext is not None else 0.0
+        self.speed = speed
+
+    #==
+    #| readRecords()
+    #|
+    #| Description:
+    #| Yields the records of the transcript, skipping (with a warning) the lines that are not JSON, not an object, or
+    #|   whose 'text', 'room' or 't' has the wrong type.
+    #|
+    #==
+    def readRecords(self, replayFile):
+
+        with replayFile:
+            for number, line in enumerate(replayFile, 1):
+                if not line.strip():
+                    continue
+
+                try:
+                    record = json.loads(line)
+                except ValueError as error:
+                    self.skipRecord(number, error)
+                    continue
+
+                if not isinstance(record, dict):
+                    self.skipRecord(number, "not a JSON object")
+                elif not isinstance(record.get('text', ''), str) or not isinstance(record.get('room') or '', str):
+                    self.skipRecord(number, "'text' and 'room' must be strings")
+                elif not isinstance(record.get('t', 0.0), (int, float)) or isinstance(record.get('t'), bool):
+                    self.skipRecord(number, "'t' must be a number")
+                else:
+                    yield record
+
+    def skipRecord(self, number, reason):
+
+        self.replaySkipped += 1
+        print(f"Skipped line {number} of the transcript: {reason}")
+
+    #==
+    #| replayDue()
+    #|
+    #| Description:
+    #| (1) Sends the records of the transcript that are due, with one write.
+    #| (2) Stops at the first record that is not due yet (replayAt is set to its time), or when more than HIGH_WATER
+    #|     bytes wait to be sent (inputDrained() then sets replayAt again).
+    #| (3) Calls inputEnded() after the last record.
+    #|
+    #| Notes:
+    #| The times are counted from the first record sent, and the replay waits while the client is disconnected.
+    #| With --speed 0 the records are sent as fast as the connection takes them, one batch per loop iteration so the
+    #|   messages received meanwhile are still read.
+    #|
+    #==
+    def replayDue(self):
+
+        self.replayAt = None
+        if not self.connected or self.draining:
+            return
+
+        now = time.monotonic()
+        if self.replayStart is None:
+            self.replayStart = now
+
+        self.corked = True
+        while self.replayNext is not None and self.connected and self.outbound.size < HIGH_WATER:
+            record = self.replayNext
+            if self.speed:
+                due = self.replayStart + (record.get('t', self.replayFirst) - self.replayFirst) / self.speed
+                if due > now:
+                    self.replayAt = due
+                    break
+
+            self.replayRecord(record)
+            self.replayNext = next(self.replayRecords, None)
+        self.corked = False
+
+        if self.connected:
+            self.replaying = True
+            self.writeSocket()
+            self.replaying = False
+
+        if self.replayNext is None:
+            self.replayRecords = None
+            if self.replaySkipped:
+                print(f"{self.replaySkipped} lines of the transcript were skipped")
+            self.inputEnded()
+        elif self.replayAt is None and self.outbound.size < LOW_WATER:
+            self.replayAt = now
+
+    #==
+    #| replayRecord()
+    #|
+    #| Description:
+    #| Sends one record of the transcript, joining its room first if the client is not talking in it.
+    #|
+    #==
+    def replayRecord(self, record):
+
+        text = record.get('text')
+        if text is None:
+            return
+
+        room = record.get('room')
+        if room != self.room:
+            self.handleLine(f"/join {room}" if room else "/leave")
+
+        try:
+            self.sendFrame(self.textFrame(text))
+        except protocolError as error:
+            print(f"Cannot send message: {error}")
+
+    #==
+    #| writeOutput()
+    #|
+    #| Description:
+    #| Writes a received message to the output file as one JSON line. The file's buffer is written out when it is
+    #|   full, or by run() at the latest OUTPUT_FLUSH seconds later.
+    #|
+    #==
+    def writeOutput(self, record):
+
+        self.output.write(json.dumps(record, ensure_ascii=False))
+        self.output.write('\n')
+        if self.outputFlushAt is None:
+            self.outputFlushAt = time.monotonic() + OUTPUT_FLUSH
+
+    def flushOutput(self):
+
+        self.output.flush()
+        self.outputFlushAt = None
+
+    #==
+    #| run()
+    #|
+    #| Description:
+    #| (1) Watches the input (inputFd, stdin by default, unless a transcript is replayed) and connects to the server.
+    #| (2) Waits on the selector and calls the callback of every ready socket (or stdin), until the client quits.
+    #| (3) Starts the next connection attempt once its delay has passed, and likewise sends the next records of the
+    #|     transcript, writes out the output buffer and quits after lingering.
+    #|
+    #==
+    def run(self, inputFd=None):
+
+        self.selector = selectors.DefaultSelector()
+        self.running = True
+
+        # A transcript is started by inputDrained() once the client is connected.
+        if self.replayRecords is None:
+            self.watchConsole(sys.stdin.fileno() if inputFd is None else inputFd)
+        self.connect()
+
+        try:
+            while self.running:
+                deadlines = [deadline for deadline in (self.reconnectAt, self.replayAt, self.outputFlushAt,
+                                                       self.finishAt, self.confirmBy) if deadline is not None]
+                timeout = max(0, min(deadlines) - time.monotonic()) if deadlines else None
+
+                for key, events in self.selector.select(timeout):
+                    if not self.running:
+                        break
+                    key.data(events)
+
+                now = time.monotonic()
+                if self.running and self.reconnectAt is not None and now >= self.reconnectAt:
+                    self.connect()
+                if self.running and self.replayAt is not None and now >= self.replayAt:
+                    self.replayDue()
+                if self.outputFlushAt is not None and now >= self.outputFlushAt:
+                    self.flushOutput()
+                if self.running and self.finishAt is not None and now >= self.finishAt:
+                    self.quit()
+                if self.running and self.confirmBy is not None and now >= self.confirmBy:
+                    print("The server did not confirm the last messages")
+                    self.incomplete = True
+                    self.closeChat()
+        except KeyboardInterrupt:
+            self.closeChat()
+        finally:
+            self.selector.close()
+            if self.output is not None:
+                self.flushOutput()
+
+    #==
+    #| quit()
+    #|
+    #| Description:
+    #| Stops the client ('/q' or the end of the console input). If a connection attempt is in progress and messages
+    #|   are waiting for it, the client first waits for it so those messages are sent.
+    #|
+    #| Notes:
+    #| A batch client first waits (up to BATCH_CLOSE_TIMEOUT seconds) for the server to answer a MSG_PING, see Batch
+    #|   mode above. A server that is draining closes the connection once it handled everything, which confirms too.
+    #|
+    #==
+    def quit(self):
+
+        if self.running and not self.connected and self.clientSocket is not None and self.offline:
+            self.quitting = True
+            return
+
+        if self.running and self.connected and self.headless:
+            self.finishAt = None
+            if self.confirmBy is None:
+                self.quitting = True
+                self.pauseConsole()
+                if not self.draining:
+                    self.send(encodeFrame(MSG_PING, CLOSE_TOKEN))
+                    self.confirmBy = time.monotonic() + BATCH_CLOSE_TIMEOUT
+            return
+
+        if self.offline:
+            print(f"Not connected, {len(self.offline)} message(s) were not sent")
+            self.incomplete = self.incomplete or self.headless
+        self.closeChat()
+
+    #==
+    #| closeChat()
+    #|
+    #| Description:
+    #| (1) Sends the messages that are still queued.
+    #| (2) Shuts down the sending side and reads (and drops) what the server still sends until it closes too.
+    #| (3) Closes the client socket. Steps (1) and (2) wait CLOSE_TIMEOUT seconds at most.
+    #|
+    #| Notes:
+    #| Closing a socket with unread data makes the kernel reset the connection, and the server may then drop the
+    #|   last messages before reading them. Step (2) avoids that (e.g. '/q' right after a room replay).
+    #|
+    #==
+    def closeChat(self):
+
+        self.running = False
+
+        if self.clientSocket is None:
+            return
+
+        self.selector.unregister(self.clientSocket)
+        if self.connected:
+            self.keepSession()
+            deadline = time.monotonic() + CLOSE_TIMEOUT
+            try:
+                self.clientSocket.settimeout(CLOSE_TIMEOUT)
+                while self.outbound.buffers:
+                    self.outbound.sendTo(self.clientSocket)
+
+                self.clientSocket.shutdown(SHUT_WR)
+                while True:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.clientSocket.settimeout(remaining)
+                    if not self.clientSocket.recv(65536):
+                        break
+            except OSError:
+                pass
+
+        self.connected = False
+        self.clientSocket.close()
+        self.clientSocket = None
+
+#==
+#| Run program
+#|
+#==
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Client-Server Chat (client)")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=15777)
+    parser.add_argument('--compress', action='store_true', help="ask the server to compress large messages")
+    parser.add_argument('--compress-dict', help="file of common text shared with the server (zlib dictionary)")
+    parser.add_argument('--compress-threshold', type=int, default=COMPRESS_THRESHOLD,
+                        help="only compress messages of at least this many bytes")
+    parser.add_argument('--tls', action='store_true', help="encrypt the connection (the server needs --tls-cert)")
+    parser.add_argument('--tls-ca',
+                        help="certificate to trust, e.g. the server's self-signed one (default: system CAs)")
+    parser.add_argument('--tls-insecure', action='store_true', help="do not check the server's certificate (testing)")
+    parser.add_argument('--input', help="send the lines of this file instead of reading the console")
+    parser.add_argument('--replay', help="send the messages of a JSONL transcript (e.g. an --output file) instead")
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help="replay the transcript this many times faster than it was recorded (0: at once)")
+    parser.add_argument('--output', help="append the messages received to this file as JSON lines instead of printing")
+    parser.add_argument('--linger', type=float, default=0,
+                        help="keep receiving for this many seconds after the input or the transcript ended")
+    parser.add_argument('--no-reconnect', action='store_true', help="quit when the connection to the server is lost")
+    parser.add_argument('--reconnect-max', type=float, default=RECONNECT_MAX,
+                        help="longest delay in seconds between reconnect attempts")
+    args = parser.parse_args()
+
+    chat = clientChat()
+    chat.host = args.host
+    chat.port = args.port
+    chat.compression = compressionOptions(args.compress, loadDictionary(args.compress_dict), args.compress_threshold)
+    if args.tls or args.tls_ca:
+        if ssl is None:
+            parser.error("this Python has no ssl module")
+        chat.tlsContext = clientContext(args.tls_ca, verify=not args.tls_insecure)
+    chat.reconnect = not args.no_reconnect
+    chat.reconnectMax = args.reconnect_max
+    chat.linger = args.linger
+
+    # Input that is not typed (a file, a pipe or a transcript) is streamed, see Batch mode above.
+    inputFile = open(args.input, 'rb') if args.input else None
+    if args.replay:
+        chat.startReplay(args.replay, args.speed)
+    chat.headless = inputFile is not None or args.replay is not None or not sys.stdin.isatty()
+    if args.output:
+        chat.output = open(args.output, 'a', encoding='utf-8', buffering=OUTPUT_BUFFER)
+
+    try:
+        chat.run(inputFile.fileno() if inputFile is not None else None)
+    finally:
+        if chat.output is not None:
+            chat.output.close()
+
+    # Batch mode: messages that may not have reached the server make the exit status 1.
+    sys.exit(1 if chat.incomplete else 0)
@@ -0,0 +1,275 @@
+# Student name: Michael Hrenko
+# Student OSU ID: 934396070
+# Course: CS 372
+# Programming Project: Client-Server Chat
+
+#==
+#| Sources
+#|
+#==
+
+# "zlib — Compression compatible with gzip", python.org, https://docs.python.org/3/library/zlib.html
+# "zlib Manual", zlib.net, https://www.zlib.net/manual.html
+# "Compression Extensions for WebSocket", RFC 7692, https://www.rfc-editor.org/rfc/rfc7692
+
+#==
+#| Import packages
+#|
+#==
+
+# Zlib compresses and decompresses the payloads (see sources above)
+import zlib
+
+# Time measures the CPU time spent compressing for the stats
+import time
+
+# Protocol holds the frame header, the COMPRESSED flag and the MSG_HELLO handshake
+from protocol import (COMPRESSED, HEADER, HELLO_ZLIB, MAX_PAYLOAD, MSG_HELLO, decodeHello, encodeFrame, encodeHello,
+                      protocolError)
+
+#==
+#| Compression
+#|
+#| Description:
+#| Payloads of at least COMPRESS_THRESHOLD bytes are compressed with zlib (raw deflate) once the client and the
+#|   server agreed on it with MSG_HELLO.
+#|
+#| My approach:
+#| (1) Each connection keeps one compressor and one decompressor for as long as it is open, and every message is
+#|     ended with a sync flush instead of starting a new stream. Later messages can refer back to earlier ones
+#|     (e.g. the same log lines pasted twice), and no per-message setup is paid.
+#| (2) The 4 bytes every sync flush ends with (00 00 ff ff) are not sent, the receiver adds them back (like the
+#|     WebSocket permessage-deflate extension, see RFC 7692).
+#| (3) Both sides can load the same dictionary of common text (--compress-dict). MSG_HELLO carries its Adler-32
+#|     checksum, and the dictionary is only used when both sides have the same one.
+#| (4) Small payloads are sent as they are: zlib cannot make them much smaller, and it would cost CPU.
+#|
+#| Notes:
+#| Once a payload went through the compressor it must be sent compressed, even if it got larger, because the
+#|   receiver's decompressor has to see the same stream.
+#| WINDOW_BITS and MEM_LEVEL are smaller than zlib's defaults, so a compressor uses about 64KB instead of 256KB
+#|   per connection.
+#|
+#==
+
+COMPRESS_THRESHOLD = 256
+COMPRESS_LEVEL = 6
+WINDOW_BITS = 13
+MEM_LEVEL = 6
+
+SYNC_TAIL = b'\x00\x00\xff\xff'
+
+# Deflate may make incompressible data a little larger, so payloads close to MAX_PAYLOAD are never compressed.
+MAX_COMPRESS = MAX_PAYLOAD - 1024
+
+#==
+#| loadDictionary()
+#|
+#| Description:
+#| Returns the contents of a dictionary file (bytes), b'' if path is None.
+#|
+#| Notes:
+#| Only the last 2 ** WINDOW_BITS bytes are used, so the most common strings should be at the end of the file.
+#|
+#==
+def loadDictionary(path):
+
+    if path is None:
+        return b''
+
+    with open(path, 'rb') as dictionaryFile:
+        return dictionaryFile.read()[-(1 << WINDOW_BITS):]
+
+#==
+#| compressionStats
+#|
+#| Description:
+#| The metrics of the compressors and decompressors of a process (see metrics.py), so the threshold can be tuned:
+#| (1) Bytes before and after compression and the time spent, in each direction.
+#| (2) The number of payloads sent uncompressed because they were below the threshold.
+#| (3) Gauges of the compression ratio (bytes before / bytes after) in each direction.
+#|
+#==
+class compressionStats:
+
+    def __init__(self, registry):
+
+        self.compressIn = registry.counter('chat_compress_in_bytes_total', "Payload bytes compressed")
+        self.compressOut = registry.counter('chat_compress_out_bytes_total', "Compressed bytes sent")
+        self.compressSeconds = registry.histogram('chat_compress_seconds', "Time spent compressing one payload")
+        self.skipped = registry.counter('chat_compress_skipped_total', "Payloads sent uncompressed (below threshold)")
+        self.decompressIn = registry.counter('chat_decompress_in_bytes_total', "Compressed bytes received")
+        self.decompressOut = registry.counter('chat_decompress_out_bytes_total', "Payload bytes decompressed")
+        self.decompressSeconds = registry.histogram('chat_decompress_seconds', "Time spent decompressing one payload")
+
+        registry.gauge('chat_compress_ratio', "Payload bytes / compressed bytes sent",
+                       lambda: self.ratio(self.compressIn, self.compressOut))
+        registry.gauge('chat_decompress_ratio', "Payload bytes / compressed bytes received",
+                       lambda: self.ratio(self.decompressOut, self.decompressIn))
+
+    @staticmethod
+    def ratio(before, after):
+
+        compressed = after.value()
+        return round(before.value() / compressed, 3) if compressed else 0
+
+#==
+#| compressionOptions
+#|
+#| Description:
+#| What one side of the chat supports (zlib on or off, the dictionary, the threshold) and the MSG_HELLO handshake:
+#| (1) The client sends hello() right after it connects.
+#| (2) The server answers with accept(), which also returns the connection's messageCompressor (None if
+#|     compression was not agreed on).
+#| (3) The client passes the answer to accepted() to get its own messageCompressor.
+#|
+#==
+class compressionOptions:
+
+    def __init__(self, enabled=False, dictionary=b'', threshold=COMPRESS_THRESHOLD, level=COMPRESS_LEVEL):
+
+        self.enabled = enabled
+        self.dictionary = dictionary
+        self.dictionaryId = zlib.adler32(dictionary) if dictionary else 0
+        self.threshold = threshold
+        self.level = level
+
+    def hello(self):
+
+        return encodeFrame(MSG_HELLO, encodeHello(HELLO_ZLIB if self.enabled else 0, self.dictionaryId))
+
+    def accept(self, payload, stats=None):
+
+        version, flags, dictionaryId = decodeHello(payload)
+
+        if not self.enabled or not flags & HELLO_ZLIB:
+            return encodeFrame(MSG_HELLO, encodeHello(0)), None
+
+        useDictionary = dictionaryId != 0 and dictionaryId == self.dictionaryId
+        reply = encodeFrame(MSG_HELLO, encodeHello(HELLO_ZLIB, self.dictionaryId if useDictionary else 0))
+        return reply, self.makeCompressor(useDictionary, stats)
+
+    def accepted(self, payload, stats=None):
+
+        version, flags, dictionaryId = decodeHello(payload)
+
+        if not self.enabled or not flags & HELLO_ZLIB:
+            return None
+
+        if dictionaryId != 0 and dictionaryId != self.dictionaryId:
+            raise protocolError("the server chose a compression dictionary this client does not have")
+
+        return self.makeCompressor(dictionaryId != 0, stats)
+
+    def makeCompressor(self, useDictionary, stats):
+
+        return messageCompressor(self.dictionary if useDictionary else b'', self.threshold, self.level, stats)
+
+#==
+#| messageCompressor
+#|
+#| Description:
+#| The zlib streams of one connection (see Compression above).
+#|
+#| Notes:
+#| compressFrame() must be called in the order the frames are sent, and decompress() in the order they were
+#|   received, since each message continues the stream of the one before it.
+#|
+#==
+class messageCompressor:
+
+    __slots__ = ('compressor', 'decompressor', 'threshold', 'stats')
+
+    #==
+    #| __init__()
+    #|
+    #==
+    def __init__(self, dictionary=b'', threshold=COMPRESS_THRESHOLD, level=COMPRESS_LEVEL, stats=None):
+
+        # Negative window bits: raw deflate, without the zlib header and checksum on every stream.
+        if dictionary:
+            self.compressor = zlib.compressobj(level, zlib.DEFLATED, -WINDOW_BITS, MEM_LEVEL, zdict=dictionary)
+            self.decompressor = zlib.decompressobj(-WINDOW_BITS, zdict=dictionary)
+        else:
+            self.compressor = zlib.compressobj(level, zlib.DEFLATED, -WINDOW_BITS, MEM_LEVEL)
+            self.decompressor = zlib.decompressobj(-WINDOW_BITS)
+
+        self.threshold = threshold
+        self.stats = stats
+
+    #==
+    #| compressFrame()
+    #|
+    #| Description:
+    #| Returns the frame with its payload compressed and COMPRESSED added to its type, or the frame itself if the
+    #|   payload is smaller than the threshold.
+    #|
+    #==
+    def compressFrame(self, frame):
+
+        size, msgType = HEADER.unpack_from(frame)
+        if size < self.threshold or size > MAX_COMPRESS:
+            if self.stats is not None:
+                self.stats.skipped.inc()
+            return frame
+
+        start = time.perf_counter()
+        data = self.compressor.compress(memoryview(frame)[HEADER.size:]) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        data = data[:-len(SYNC_TAIL)]
+
+        if self.stats is not None:
+            self.stats.compressSeconds.observe(time.perf_counter() - start)
+            self.stats.compressIn.inc(size)
+            self.stats.compressOut.inc(len(data))
+
+        return encodeFrame(msgType | COMPRESSED, data)
+
+    #==
+    #| decompress()
+    #|
+    #| Description:
+    #| Returns (type, payload) for a frame received with the COMPRESSED flag.
+    #|
+    #| Notes:
+    #| Raises protocolError if the data is not valid or would decompress to more than maxPayload bytes, so a small
+    #|   frame cannot make the receiver allocate a huge buffer.
+    #|
+    #==
+    def decompress(self, msgType, payload, maxPayload=MAX_PAYLOAD):
+
+        start = time.perf_counter()
+        try:
+            data = self.decompressor.decompress(b''.join((payload, SYNC_TAIL)), maxPayload + 1)
+        except zlib.error as error:
+            raise protocolError(f"cannot decompress message: {error}")
+
+        if len(data) > maxPayload or self.decompressor.unconsumed_tail:
+            raise protocolError(f"compressed message is larger than {maxPayload} bytes")
+
+        if self.stats is not None:
+            self.stats.decompressSeconds.observe(time.perf_counter() - start)
+            self.stats.decompressIn.inc(len(payload))
+            self.stats.decompressOut.inc(len(data))
+
+        return msgType & ~COMPRESSED, data
+
+#==
+#| decompressFrame()
+#|
+#| Description:
+#| Returns (type, payload) for a received frame: decompressed with the connection's compressor if the type has the
+#|   COMPRESSED flag, unchanged otherwise.
+#|
+#| Notes:
+#| Raises protocolError for a compressed frame on a connection that did not agree on compression.
+#|
+#==
+def decompressFrame(compressor, msgType, payload):
+
+    if not msgType & COMPRESSED:
+        return msgType, payload
+
+    if compressor is None:
+        raise protocolError("compressed message before compression was agreed on")
+
+    return compressor.decompress(msgType, payload)
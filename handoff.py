@@ -0,0 +1,147 @@
+# Student name: Michael Hrenko
+# Student OSU ID: 934396070
+# Course: CS 372
+# Programming Project: Client-Server Chat
+
+#==
+#| Sources
+#|
+#==
+
+# "socket.send_fds / socket.recv_fds", python.org, https://docs.python.org/3/library/socket.html#socket.send_fds
+# "unix(7) — SCM_RIGHTS", Linux manual page, https://man7.org/linux/man-pages/man7/unix.7.html
+# "Socket Takeover: Zero Downtime Release", Meta Engineering,
+#   https://engineering.fb.com/2020/10/30/networking-traffic/zero-downtime-release/
+
+#==
+#| Import packages
+#|
+#==
+
+# Socket passes the listening sockets between the processes over a Unix socket
+from socket import *
+
+# Asyncio waits for the new process's answer without blocking the old process's event loop
+import asyncio
+
+# Os removes the handoff socket's file
+import os
+
+#==
+#| Drain
+#|
+#| Description:
+#| DRAIN_TIMEOUT: seconds a stopping server waits for its clients to answer MSG_RECONNECT before closing their
+#|   connections anyway.
+#| RECONNECT_WINDOW: seconds over which the clients spread their reconnections (sent in MSG_RECONNECT), so a
+#|   restart does not bring every client back at the same moment.
+#|
+#==
+
+DRAIN_TIMEOUT = 5.0
+RECONNECT_WINDOW = 5.0
+
+#==
+#| Handoff
+#|
+#| Description:
+#| HANDOFF_TIMEOUT: seconds the old and the new process wait for each other during a handoff.
+#| HANDOFF_HELLO / HANDOFF_READY: the messages of the handoff (see handOff() and inheritSockets()).
+#| MAX_SOCKETS: most listening sockets passed at once (e.g. one IPv4 and one IPv6 socket).
+#|
+#| My approach:
+#| (1) A server started with --handoff PATH listens on a Unix socket at PATH.
+#| (2) A new server started with the same --handoff PATH first connects to it. The old server sends its listening
+#|     sockets over it (SCM_RIGHTS), so the new process gets its own file descriptors of the same sockets.
+#| (3) The new server starts accepting on them and answers HANDOFF_READY. Only then does the old server stop
+#|     accepting and drain its clients, so there is no moment where nobody listens on the port: connections in the
+#|     kernel's accept queue are accepted by whichever process gets to them first, and no connect is refused.
+#| (4) The new server then takes over PATH for the next restart.
+#|
+#| Notes:
+#| Needs Unix sockets and send_fds() (Python 3.9+, Unix).
+#|
+#==
+
+HANDOFF_TIMEOUT = 5.0
+HANDOFF_HELLO = b'chat-listen'
+HANDOFF_READY = b'ready'
+MAX_SOCKETS = 16
+
+#==
+#| inheritSockets()
+#|
+#| Description:
+#| Asks the server listening on the Unix socket at path for its listening sockets. Returns (connection, sockets),
+#|   or (None, []) if no server is listening there. HANDOFF_READY must be sent on the connection once the sockets
+#|   are being served.
+#|
+#==
+def inheritSockets(path):
+
+    connection = socket(AF_UNIX, SOCK_STREAM)
+    connection.settimeout(HANDOFF_TIMEOUT)
+
+    try:
+        connection.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        # No file, or a file left by a server that is gone: start from scratch.
+        connection.close()
+        return None, []
+
+    message, fds, flags, address = recv_fds(connection, len(HANDOFF_HELLO), MAX_SOCKETS)
+    sockets = [socket(fileno=fd) for fd in fds]
+    if message != HANDOFF_HELLO or not sockets:
+        for sock in sockets:
+            sock.close()
+        connection.close()
+        raise OSError(f"{path} did not send listening sockets")
+
+    return connection, sockets
+
+#==
+#| listenHandoff()
+#|
+#| Description:
+#| Returns a non-blocking Unix socket listening at path, for the next server to connect to.
+#|
+#| Notes:
+#| The file of the previous server (if any) is replaced. Its socket stays open until that server exits, but new
+#|   connections only reach this one.
+#|
+#==
+def listenHandoff(path):
+
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+    listener = socket(AF_UNIX, SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(1)
+    listener.setblocking(False)
+    return listener
+
+#==
+#| handOff()
+#|
+#| Description:
+#| Sends the listening sockets to the new server on connection and waits for its HANDOFF_READY. Returns True if
+#|   the new server took over, False if it failed or did not answer in time (the old server then keeps serving).
+#|
+#==
+async def handOff(connection, sockets):
+
+    loop = asyncio.get_running_loop()
+    connection.setblocking(False)
+
+    try:
+        send_fds(connection, [HANDOFF_HELLO], [sock.fileno() for sock in sockets])
+        answer = await asyncio.wait_for(loop.sock_recv(connection, len(HANDOFF_READY)), HANDOFF_TIMEOUT)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    finally:
+        connection.close()
+
+    return answer == HANDOFF_READY
@@ -0,0 +1,381 @@
+# Student name: Michael Hrenko
+# Student OSU ID: 934396070
+# Course: CS 372
+# Programming Project: Client-Server Chat
+
+#==
+#| Sources
+#|
+#==
+
+# "collections.deque", python.org, https://docs.python.org/3/library/collections.html#collections.deque
+# "mmap — Memory-mapped file support", python.org, https://docs.python.org/3/library/mmap.html
+# "bisect — Array bisection algorithm", python.org, https://docs.python.org/3/library/bisect.html
+# "collections.OrderedDict", python.org, https://docs.python.org/3/library/collections.html#collections.OrderedDict
+
+#==
+#| Import packages
+#|
+#==
+
+# Deque is the ring buffer that holds the recent messages of a room, OrderedDict keeps the open segment files in
+#   the order they were last used
+from collections import OrderedDict, deque
+
+# Bisect finds the log segment that holds a sequence number
+import bisect
+
+# Itertools slices the newest entries out of the ring buffer without copying it
+import itertools
+
+# Hashlib turns a room name into a directory name that is always valid on disk
+import hashlib
+
+# Mmap maps log segments into memory so replay does not read or parse whole files
+import mmap
+
+# Os lists, creates and truncates the log files
+import os
+
+# Struct packs and unpacks the log record header
+import struct
+
+# Protocol holds the frame header, which is added back to the payloads read from the log
+from protocol import HEADER, MSG_ROOM
+
+#==
+#| Limits
+#|
+#| Description:
+#| HISTORY_COUNT / HISTORY_BYTES: the most messages and bytes kept in memory for each room.
+#| REPLAY_COUNT / REPLAY_BYTES: the most messages and bytes sent to a client that joins a room.
+#| SEGMENT_BYTES: size at which the log of a room starts a new segment file.
+#| OPEN_SEGMENTS: the most segment files kept open for appending (one per room that was written to recently).
+#|
+#==
+
+HISTORY_COUNT = 100
+HISTORY_BYTES = 256 * 1024
+REPLAY_COUNT = 1000
+REPLAY_BYTES = 1024 * 1024
+SEGMENT_BYTES = 4 * 1024 * 1024
+OPEN_SEGMENTS = 64
+
+# Log record header: sequence number and payload length.
+RECORD = struct.Struct('!QI')
+
+#==
+#| roomHistory
+#|
+#| Description:
+#| Ring buffer of the most recent messages of one room.
+#|
+#| My approach:
+#| (1) entries holds (seq, frame) pairs, oldest first. The frame is the exact MSG_ROOM frame that was sent to the
+#|     room, so replaying it needs no encoding.
+#| (2) append() evicts the oldest entries while there are more than maxCount entries or maxBytes bytes.
+#| (3) since() returns the frames after a sequence number, or None if some of them were already evicted (the
+#|     caller then reads them from the messageLog).
+#|
+#==
+class roomHistory:
+
+    __slots__ = ('entries', 'size', 'maxCount', 'maxBytes')
+
+    #==
+    #| __init__()
+    #|
+    #==
+    def __init__(self, maxCount=HISTORY_COUNT, maxBytes=HISTORY_BYTES):
+
+        self.entries = deque()
+        self.size = 0
+        self.maxCount = maxCount
+        self.maxBytes = maxBytes
+
+    #==
+    #| append()
+    #|
+    #| Description:
+    #| Adds a frame with its sequence number and evicts the oldest frames that no longer fit.
+    #|
+    #==
+    def append(self, seq, frame):
+
+        self.entries.append((seq, frame))
+        self.size += len(frame)
+
+        while self.entries and (len(self.entries) > self.maxCount or self.size > self.maxBytes):
+            oldSeq, oldFrame = self.entries.popleft()
+            self.size -= len(oldFrame)
+
+    #==
+    #| since()
+    #|
+    #| Description:
+    #| Returns the frames with a sequence number greater than seq (oldest first), or None if the ring no longer holds
+    #|   all of them.
+    #|
+    #==
+    def since(self, seq):
+
+        if not self.entries:
+            return None
+        if self.entries[0][0] > seq + 1:
+            return None
+
+        return [frame for entrySeq, frame in self.entries if entrySeq > seq]
+
+    #==
+    #| last()
+    #|
+    #| Description:
+    #| Returns the newest count frames (oldest first).
+    #|
+    #==
+    def last(self, count):
+
+        if count <= 0:
+            return []
+
+        start = max(0, len(self.entries) - count)
+        return [frame for entrySeq, frame in itertools.islice(self.entries, start, None)]
+
+#==
+#| messageLog
+#|
+#| Description:
+#| Append-only log of every room message, split into segment files.
+#|
+#| My approach:
+#| (1) Each room has its own directory (named after a hash of the room name) of segment files. A segment is named
+#|     after the sequence number of its first record, so the segment holding a sequence number is found with a
+#|     binary search over the file names.
+#| (2) A record is the sequence number and length (RECORD) followed by the MSG_ROOM payload.
+#| (3) append() writes to a buffered file, flush() writes the buffered records out (the server calls it once per
+#|     event loop iteration). A new segment starts once the current one is larger than segmentBytes.
+#| (4) At most openSegments segment files are kept open. Opening one more closes (and so flushes) the one that
+#|     was written to least recently, so a server with many rooms does not run out of file descriptors. It is
+#|     opened again in append mode when its room gets the next message.
+#| (5) readSince() maps the segments that can hold the requested messages into memory and follows the record
+#|     headers, so only the records that are replayed are copied.
+#| (6) When a room is first used, the last segment is checked: a record cut short by a crash is truncated and the
+#|     last sequence number is recovered, so numbering continues after a restart.
+#|
+#==
+class messageLog:
+
+    #==
+    #| __init__()
+    #|
+    #==
+    def __init__(self, directory, segmentBytes=SEGMENT_BYTES, openSegments=OPEN_SEGMENTS):
+
+        self.directory = directory
+        self.segmentBytes = segmentBytes
+        self.openSegments = openSegments
+
+        # Per room: sorted first sequence numbers of its segments, the open segment file (least recently written
+        #   first, see My approach (4)) and the last sequence.
+        self.segments = {}
+        self.files = OrderedDict()
+        self.lastSeqs = {}
+
+        os.makedirs(directory, exist_ok=True)
+
+    #==
+    #| roomDirectory()
+    #|
+    #| Description:
+    #| Returns the directory that holds the segments of a room.
+    #|
+    #==
+    def roomDirectory(self, room):
+
+        return os.path.join(self.directory, hashlib.sha1(room.encode('utf-8')).hexdigest())
+
+    #==
+    #| segmentPath()
+    #|
+    #| Description:
+    #| Returns the path of the segment of a room that starts at firstSeq.
+    #|
+    #==
+    def segmentPath(self, room, firstSeq):
+
+        return os.path.join(self.roomDirectory(room), f"{firstSeq:020d}.log")
+
+    #==
+    #| openRoom()
+    #|
+    #| Description:
+    #| Loads the segment list of a room and recovers its last sequence number (see My approach (6)).
+    #|
+    #==
+    def openRoom(self, room):
+
+        if room in self.segments:
+            return
+
+        directory = self.roomDirectory(room)
+        os.makedirs(directory, exist_ok=True)
+
+        firsts = sorted(int(name[:-4]) for name in os.listdir(directory)
+                        if name.endswith('.log') and name[:-4].isdigit())
+        self.segments[room] = firsts
+        self.lastSeqs[room] = 0
+
+        if not firsts:
+            return
+
+        path = self.segmentPath(room, firsts[-1])
+        lastSeq = 0
+        validEnd = 0
+
+        # Follow the record headers through the mapped segment (the payloads are skipped, not read).
+        size = os.path.getsize(path)
+        if size:
+            with open(path, 'rb') as segment, mmap.mmap(segment.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                offset = 0
+                while offset + RECORD.size <= size:
+                    seq, length = RECORD.unpack_from(data, offset)
+                    if offset + RECORD.size + length > size:
+                        break
+                    lastSeq = seq
+                    offset += RECORD.size + length
+                    validEnd = offset
+
+        if validEnd < size:
+            os.truncate(path, validEnd)
+
+        self.lastSeqs[room] = lastSeq if lastSeq else firsts[-1] - 1
+
+    #==
+    #| lastSeq()
+    #|
+    #| Description:
+    #| Returns the sequence number of the last message logged for a room (0 if there is none).
+    #|
+    #==
+    def lastSeq(self, room):
+
+        self.openRoom(room)
+        return self.lastSeqs[room]
+
+    #==
+    #| append()
+    #|
+    #| Description:
+    #| Adds a MSG_ROOM payload with its sequence number to the room's current segment.
+    #|
+    #==
+    def append(self, room, seq, payload):
+
+        self.openRoom(room)
+        segment = self.files.get(room)
+        if segment is not None:
+            self.files.move_to_end(room)
+
+        # Open the last segment again when it was closed, and start a new one when there is none or it is full.
+        firsts = self.segments[room]
+        if segment is None and firsts:
+            segment = self.openSegment(room, firsts[-1])
+        if segment is None or segment.tell() >= self.segmentBytes:
+            if segment is not None:
+                segment.close()
+                del self.files[room]
+            firsts.append(seq)
+            segment = self.openSegment(room, seq)
+
+        segment.write(RECORD.pack(seq, len(payload)))
+        segment.write(payload)
+        self.lastSeqs[room] = seq
+
+    #==
+    #| openSegment()
+    #|
+    #| Description:
+    #| Opens a segment of a room for appending, first closing the least recently written segments while
+    #|   openSegments are open.
+    #|
+    #==
+    def openSegment(self, room, firstSeq):
+
+        while len(self.files) >= self.openSegments:
+            self.files.popitem(last=False)[1].close()
+
+        segment = self.files[room] = open(self.segmentPath(room, firstSeq), 'ab')
+        return segment
+
+    #==
+    #| flush()
+    #|
+    #| Description:
+    #| Writes the buffered records of every room to disk.
+    #|
+    #==
+    def flush(self):
+
+        for segment in self.files.values():
+            segment.flush()
+
+    #==
+    #| close()
+    #|
+    #==
+    def close(self):
+
+        for segment in self.files.values():
+            segment.close()
+        self.files.clear()
+
+    #==
+    #| readSince()
+    #|
+    #| Description:
+    #| Returns the MSG_ROOM frames of a room with a sequence number greater than seq (oldest first). At most
+    #|   maxCount frames and maxBytes bytes are returned, keeping the newest ones.
+    #|
+    #==
+    def readSince(self, room, seq, maxCount=REPLAY_COUNT, maxBytes=REPLAY_BYTES):
+
+        self.openRoom(room)
+        if room in self.files:
+            self.files[room].flush()
+
+        firsts = self.segments[room]
+        frames = deque()
+        size = 0
+
+        # Start with the segment that holds seq + 1 (the first message that is needed).
+        start = max(0, bisect.bisect_right(firsts, seq + 1) - 1)
+
+        for firstSeq in firsts[start:]:
+            path = self.segmentPath(room, firstSeq)
+            try:
+                with open(path, 'rb') as segment:
+                    if os.fstat(segment.fileno()).st_size == 0:
+                        continue
+                    data = mmap.mmap(segment.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                continue
+
+            with data:
+                offset = 0
+                while offset + RECORD.size <= len(data):
+                    recordSeq, length = RECORD.unpack_from(data, offset)
+                    payloadStart = offset + RECORD.size
+                    offset = payloadStart + length
+                    if offset > len(data):
+                        break
+                    if recordSeq <= seq:
+                        continue
+
+                    frame = HEADER.pack(length, MSG_ROOM) + data[payloadStart:offset]
+                    frames.append(frame)
+                    size += len(frame)
+
+                    while len(frames) > maxCount or size > maxBytes:
+                        size -= len(frames.popleft())
+
+        return list(frames)
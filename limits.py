@@ -0,0 +1,157 @@
+# Student name: Michael Hrenko
+# Student OSU ID: 934396070
+# Course: CS 372
+# Programming Project: Client-Server Chat
+
+#==
+#| Sources
+#|
+#==
+
+# "Token bucket", Wikipedia, https://en.wikipedia.org/wiki/Token_bucket
+# "Generic Cell Rate Algorithm", Wikipedia, https://en.wikipedia.org/wiki/Generic_cell_rate_algorithm
+# "BaseTransport.pause_reading", python.org,
+#   https://docs.python.org/3/library/asyncio-protocol.html#asyncio.ReadTransport.pause_reading
+
+#==
+#| Rate limits
+#|
+#| Description:
+#| MESSAGE_RATE / BYTE_RATE: default messages and bytes per second a client may send (0 turns a limit off).
+#| BURST_SECONDS: a sender that was quiet may send this many seconds worth of its rate at once.
+#| THROTTLE_LIMIT: a client throttled more than this many separate times within THROTTLE_WINDOW seconds (it goes
+#|   over its limits again after every break) is disconnected.
+#| THROTTLE_GAP: pauses less than this many seconds apart count as one throttle, however long it lasts.
+#|
+#==
+
+MESSAGE_RATE = 100.0
+BYTE_RATE = 1024 * 1024.0
+BURST_SECONDS = 2.0
+THROTTLE_LIMIT = 10
+THROTTLE_GAP = 1.0
+THROTTLE_WINDOW = 60.0
+
+#==
+#| rateLimits
+#|
+#| Description:
+#| The limits shared by every rateLimiter of one kind (e.g. every connection, or every room): messages and bytes
+#|   per second, and how much of each may be sent at once (the size of the buckets).
+#|
+#==
+class rateLimits:
+
+    def __init__(self, messageRate=0, byteRate=0, burst=BURST_SECONDS):
+
+        self.messageRate = messageRate
+        self.byteRate = byteRate
+        self.messageBurst = max(1.0, messageRate * burst)
+        self.byteBurst = byteRate * burst
+
+    #==
+    #| limiter()
+    #|
+    #| Description:
+    #| Returns a new rateLimiter with full buckets, or None when both limits are off (nothing to check per message).
+    #|
+    #==
+    def limiter(self, now):
+
+        if not self.messageRate and not self.byteRate:
+            return None
+
+        return rateLimiter(self, now)
+
+#==
+#| rateLimiter
+#|
+#| Description:
+#| Two token buckets (messages and bytes) for one connection or one room.
+#|
+#| My approach:
+#| (1) A bucket is only a number of tokens and the time it was last looked at. take() first adds the tokens earned
+#|     since then (rate * elapsed, up to the burst), so nothing runs between messages (no timer per bucket).
+#| (2) A message is only taken when the buckets hold enough tokens for it. Otherwise take() takes nothing and
+#|     returns how long the sender must wait until they do, and the caller keeps the message until then (see
+#|     chatConnection.handleFrames() in server.py): it is not decoded or sent on before the sender is within its
+#|     limits.
+#| (3) A message larger than the byte burst could never fit, so it only waits for a full bucket and leaves it
+#|     below 0 (the next message then waits for the debt to be paid back).
+#| (4) throttle() counts the separate throttles of a connection. While the client is paused it cannot send faster
+#|     than its limits (TCP holds its data back), so a long upload that is paused again and again is one throttle
+#|     and is never disconnected. A client that goes over its limits again after every break is (see THROTTLE_LIMIT).
+#|
+#| Notes:
+#| __slots__ and the shared rateLimits keep a limiter at a few dozen bytes, so every connection can have one.
+#|
+#==
+class rateLimiter:
+
+    __slots__ = ('limits', 'messages', 'bytes', 'stamp', 'throttledUntil', 'offences', 'offencesStamp')
+
+    def __init__(self, limits, now):
+
+        self.limits = limits
+        self.messages = limits.messageBurst
+        self.bytes = limits.byteBurst
+        self.stamp = now
+        self.throttledUntil = float('-inf')
+        self.offences = 0.0
+        self.offencesStamp = now
+
+    #==
+    #| take()
+    #|
+    #| Description:
+    #| Takes one message of size bytes if it is within the sender's limits and returns 0, otherwise takes nothing and
+    #|   returns the number of seconds until it is.
+    #|
+    #==
+    def take(self, size, now):
+
+        limits = self.limits
+        elapsed = now - self.stamp
+        self.stamp = now
+        delay = 0.0
+
+        if limits.messageRate:
+            self.messages = min(limits.messageBurst, self.messages + elapsed * limits.messageRate)
+            if self.messages < 1:
+                delay = (1 - self.messages) / limits.messageRate
+
+        if limits.byteRate:
+            self.bytes = min(limits.byteBurst, self.bytes + elapsed * limits.byteRate)
+            needed = min(size, limits.byteBurst)
+            if self.bytes < needed:
+                delay = max(delay, (needed - self.bytes) / limits.byteRate)
+
+        if not delay:
+            self.messages -= 1
+            self.bytes -= size
+
+        return delay
+
+    #==
+    #| throttle()
+    #|
+    #| Description:
+    #| Records that the sender is paused for delay seconds. Returns True if it was throttled more than limit separate
+    #|   times within THROTTLE_WINDOW seconds (limit 0: never).
+    #|
+    #| Notes:
+    #| A pause that starts within THROTTLE_GAP seconds of the end of the previous one continues the same throttle. The
+    #|   offences are a bucket too: they drain at limit per THROTTLE_WINDOW seconds.
+    #|
+    #==
+    def throttle(self, delay, now, limit=THROTTLE_LIMIT):
+
+        continued = now - self.throttledUntil <= THROTTLE_GAP
+        self.throttledUntil = now + delay
+        if continued or not limit:
+            return False
+
+        elapsed = now - self.offencesStamp
+        self.offencesStamp = now
+        self.offences = max(0.0, self.offences - elapsed * limit / THROTTLE_WINDOW) + 1
+        return self.offences > limit
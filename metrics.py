@@ -0,0 +1,332 @@
+# Student name: Michael Hrenko
+# Student OSU ID: 934396070
+# Course: CS 372
+# Programming Project: Client-Server Chat
+
+#==
+#| Sources
+#|
+#==
+
+# "Exposition formats", Prometheus, https://prometheus.io/docs/instrumenting/exposition_formats/
+# "http.server — HTTP servers", python.org, https://docs.python.org/3/library/http.server.html
+# "threading.local", python.org, https://docs.python.org/3/library/threading.html#thread-local-data
+
+#==
+#| Import packages
+#|
+#==
+
+# Bisect finds the histogram bucket of a value
+import bisect
+
+# Http.server serves the metrics to Prometheus on a side port
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Json writes the periodic snapshots
+import json
+
+# Sys is where the snapshots are written (stderr)
+import sys
+
+# Threading keeps one shard of every metric per thread and runs the HTTP server and the snapshot timer
+import threading
+
+# Time stamps the snapshots
+import time
+
+#==
+#| Metrics
+#|
+#| Description:
+#| counter:   a number that only goes up (e.g. messages received).
+#| gauge:     a number read when the metrics are collected (e.g. connected clients).
+#| histogram: counts of values per bucket, plus their sum and count (e.g. send latency).
+#|
+#| My approach:
+#| (1) Every thread that updates a counter or histogram gets its own shard (a small list) of it, so an update is a
+#|     plain += on a list only that thread writes. No lock is taken on the hot path.
+#| (2) collect() adds the shards up when the metrics are scraped. A scrape may miss an update that is happening at
+#|     the same moment, it is counted by the next scrape.
+#| (3) A gauge calls a function at collection time, so nothing is updated on the hot path at all.
+#|
+#==
+
+# Histogram buckets for latencies in seconds (50us .. 5s).
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                   2.5, 5.0)
+
+# Histogram buckets for sizes in bytes (64B .. 1MiB).
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+#==
+#| shardedMetric
+#|
+#| Description:
+#| Base of counter and histogram: hands every thread its own shard and keeps the list of shards for collect().
+#|
+#==
+class shardedMetric:
+
+    def __init__(self, name, helpText, shardSize):
+
+        self.name = name
+        self.helpText = helpText
+        self.shardSize = shardSize
+        self.local = threading.local()
+        self.shards = []
+        self.lock = threading.Lock()
+
+    #==
+    #| shard()
+    #|
+    #| Description:
+    #| Returns the calling thread's shard, creating it on the thread's first update.
+    #|
+    #==
+    def shard(self):
+
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = [0] * self.shardSize
+            with self.lock:
+                self.shards.append(shard)
+            return shard
+
+    #==
+    #| total()
+    #|
+    #| Description:
+    #| Returns the shards added up, item by item.
+    #|
+    #==
+    def total(self):
+
+        with self.lock:
+            shards = list(self.shards)
+
+        return [sum(values) for values in zip(*shards)] if shards else [0] * self.shardSize
+
+#==
+#| counter
+#|
+#==
+class counter(shardedMetric):
+
+    def __init__(self, name, helpText):
+
+        super().__init__(name, helpText, 1)
+
+    def inc(self, amount=1):
+
+        self.shard()[0] += amount
+
+    def value(self):
+
+        return self.total()[0]
+
+    def collect(self, labels=''):
+
+        return [f"# HELP {self.name} {self.helpText}", f"# TYPE {self.name} counter",
+                f"{self.name}{{{labels}}} {self.value()}" if labels else f"{self.name} {self.value()}"]
+
+    def snapshot(self):
+
+        return self.value()
+
+#==
+#| histogram
+#|
+#| Description:
+#| A shard holds one count per bucket, then the count of values above the last bucket, then the sum of the values.
+#|
+#==
+class histogram(shardedMetric):
+
+    def __init__(self, name, helpText, buckets=LATENCY_BUCKETS):
+
+        super().__init__(name, helpText, len(buckets) + 2)
+        self.buckets = buckets
+
+    def observe(self, value):
+
+        shard = self.shard()
+        shard[bisect.bisect_left(self.buckets, value)] += 1
+        shard[-1] += value
+
+    def collect(self, labels=''):
+
+        values = self.total()
+        lines = [f"# HELP {self.name} {self.helpText}", f"# TYPE {self.name} histogram"]
+        bucketLabels = labels + ',' if labels else ''
+        labels = f"{{{labels}}}" if labels else ''
+
+        cumulative = 0
+        for bound, count in zip(self.buckets, values):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{{bucketLabels}le="{bound}"}} {cumulative}')
+
+        cumulative += values[len(self.buckets)]
+        lines.append(f'{self.name}_bucket{{{bucketLabels}le="+Inf"}} {cumulative}')
+        lines.append(f"{self.name}_sum{labels} {values[-1]}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+    def snapshot(self):
+
+        values = self.total()
+        return {'count': sum(values[:-1]), 'sum': values[-1]}
+
+#==
+#| gauge
+#|
+#==
+class gauge:
+
+    def __init__(self, name, helpText, function):
+
+        self.name = name
+        self.helpText = helpText
+        self.function = function
+
+    def value(self):
+
+        # A gauge is read from another thread while the server runs, so a changing collection may need a retry.
+        for attempt in range(3):
+            try:
+                return self.function()
+            except RuntimeError:
+                continue
+        return 0
+
+    def collect(self, labels=''):
+
+        return [f"# HELP {self.name} {self.helpText}", f"# TYPE {self.name} gauge",
+                f"{self.name}{{{labels}}} {self.value()}" if labels else f"{self.name} {self.value()}"]
+
+    def snapshot(self):
+
+        return self.value()
+
+#==
+#| metricsRegistry
+#|
+#| Description:
+#| Holds the metrics of a process and serves them:
+#| (1) serve() starts an HTTP server on a side port that answers every GET with the metrics in the Prometheus text
+#|     format.
+#| (2) logEvery() writes a one line JSON snapshot of the metrics to stderr every interval seconds.
+#|
+#| Notes:
+#| Both run on daemon threads, so the chat's own threads and event loop are never blocked by a scrape.
+#|
+#==
+class metricsRegistry:
+
+    #==
+    #| __init__()
+    #|
+    #==
+    def __init__(self):
+
+        self.metrics = []
+        self.labels = {}
+        self.httpServer = None
+
+    def counter(self, name, helpText):
+
+        metric = counter(name, helpText)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, helpText, buckets=LATENCY_BUCKETS):
+
+        metric = histogram(name, helpText, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, name, helpText, function):
+
+        metric = gauge(name, helpText, function)
+        self.metrics.append(metric)
+        return metric
+
+    #==
+    #| collect()
+    #|
+    #| Description:
+    #| Returns every metric in the Prometheus text format, with the registry's labels (e.g. worker="1") on every
+    #|   sample so the series of the prefork workers can be told apart.
+    #|
+    #==
+    def collect(self):
+
+        labels = ','.join(f'{name}="{value}"' for name, value in sorted(self.labels.items()))
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.collect(labels))
+
+        return "\n".join(lines) + "\n"
+
+    #==
+    #| snapshot()
+    #|
+    #| Description:
+    #| Returns every metric as a dictionary (name: value), plus the time and labels (e.g. the worker number).
+    #|
+    #==
+    def snapshot(self):
+
+        values = {'time': round(time.time(), 3)}
+        values.update(self.labels)
+        for metric in self.metrics:
+            values[metric.name] = metric.snapshot()
+
+        return values
+
+    #==
+    #| serve()
+    #|
+    #| Description:
+    #| Starts the HTTP endpoint on host/port in a daemon thread.
+    #|
+    #==
+    def serve(self, host, port):
+
+        registry = self
+
+        class metricsHandler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+
+                body = registry.collect().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            # Scrapes happen every few seconds, so do not print a line for each one.
+            def log_message(self, format, *args):
+                pass
+
+        self.httpServer = ThreadingHTTPServer((host, port), metricsHandler)
+        self.httpServer.daemon_threads = True
+        threading.Thread(target=self.httpServer.serve_forever, daemon=True).start()
+
+    #==
+    #| logEvery()
+    #|
+    #| Description:
+    #| Writes a snapshot to stderr every interval seconds from a daemon thread.
+    #|
+    #==
+    def logEvery(self, interval):
+
+        def logLoop():
+            while True:
+                time.sleep(interval)
+                print(json.dumps(self.snapshot()), file=sys.stderr, flush=True)
+
+        threading.Thread(target=logLoop, daemon=True).start()
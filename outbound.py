@@ -0,0 +1,279 @@
+# Student name: Michael Hrenko
+# Student OSU ID: 934396070
+# Course: CS 372
+# Programming Project: Client-Server Chat
+
+#==
+#| Sources
+#|
+#==
+
+# "socket.sendmsg", python.org, https://docs.python.org/3/library/socket.html#socket.socket.sendmsg
+# "threading — Condition Objects", python.org, https://docs.python.org/3/library/threading.html#condition-objects
+# "writev(2)", Linux manual page, https://man7.org/linux/man-pages/man2/writev.2.html
+
+#==
+#| Import packages
+#|
+#==
+
+# Os reads the largest number of buffers one sendmsg() call accepts (IOV_MAX)
+import os
+
+# Time measures how long a producer has been waiting on a slow consumer
+import time
+
+# Threading provides the lock and condition shared by the threads that send on one socket
+import threading
+
+# Ssl tells TLS sockets apart, which cannot use sendmsg() (missing from some Python builds)
+try:
+    from ssl import SSLSocket
+except ImportError:
+    SSLSocket = None
+
+#==
+#| Limits
+#|
+#| Description:
+#| HIGH_WATER / LOW_WATER: once more than HIGH_WATER bytes are waiting to be sent, producers are paused until the
+#|   queue drops below LOW_WATER.
+#| MAX_QUEUED: a consumer with more than MAX_QUEUED bytes waiting is too slow and is disconnected.
+#| SLOW_TIMEOUT: seconds a producer waits for a paused queue to drain before the consumer is treated as too slow.
+#|
+#==
+
+HIGH_WATER = 256 * 1024
+LOW_WATER = 64 * 1024
+MAX_QUEUED = 4 * 1024 * 1024
+SLOW_TIMEOUT = 10.0
+
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+if IOV_MAX <= 0:
+    IOV_MAX = 1024
+
+#==
+#| slowConsumerError
+#|
+#| Description:
+#| Raised when the peer does not read its messages fast enough and the outbound queue stays above the limits.
+#|
+#==
+class slowConsumerError(OSError):
+    pass
+
+#==
+#| outboundQueue
+#|
+#| Description:
+#| The frames waiting to be sent on one connection.
+#|
+#| My approach:
+#| (1) put() appends a frame without copying it and keeps a running byte count (size).
+#| (2) sendTo() writes as many pending frames as possible with one sendmsg() (writev-style) call and keeps whatever
+#|     part of a frame the kernel did not accept, so partial sends never lose data.
+#| (3) drain() hands every pending frame to the caller at once (e.g. to asyncio's transport.writelines()).
+#|
+#| Notes:
+#| Not thread safe by itself, see queuedSender for the threaded mode.
+#|
+#==
+class outboundQueue:
+
+    __slots__ = ('buffers', 'size', 'retry')
+
+    #==
+    #| __init__()
+    #|
+    #==
+    def __init__(self):
+
+        self.buffers = []
+        self.size = 0
+        self.retry = False
+
+    #==
+    #| put()
+    #|
+    #| Description:
+    #| Adds a frame (bytes) to the end of the queue.
+    #|
+    #==
+    def put(self, frame):
+
+        self.buffers.append(frame)
+        self.size += len(frame)
+
+    #==
+    #| drain()
+    #|
+    #| Description:
+    #| Removes and returns every pending frame.
+    #|
+    #==
+    def drain(self):
+
+        buffers = self.buffers
+        self.buffers = []
+        self.size = 0
+        self.retry = False
+        return buffers
+
+    #==
+    #| sendTo()
+    #|
+    #| Description:
+    #| (1) Sends the pending frames to sock with one sendmsg() call (up to IOV_MAX frames).
+    #| (2) Removes the frames that were sent. A frame that was only partly sent is replaced by its unsent part.
+    #| (3) Returns the number of bytes sent.
+    #|
+    #| Notes:
+    #| Falls back to send() of the joined frames on platforms without sendmsg() (e.g. Windows).
+    #| A TLS socket (see tls.py) gets the batch joined into one buffer, which stays first in the queue: a TLS write
+    #|   that could not complete must be retried with the same data, so no frame is added to it until it was sent.
+    #|
+    #==
+    def sendTo(self, sock):
+
+        if not self.buffers:
+            return 0
+
+        batch = self.buffers[:IOV_MAX]
+        if SSLSocket is not None and isinstance(sock, SSLSocket):
+            if not self.retry and len(batch) > 1:
+                self.buffers[:len(batch)] = [b''.join(batch)]
+            batch = self.buffers[:1]
+            self.retry = True
+            sent = sock.send(batch[0])
+            self.retry = False
+        elif hasattr(sock, 'sendmsg'):
+            sent = sock.sendmsg(batch)
+        else:
+            sent = sock.send(b''.join(batch))
+
+        self.size -= sent
+
+        # Drop the frames that were sent completely.
+        count = 0
+        remaining = sent
+        for buffer in batch:
+            if remaining < len(buffer):
+                break
+            remaining -= len(buffer)
+            count += 1
+        del self.buffers[:count]
+
+        # Keep the part of the next frame that the kernel did not accept.
+        if remaining:
+            self.buffers[0] = memoryview(self.buffers[0])[remaining:]
+
+        return sent
+
+#==
+#| queuedSender
+#|
+#| Description:
+#| Sends frames on a blocking socket for the threaded mode, coalescing frames that arrive while a send is running.
+#|
+#| My approach:
+#| (1) send() puts the frame on an outboundQueue. If no other thread is sending, the calling thread becomes the
+#|     writer and sends everything that is queued (including frames added meanwhile) with sendmsg().
+#| (2) If another thread is already writing, send() returns right away and that writer sends the frame in its
+#|     next batch.
+#| (3) If more than highWater bytes are pending, send() pauses the producer until the queue drops below
+#|     lowWater. If that takes longer than slowTimeout the consumer is too slow and slowConsumerError is raised.
+#|
+#==
+class queuedSender:
+
+    #==
+    #| __init__()
+    #|
+    #==
+    def __init__(self, sock, highWater=HIGH_WATER, lowWater=LOW_WATER, slowTimeout=SLOW_TIMEOUT):
+
+        self.sock = sock
+        self.highWater = highWater
+        self.lowWater = lowWater
+        self.slowTimeout = slowTimeout
+        self.queue = outboundQueue()
+        self.condition = threading.Condition()
+        self.writing = False
+
+    #==
+    #| send()
+    #|
+    #| Description:
+    #| Queues a frame and sends it (along with any other pending frames) unless another thread is already doing so.
+    #|
+    #| Notes:
+    #| Raises slowConsumerError if the producer had to wait more than slowTimeout, or OSError if the send failed.
+    #|
+    #==
+    def send(self, frame):
+
+        with self.condition:
+
+            # Pause the producer while the consumer catches up.
+            if self.queue.size > self.highWater:
+                deadline = time.monotonic() + self.slowTimeout
+                while self.queue.size > self.lowWater:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not self.condition.wait(remaining):
+                        raise slowConsumerError("peer is not reading its messages")
+
+            self.queue.put(frame)
+
+            if self.writing:
+                return
+            self.writing = True
+
+        try:
+            self.writeAll()
+        finally:
+            with self.condition:
+                self.writing = False
+                self.condition.notify_all()
+
+    #==
+    #| writeAll()
+    #|
+    #| Description:
+    #| Sends until the queue is empty, waking paused producers whenever the queue drops below lowWater.
+    #|
+    #| Notes:
+    #| Only one thread (the writer) runs this at a time. The lock is released during sendmsg() so producers can
+    #|   keep adding frames to the next batch.
+    #| Used by the threaded mode only, which has no TLS: outboundQueue.sendTo() never joins the batch here.
+    #|
+    #==
+    def writeAll(self):
+
+        while True:
+            with self.condition:
+                if not self.queue.buffers:
+                    return
+                batch = outboundQueue()
+                batch.buffers = self.queue.buffers[:IOV_MAX]
+                batch.size = sum(len(buffer) for buffer in batch.buffers)
+
+            count = len(batch.buffers)
+            size = batch.size
+            try:
+                while batch.buffers:
+                    batch.sendTo(self.sock)
+            finally:
+                # Producers only append, so the first frames of the queue are the ones that were just sent. If a send
+                #   failed part way, only what was sent is removed (and the rest of a frame that was partly sent is
+                #   kept), so a later send never repeats bytes and breaks the framing.
+                with self.condition:
+                    del self.queue.buffers[:count - len(batch.buffers)]
+                    if batch.buffers:
+                        self.queue.buffers[0] = batch.buffers[0]
+                    self.queue.size -= size - batch.size
+                    if self.queue.size <= self.lowWater:
+                        self.condition.notify_all()
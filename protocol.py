@@ -0,0 +1,510 @@
+# Student name: Michael Hrenko
+# Student OSU ID: 934396070
+# Course: CS 372
+# Programming Project: Client-Server Chat
+
+#==
+#| Sources
+#|
+#==
+
+# "struct — Interpret bytes as packed binary data", python.org, https://docs.python.org/3/library/struct.html
+# "Memory Views", python.org, https://docs.python.org/3/library/stdtypes.html#memoryview
+
+#==
+#| Import packages
+#|
+#==
+
+# Struct packs and unpacks the fixed size frame header (see source above)
+import struct
+
+#==
+#| Wire protocol
+#|
+#| Description:
+#| Every message sent between the client and the server is a frame:
+#|
+#|   +----------------------+------------------+--------------------------+
+#|   | length (4 bytes, BE) | type (1 byte)    | payload (length bytes)   |
+#|   +----------------------+------------------+--------------------------+
+#|
+#| Notes:
+#| TCP is a byte stream, so one recv() may hold part of a frame or several frames. The length prefix lets the
+#|   receiver find where each message ends no matter how the bytes were split or merged.
+#| Payloads are only decoded (e.g. UTF-8) once the whole frame has arrived, so a character is never cut in half.
+#|
+#| Message types:
+#| MSG_CHAT:  UTF-8 text sent to everyone (the other side in the threaded mode).
+#| MSG_JOIN:  client -> server, join a room and replay its recent messages, see encodeJoin().
+#| MSG_LEAVE: client -> server, the payload is the UTF-8 name of the room to leave.
+#| MSG_ROOM:  a message for one room, see encodeRoomMessage(). The client leaves the sender empty and the sequence
+#|            number 0, the server fills them in before sending the message to the room's members.
+#| MSG_HELLO: the handshake, see encodeHello(). The client offers options (e.g. compression) right after it
+#|            connects and the server answers with the options it accepted.
+#| MSG_PING:  asks the other side to show it is still there. It answers with a MSG_PONG holding the same payload.
+#| MSG_PONG:  the answer to a MSG_PING.
+#| MSG_RECONNECT: server -> client, the server is shutting down or handing over to a new process, see
+#|            encodeReconnect(). The client sends it back once it has stopped sending, then the server closes the
+#|            connection and the client reconnects.
+#|
+#| The high bit of the type (COMPRESSED) marks a payload compressed with the connection's zlib stream, e.g.
+#|   MSG_CHAT | COMPRESSED (see compression.py). It is only used once both sides agreed on it with MSG_HELLO.
+#|
+#| Types 64 and up are only used on the bus between the worker processes of the prefork mode (see bus.py).
+#|
+#==
+
+HEADER = struct.Struct('!IB')
+
+ROOM_HEADER = struct.Struct('!QBB')
+JOIN_HEADER = struct.Struct('!Q')
+HELLO = struct.Struct('!BBI')
+SEQ = struct.Struct('!Q')
+RECONNECT = struct.Struct('!I')
+
+# Message types.
+MSG_CHAT = 1
+MSG_JOIN = 2
+MSG_LEAVE = 3
+MSG_ROOM = 4
+MSG_HELLO = 5
+MSG_PING = 6
+MSG_PONG = 7
+MSG_RECONNECT = 8
+
+# Flag added to the message type of a compressed payload.
+COMPRESSED = 0x80
+
+# Bus message types (prefork mode, see bus.py).
+BUS_PUBLISH = 64
+BUS_DELIVER = 65
+BUS_SUBSCRIBE = 66
+BUS_UNSUBSCRIBE = 67
+BUS_REPLAY = 68
+BUS_CHAT = 69
+
+# Version sent in MSG_HELLO and the option flags it can carry.
+PROTOCOL_VERSION = 1
+HELLO_ZLIB = 0x01
+
+# Room and sender names are at most this many bytes (UTF-8).
+MAX_NAME = 255
+
+# Largest payload accepted from a peer. Protects the receiver from allocating a huge buffer for a bad length.
+MAX_PAYLOAD = 1024 * 1024
+
+# Starting size of each decoder buffer. It grows for larger frames and shrinks back once they are consumed.
+BUFFER_SIZE = 4096
+
+#==
+#| protocolError
+#|
+#| Description:
+#| Raised when a peer sends a frame that breaks the wire protocol (e.g. a payload larger than MAX_PAYLOAD).
+#|
+#==
+class protocolError(ValueError):
+    pass
+
+#==
+#| encodeFrame()
+#|
+#| Description:
+#| Returns the frame (header + payload) for a message type and a payload (bytes).
+#|
+#==
+def encodeFrame(msgType, payload):
+
+    return HEADER.pack(len(payload), msgType) + payload
+
+#==
+#| encodeRoomMessage()
+#|
+#| Description:
+#| Returns the MSG_ROOM payload for a room, a sender and the message text (all str) and its sequence number:
+#|
+#|   +-----------+---------------+-----------------+------+--------+------+
+#|   | seq       | room length   | sender length   | room | sender | text |
+#|   | (8 bytes) | (1 byte)      | (1 byte)        |      |        |      |
+#|   +-----------+---------------+-----------------+------+--------+------+
+#|
+#| The server numbers the messages of each room 1, 2, 3, ... so a client can ask for the messages it missed.
+#|
+#| Notes:
+#| Raises protocolError if the room is empty or a name is longer than MAX_NAME bytes.
+#|
+#==
+def encodeRoomMessage(room, sender, text, seq=0):
+
+    room = room.encode('utf-8')
+    sender = sender.encode('utf-8')
+
+    if not room or len(room) > MAX_NAME or len(sender) > MAX_NAME:
+        raise protocolError("room and sender names must be 1 to 255 bytes")
+
+    return ROOM_HEADER.pack(seq, len(room), len(sender)) + room + sender + text.encode('utf-8')
+
+#==
+#| decodeRoomHeader()
+#|
+#| Description:
+#| Returns (seq, room, sender, textStart) from a MSG_ROOM payload (bytes or memoryview), where textStart is the
+#|   offset of the text in the payload. The text itself is not decoded.
+#|
+#| Notes:
+#| Raises protocolError if the payload is too short or the room is empty.
+#|
+#==
+def decodeRoomHeader(payload):
+
+    if len(payload) < ROOM_HEADER.size:
+        raise protocolError("room message is too short")
+
+    seq, roomLength, senderLength = ROOM_HEADER.unpack_from(payload)
+    roomEnd = ROOM_HEADER.size + roomLength
+    senderEnd = roomEnd + senderLength
+
+    if roomLength == 0 or len(payload) < senderEnd:
+        raise protocolError("room message is malformed")
+
+    room = str(payload[ROOM_HEADER.size:roomEnd], 'utf-8', 'replace')
+    sender = str(payload[roomEnd:senderEnd], 'utf-8', 'replace')
+    return seq, room, sender, senderEnd
+
+#==
+#| decodeRoomMessage()
+#|
+#| Description:
+#| Returns (seq, room, sender, text) from a MSG_ROOM payload (bytes or memoryview).
+#|
+#| Notes:
+#| Raises protocolError if the payload is too short or the room is empty.
+#|
+#==
+def decodeRoomMessage(payload):
+
+    seq, room, sender, textStart = decodeRoomHeader(payload)
+    return seq, room, sender, str(payload[textStart:], 'utf-8', 'replace')
+
+#==
+#| setRoomSeq()
+#|
+#| Description:
+#| Returns a copy of a MSG_ROOM payload with its sequence number set to seq (the rest is not decoded).
+#|
+#==
+def setRoomSeq(payload, seq):
+
+    return SEQ.pack(seq) + payload[SEQ.size:]
+
+#==
+#| encodeRoomName()
+#|
+#| Description:
+#| Returns the MSG_LEAVE payload for a room name (str).
+#|
+#| Notes:
+#| Raises protocolError if the name is empty or longer than MAX_NAME bytes.
+#|
+#==
+def encodeRoomName(room):
+
+    room = room.encode('utf-8')
+    if not room or len(room) > MAX_NAME:
+        raise protocolError("room names must be 1 to 255 bytes")
+
+    return room
+
+#==
+#| encodeJoin()
+#|
+#| Description:
+#| Returns the MSG_JOIN payload for a room name (str):
+#|
+#|   +-----------+------+
+#|   | since     | room |
+#|   | (8 bytes) |      |
+#|   +-----------+------+
+#|
+#| since = 0 asks for the room's latest messages, since = N for every message after sequence number N (e.g. the
+#|   last message the client received before it was disconnected).
+#|
+#==
+def encodeJoin(room, since=0):
+
+    return JOIN_HEADER.pack(since) + encodeRoomName(room)
+
+#==
+#| decodeJoin()
+#|
+#| Description:
+#| Returns (room, since) from a MSG_JOIN payload.
+#|
+#==
+def decodeJoin(payload):
+
+    if len(payload) < JOIN_HEADER.size:
+        raise protocolError("join message is too short")
+
+    since, = JOIN_HEADER.unpack_from(payload)
+    return decodeRoomName(payload[JOIN_HEADER.size:]), since
+
+#==
+#| encodeHello()
+#|
+#| Description:
+#| Returns the MSG_HELLO payload for the option flags (e.g. HELLO_ZLIB) and the id of the compression dictionary
+#|   (0 for none):
+#|
+#|   +-----------+-----------+---------------+
+#|   | version   | flags     | dictionary id |
+#|   | (1 byte)  | (1 byte)  | (4 bytes)     |
+#|   +-----------+-----------+---------------+
+#|
+#==
+def encodeHello(flags, dictionaryId=0):
+
+    return HELLO.pack(PROTOCOL_VERSION, flags, dictionaryId)
+
+#==
+#| decodeHello()
+#|
+#| Description:
+#| Returns (version, flags, dictionaryId) from a MSG_HELLO payload.
+#|
+#| Notes:
+#| Bytes after the known fields are ignored, so later versions can add options.
+#|
+#==
+def decodeHello(payload):
+
+    if len(payload) < HELLO.size:
+        raise protocolError("hello message is too short")
+
+    return HELLO.unpack_from(payload)
+
+#==
+#| encodeReconnect()
+#|
+#| Description:
+#| Returns the MSG_RECONNECT payload for the number of seconds (float) over which the clients should spread their
+#|   reconnections (sent in milliseconds, 4 bytes):
+#|
+#|   +-----------------+
+#|   | window (ms)     |
+#|   | (4 bytes)       |
+#|   +-----------------+
+#|
+#==
+def encodeReconnect(window):
+
+    return RECONNECT.pack(int(window * 1000))
+
+#==
+#| decodeReconnect()
+#|
+#| Description:
+#| Returns the reconnect window in seconds from a MSG_RECONNECT payload (0 if the payload is empty, e.g. the
+#|   client's answer).
+#|
+#==
+def decodeReconnect(payload):
+
+    if len(payload) < RECONNECT.size:
+        return 0.0
+
+    return RECONNECT.unpack_from(payload)[0] / 1000
+
+#==
+#| decodeRoomName()
+#|
+#| Description:
+#| Returns the room name from a MSG_LEAVE payload.
+#|
+#| Notes:
+#| Raises protocolError if the name is empty or longer than MAX_NAME bytes.
+#|
+#==
+def decodeRoomName(payload):
+
+    if not payload or len(payload) > MAX_NAME:
+        raise protocolError("room names must be 1 to 255 bytes")
+
+    return str(payload, 'utf-8', 'replace')
+
+#==
+#| frameDecoder
+#|
+#| Description:
+#| Incremental decoder that turns the bytes received from a socket back into frames.
+#|
+#| My approach:
+#| (1) Data is received straight into a reusable bytearray (recv_into() or asyncio's BufferedProtocol) through
+#|     writableView() and commit(), so received bytes are never copied into temporary objects.
+#| (2) frames() yields (type, payload) for every complete frame in the buffer. The payload is a memoryview of the
+#|     buffer (no copy).
+#| (3) The unread bytes of a partial frame are moved to the start of the buffer only when more space is needed.
+#|
+#| Notes:
+#| A payload memoryview is only valid until the next writableView() call, so decode or copy it right away.
+#|
+#==
+class frameDecoder:
+
+    __slots__ = ('maxPayload', 'bufferSize', 'buffer', 'view', 'start', 'end')
+
+    #==
+    #| __init__()
+    #|
+    #==
+    def __init__(self, maxPayload=MAX_PAYLOAD, bufferSize=BUFFER_SIZE):
+
+        self.maxPayload = maxPayload
+        self.bufferSize = bufferSize
+        self.buffer = bytearray(bufferSize)
+        self.view = memoryview(self.buffer)
+
+        # self.buffer[self.start:self.end] holds the bytes that were received but not decoded yet.
+        self.start = 0
+        self.end = 0
+
+    #==
+    #| writableView()
+    #|
+    #| Description:
+    #| (1) Returns a memoryview of the free space at the end of the buffer, to be passed to recv_into().
+    #| (2) Makes room first if there is no free space left: moves the unread bytes to the start of the buffer, or
+    #|     allocates a larger buffer when the frame being received does not fit.
+    #|
+    #==
+    def writableView(self):
+
+        if self.end == len(self.buffer):
+            unread = self.end - self.start
+            needed = max(unread + 1, self.pendingFrameSize())
+
+            if needed > len(self.buffer) or self.start == 0:
+                self.resize(max(needed, len(self.buffer) * 2))
+            else:
+                self.buffer[0:unread] = self.buffer[self.start:self.end]
+                self.start = 0
+                self.end = unread
+
+        return self.view[self.end:]
+
+    #==
+    #| commit()
+    #|
+    #| Description:
+    #| Records that nbytes were written into the view returned by writableView().
+    #|
+    #==
+    def commit(self, nbytes):
+
+        self.end += nbytes
+
+    #==
+    #| feed()
+    #|
+    #| Description:
+    #| Copies data (bytes) into the buffer, for callers that do not receive into writableView() directly.
+    #|
+    #==
+    def feed(self, data):
+
+        data = memoryview(data)
+        while data:
+            view = self.writableView()
+            count = min(len(view), len(data))
+            view[:count] = data[:count]
+            self.commit(count)
+            data = data[count:]
+
+    #==
+    #| frames()
+    #|
+    #| Description:
+    #| Yields (type, payload) for every complete frame in the buffer.
+    #|
+    #| Notes:
+    #| Raises protocolError if a frame is larger than maxPayload.
+    #|
+    #==
+    def frames(self):
+
+        while self.end - self.start >= HEADER.size:
+            length, msgType = HEADER.unpack_from(self.buffer, self.start)
+
+            if length > self.maxPayload:
+                raise protocolError(f"frame of {length} bytes is larger than {self.maxPayload}")
+
+            payloadStart = self.start + HEADER.size
+            if self.end - payloadStart < length:
+                break
+
+            self.start = payloadStart + length
+            yield msgType, self.view[payloadStart:self.start]
+
+        # Everything was decoded, so the next recv can start at the beginning of the buffer again.
+        if self.start == self.end:
+            self.start = 0
+            self.end = 0
+            if len(self.buffer) > self.bufferSize:
+                self.resize(self.bufferSize)
+
+    #==
+    #| unread()
+    #|
+    #| Description:
+    #| Puts back the last frame yielded by frames() (size bytes, header included), so it is yielded again by the next
+    #|   call (e.g. a frame the server is not ready to handle yet).
+    #|
+    #| Notes:
+    #| The caller has to stop iterating frames() right after.
+    #|
+    #==
+    def unread(self, size):
+
+        self.start -= size
+
+    #==
+    #| pendingFrameSize()
+    #|
+    #| Description:
+    #| Returns the size (header + payload) of the partial frame at the start of the unread bytes, or 0 if its header
+    #|   has not arrived yet.
+    #|
+    #==
+    def pendingFrameSize(self):
+
+        if self.end - self.start < HEADER.size:
+            return 0
+
+        length, msgType = HEADER.unpack_from(self.buffer, self.start)
+        if length > self.maxPayload:
+            raise protocolError(f"frame of {length} bytes is larger than {self.maxPayload}")
+
+        return HEADER.size + length
+
+    #==
+    #| resize()
+    #|
+    #| Description:
+    #| Replaces the buffer with a new one of size bytes that holds the unread bytes at its start.
+    #|
+    #| Notes:
+    #| A new bytearray is allocated instead of resizing the old one because payload memoryviews may still
+    #|   reference it (a bytearray cannot be resized while it is exported).
+    #|
+    #==
+    def resize(self, size):
+
+        unread = self.end - self.start
+        buffer = bytearray(size)
+        buffer[0:unread] = self.buffer[self.start:self.end]
+
+        self.buffer = buffer
+        self.view = memoryview(buffer)
+        self.start = 0
+        self.end = unread
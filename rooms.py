@@ -0,0 +1,80 @@
+# Student name: Michael Hrenko
+# Student OSU ID: 934396070
+# Course: CS 372
+# Programming Project: Client-Server Chat
+
+#==
+#| roomRegistry
+#|
+#| Description:
+#| Keeps track of which connections are in which chat room.
+#|
+#| My approach:
+#| (1) members maps a room name to the set of connections in that room, so sending to a room only touches that
+#|     room's members instead of every connected client.
+#| (2) Each connection also keeps the set of rooms it joined (connection.rooms), so leaving every room on
+#|     disconnect only visits those rooms.
+#| (3) A room is removed from members as soon as its last member leaves, so empty rooms use no memory.
+#|
+#==
+class roomRegistry:
+
+    #==
+    #| __init__()
+    #|
+    #==
+    def __init__(self):
+
+        self.members = {}
+
+    #==
+    #| join()
+    #|
+    #| Description:
+    #| Adds the connection to the room. Returns False if it was already a member.
+    #|
+    #==
+    def join(self, connection, room):
+
+        members = self.members.get(room)
+        if members is None:
+            members = self.members[room] = set()
+        elif connection in members:
+            return False
+
+        members.add(connection)
+        connection.rooms.add(room)
+        return True
+
+    #==
+    #| leave()
+    #|
+    #| Description:
+    #| Removes the connection from the room. Returns False if it was not a member.
+    #|
+    #==
+    def leave(self, connection, room):
+
+        members = self.members.get(room)
+        if members is None or connection not in members:
+            return False
+
+        members.discard(connection)
+        connection.rooms.discard(room)
+        if not members:
+            del self.members[room]
+        return True
+
+    #==
+    #| membersOf()
+    #|
+    #| Description:
+    #| Returns the set of connections in the room (empty if the room does not exist).
+    #|
+    #| Notes:
+    #| The set is the registry's own, so callers must not change it.
+    #|
+    #==
+    def membersOf(self, room):
+
+        return self.members.get(room, ())
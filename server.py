@@ -1,203 +1,1684 @@
-# Student name: Michael Hrenko
-# Student OSU ID: 934396070
-# Course: CS 372
-# Programming Project: Client-Server Chat
-
-# #################################################################################################################### #
-# Sources                                                                                                              #
-#                                                                                                                      #
-# #################################################################################################################### #
-
-# "Computer Networking: A Top-down Approach", 7th edition by James Kurose and Keith Ross, Section 2.71 - "TCPServer.py"
-# "socket — Low-level networking interface", python.org, https://docs.python.org/3/library/socket.html
-# "threading — Thread-based parallelism", python.org, https://docs.python.org/3/library/threading.html
-# "An Intro to Threading in Python", Jim Anderson, Real Python, https://realpython.com/intro-to-python-threading/
-
-# #################################################################################################################### #
-# Import packages                                                                                                      #
-#                                                                                                                      #
-# #################################################################################################################### #
-
-# Socket is the python package that provides a "Low-level networking interface" (see source above)
-from socket import *
-
-# Threading is the python package that provides parallelism "Low-level networking interface" (see source above)
-import threading
-
-# #################################################################################################################### #
-# serverChat                                                                                                           #
-#                                                                                                                      #
-# Description:                                                                                                         #
-# Runs the server side of the chat with the client.                                                                    #
-#                                                                                                                      #
-# My approach:                                                                                                         #
-# (1) Initialize (a) the bind for the server, (b) listening for a connection from the client, (c) a send               #
-#     message thread.                                                                                                  #
-#   -  Threading is used because we need the ability to send and receive multiple messages. To accommodate this,       #
-#      each send and receive function needs to remain open at the same time. This can best be done using               #
-#      parallelism.                                                                                                    #
-# (2) Call receive message in the main function.                                                                       #
-#   - Both the send and receive functions are while loops that continue to run while the client and server             #
-#     connections are open.                                                                                            #
-# (3) The program ends when the server enters '/q' (stopping the thread), or the client quits and the receive          #
-#       message detects this.                                                                                          #                                                                                                       #
-#   - Neither the client nor the server send a quit message.                                                           #
-#                                                                                                                      #
-# #################################################################################################################### #
-
-class serverChat:
-
-    # ################################################################################################################ #
-    # __init__()                                                                                                       #
-    #                                                                                                                  #
-    # ################################################################################################################ #
-    def __init__(self):
-
-        self.host = 'localhost'
-        self.port = 15777
-        self.clientSocket = None
-        self.clientAddress = None
-        self.serverSocket = None
-        self.threadSend = None
-        self.connected = False
-        self.clientMessageCount = 0
-
-    # ################################################################################################################ #
-    # sendMessage()                                                                                                    #
-    #                                                                                                                  #
-    # Description:                                                                                                     #
-    # (1) Receives a message input by the server.                                                                      #
-    # (2) If the message is 'q', calls closeChat() to stop the thread.                                                 #
-    # (3) Else tries to send the message to the client. If the client closed the connection, sets                      #
-    #   self.connected to False to indicate that receiveMessage() should also stop.                                    #
-    #                                                                                                                  #
-    # Notes:                                                                                                           #
-    # Remains active while client and server are still connected.                                                      #
-    #                                                                                                                  #
-    # ################################################################################################################ #
-    def sendMessage(self):
-
-        while self.connected:
-
-            # Get the message from the user.
-            serverMessage = (input()).strip()
-
-            # '/q' quits the program by calling closeChat() and setting self.connected to False 
-            #   so receiveMessage() also stops.
-            if serverMessage == "/q":
-                self.connected = False
-                self.closeChat()
-            else:
-                # Use a try function b/c the client may have closed the connection.
-                # If that occurs call closeChat() and set self.connected to False so 
-                #   receiveMessage() also stops. 
-                try:
-                    self.clientSocket.send(serverMessage.encode('utf-8'))           
-                except:
-                    self.connected = False
-                    self.closeChat()
-
-    # ################################################################################################################ #
-    # receiveMessage()                                                                                                 #
-    #                                                                                                                  #
-    # Description:                                                                                                     #
-    # Receives and prints messages from the client.                                                                    #
-    #                                                                                                                  #  
-    # Notes:                                                                                                           #
-    # Remains active while client and server are still connected.                                                      #
-    #                                                                                                                  #
-    # ################################################################################################################ #
-    def receiveMessage(self):
-        while self.connected:
-
-            # Use a try function b/c the client may have closed the connection before this was able to run.
-            #  If that happens, break the loop. 
-            try:
-                # Receive data from the client socket as a bytes object.
-                # 1024 is the size of the buffer
-                clientMessage = self.clientSocket.recv(1024).decode('utf-8')
-                print(f"Client: {clientMessage}")
-
-                # This counter is used so receiveMessage can print an intro message (only once) to 
-                #   the server user after the first message is received from the client. 
-                self.clientMessageCount += 1
-
-                # Print this on the first instance of the client sending a message. 
-                if self.clientMessageCount == 1:
-                    print("Enter a message or /q to quit")
-                    
-            except:
-                self.connected = False
-                break
-
-    # ################################################################################################################ #
-    # connect()                                                                                                        #
-    #                                                                                                                  #
-    # Description:                                                                                                     #
-    # (1) Bind the server to the host/port and listens for a connection from the client.                               #
-    # (2) Connects to the client socket.                                                                               #
-    # (2) Initializes and starts threading for the sendMessage function.                                               #
-    #                                                                                                                  #
-    # Notes:                                                                                                           #
-    # Threading is used because we need the ability to send and receive multiple messages. To accommodate  this,       #
-    #   each send and receive function needs to remain open at the same time. This can best be done using              #
-    #   parallelism.                                                                                                   #
-    #                                                                                                                  #
-    # ################################################################################################################ #
-    def connect(self):
-
-        try:
-
-            # Create the socket for the client.
-            # AF_INET: underlying network is using IPv4.
-            # SOCK_STREAM: use the TCP socket. 
-            # Use TCP because we're sending/receiving data which needs to be accurate. 
-            self.serverSocket = socket(AF_INET, SOCK_STREAM)
-
-            # Set a socket reuse option before binding the server.
-            self.serverSocket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
-
-            # Bind/set the socket to the address and port above.
-            self.serverSocket.bind((self.host, self.port))
-
-            # Initialize server to start listening for connection requests from the client. 
-            # 1 sets the maximum number of queued connections.
-            self.serverSocket.listen(1)
-            print(f"\nServer listening on {self.host} port {self.port}")
-
-            # When the client sends the request, the server will create a new socket for it. 
-            # Then the client and server will complete the three-way handshake.
-            self.clientSocket, self.clientAddress = self.serverSocket.accept()
-            print(f"Connected to {self.clientAddress[0]} on port {self.clientAddress[1]}")
-            print("Waiting for message...")
-
-            self.connected = True
-
-            # Initialize and start threading the sendMessage function.
-            self.threadSend = threading.Thread(target=self.sendMessage, daemon=True)
-            self.threadSend.start()
-
-        except:
-           print("Cannot bind server") 
-
-    # ################################################################################################################ #
-    # closeChat()                                                                                                      #
-    #                                                                                                                  #
-    # Description:                                                                                                     #
-    # (1) Closes the client socket.                                                                                    #
-    # (2) Closes the server socket.                                                                                    #
-    #                                                                                                                  #
-    # ################################################################################################################ #
-    def closeChat(self):
-        self.clientSocket.close()
-        self.serverSocket.close()
-
-# #################################################################################################################### #
-# Run program                                                                                                          #
-#                                                                                                                      #
-# #################################################################################################################### #
-if __name__ == '__main__':
-
-    chat = serverChat()
-    chat.connect()
-    chat.receiveMessage()
+# Student name: Michael Hrenko
+# Student OSU ID: 934396070
+# Course: CS 372
+# Programming Project: Client-Server Chat
+
+#==
+#| Sources
+#|
+#==
+
+# "Computer Networking: A Top-down Approach", 7th edition by James Kurose and Keith Ross, Section 2.71 - "TCPServer.py"
+# "socket — Low-level networking interface", python.org, https://docs.python.org/3/library/socket.html
+# "threading — Thread-based parallelism", python.org, https://docs.python.org/3/library/threading.html
+# "An Intro to Threading in Python", Jim Anderson, Real Python, https://realpython.com/intro-to-python-threading/
+# "asyncio — Asynchronous I/O", python.org, https://docs.python.org/3/library/asyncio.html
+# "Transports and Protocols", python.org, https://docs.python.org/3/library/asyncio-protocol.html
+
+#==
+#| Import packages
+#|
+#==
+
+# Socket is the python package that provides a "Low-level networking interface" (see source above)
+from socket import *
+
+# Threading is the python package that provides parallelism "Low-level networking interface" (see source above)
+import threading
+
+# Protocol holds the length-prefixed frame format shared by the client and the server
+from protocol import (BUS_CHAT, BUS_DELIVER, BUS_PUBLISH, BUS_REPLAY, BUS_SUBSCRIBE, BUS_UNSUBSCRIBE, HEADER,
+                      MSG_CHAT, MSG_HELLO, MSG_JOIN, MSG_LEAVE, MSG_PING, MSG_PONG, MSG_RECONNECT, MSG_ROOM,
+                      decodeJoin, decodeRoomHeader, decodeRoomMessage, decodeRoomName, encodeFrame, encodeReconnect,
+                      encodeRoomMessage, encodeRoomName, frameDecoder, protocolError)
+
+# Outbound queues the frames to send so partial sends never lose data and pending frames go out together
+from outbound import HIGH_WATER, LOW_WATER, MAX_QUEUED, outboundQueue, queuedSender, slowConsumerError
+
+# Timers holds the timer wheel that drives the heartbeats and timeouts of the async mode
+from timers import timerWheel
+
+# Compression compresses large payloads once a client asked for it in its MSG_HELLO
+from compression import COMPRESS_THRESHOLD, compressionOptions, compressionStats, decompressFrame, loadDictionary
+
+# Limits holds the token buckets that throttle clients sending too fast
+from limits import BURST_SECONDS, BYTE_RATE, MESSAGE_RATE, THROTTLE_LIMIT, rateLimits
+
+# Tls encrypts the async mode's connections, with the handshakes on a thread pool (see tls.py)
+from tls import HANDSHAKE_THREADS, handshakePool, serverContext, ssl, tlsProtocol, tlsStats
+
+# Handoff drains the clients on shutdown and passes the listening socket to a new server on a hot restart
+from handoff import (DRAIN_TIMEOUT, HANDOFF_READY, RECONNECT_WINDOW, handOff, inheritSockets, listenHandoff)
+
+# Asyncio runs the event loop used by the multi-client server mode (see source above)
+import asyncio
+
+# Argparse reads the command line options (host, port and server mode)
+import argparse
+
+# Sys gives the event loop access to the server user's console input (stdin)
+import sys
+
+# Rooms keeps track of which clients are in which chat room (async mode)
+from rooms import roomRegistry
+
+# History keeps the recent messages of each room in memory and (optionally) in an append-only log on disk
+from history import REPLAY_BYTES, REPLAY_COUNT, messageLog, roomHistory
+
+# Bus relays room messages between the worker processes of the prefork mode
+from bus import CONNECTION_ID, busHub, busLink, encodeSubscribe, watchConsole
+
+# Metrics counts what the server does and serves the counts to Prometheus (see serveMetrics())
+from metrics import SIZE_BUCKETS, metricsRegistry
+
+# Time measures how long receiving and sending take
+import time
+
+# Os forks the worker processes of the prefork mode (Unix only)
+import os
+
+# Itertools numbers the client connections
+import itertools
+
+# Signal stops the worker processes when the prefork server quits
+import signal
+
+# Traceback prints the error that stopped a worker process
+import traceback
+
+# Resource raises the open file limit so the async mode can hold thousands of client sockets (Unix only)
+try:
+    import resource
+except ImportError:
+    resource = None
+
+#==
+#| Metrics
+#|
+#| Description:
+#| Counters and histograms updated on the hot path. The gauges that read the server's state (e.g. connected
+#|   clients) are added by serveMetrics().
+#|
+#==
+
+metrics = metricsRegistry()
+connectionsTotal = metrics.counter('chat_connections_total', "Client connections accepted")
+messagesReceived = metrics.counter('chat_messages_received_total', "Frames received from clients")
+bytesReceived = metrics.counter('chat_bytes_received_total', "Bytes received from clients")
+messagesSent = metrics.counter('chat_messages_sent_total', "Frames queued for clients")
+bytesSent = metrics.counter('chat_bytes_sent_total', "Bytes written to clients")
+slowConsumers = metrics.counter('chat_slow_consumers_total', "Clients disconnected for not reading their messages")
+protocolErrors = metrics.counter('chat_protocol_errors_total', "Clients disconnected for breaking the protocol")
+connectionErrors = metrics.counter('chat_connection_errors_total', "Connections lost because of a socket error")
+receiveSeconds = metrics.histogram('chat_receive_seconds', "Time spent handling one read (decoding and fan-out)")
+sendSeconds = metrics.histogram('chat_send_seconds', "Time spent in one send call")
+sendBatchBytes = metrics.histogram('chat_send_batch_bytes', "Bytes written by one send call", SIZE_BUCKETS)
+pingsSent = metrics.counter('chat_pings_sent_total', "Heartbeats sent to idle clients")
+idleReaped = metrics.counter('chat_idle_reaped_total', "Clients disconnected for not answering heartbeats")
+handshakeTimeouts = metrics.counter('chat_handshake_timeouts_total',
+                                    "Clients disconnected for not sending a first message")
+throttledTotal = metrics.counter('chat_throttled_total', "Times a client's reads were paused for sending too fast")
+rateLimited = metrics.counter('chat_rate_limited_total', "Clients disconnected for being throttled too often")
+compressStats = compressionStats(metrics)
+tlsMetrics = tlsStats(metrics)
+
+#==
+#| serverChat
+#|
+#| Description:
+#| Runs the server side of the chat with the client.
+#|
+#| My approach:
+#| (1) Initialize (a) the bind for the server, (b) listening for a connection from the client, (c) a send
+#|     message thread.
+#|   -  Threading is used because we need the ability to send and receive multiple messages. To accommodate this,
+#|      each send and receive function needs to remain open at the same time. This can best be done using
+#|      parallelism.
+#| (2) Call receive message in the main function.
+#|   - Both the send and receive functions are while loops that continue to run while the client and server
+#|     connections are open.
+#| (3) The program ends when the server enters '/q' (stopping the thread), or the client quits and the receive
+#|     message detects this.
+#|   - Neither the client nor the server send a quit message.
+#|
+#| Async mode (--mode async):
+#| (1) runAsync() starts an asyncio event loop that accepts any number of clients on one thread.
+#|   - Each client is a chatConnection (see below), so no thread or task is created per connection.
+#| (2) Every message received from a client is broadcast to all of the other connected clients.
+#|   - Clients can also join named rooms. A room message only goes to the members of that room (see sendToRoom()).
+#|   - Room messages are numbered and kept in a ring buffer per room (and in a messageLog with --log-dir), so a
+#|     client that joins or reconnects is sent the messages it missed (see replay()).
+#| (3) The server user can still type messages (sent to every client) or '/q' to stop the server.
+#|
+#| Prefork mode (--mode async --workers N):
+#| (1) runPrefork() forks N worker processes. Each one runs runAsync() on its own event loop and binds the same
+#|     port with SO_REUSEPORT, so the kernel spreads the incoming connections over the workers (and CPU cores).
+#| (2) The parent process becomes the hub (see bus.py): it numbers and records the room messages and relays them
+#|     to the workers that have members in the room. Each worker talks to the hub over a Unix socket pair.
+#|
+#| TLS (--mode async --tls-cert FILE --tls-key FILE):
+#| (1) Every connection is wrapped in a tlsProtocol (see tls.py), which runs the handshake on a thread pool and then
+#|     hands the decrypted stream to its chatConnection.
+#| (2) The SSLContext is created before the workers are forked, so they share its session ticket keys: a client
+#|     resumes its session on whichever worker the kernel gives its reconnection to.
+#|
+#| Shutdown (see stop() and drain()):
+#| (1) '/q' or SIGTERM stops accepting, sends every client a MSG_RECONNECT and waits for them to answer, so queued
+#|     messages are delivered and the clients reconnect spread over reconnectWindow seconds.
+#| (2) With --handoff a new server inherits the listening socket of the running one (see handoff.py): the old server
+#|     only stops accepting once the new one serves the socket, so no connection is refused during a restart.
+#|
+#==
+
+class serverChat:
+
+    #==
+    #| __init__()
+    #|
+    #==
+    def __init__(self):
+
+        self.host = 'localhost'
+        self.port = 15777
+        self.clientSocket = None
+        self.clientAddress = None
+        self.serverSocket = None
+        self.threadSend = None
+        self.connected = False
+        self.clientMessageCount = 0
+        self.decoder = frameDecoder()
+        self.sender = None
+
+        # quiet stops printing every client message (e.g. while benchmarking).
+        self.quiet = False
+
+        # compression holds what the server accepts in a client's MSG_HELLO (see compression.py).
+        # compressor is the threaded mode client's messageCompressor, None until compression was agreed on.
+        self.compression = compressionOptions()
+        self.compressor = None
+
+        # Heartbeats and timeouts in seconds (0 turns each one off).
+        # heartbeat: a client that sent nothing for this long is sent a MSG_PING.
+        # idleTimeout: a client that sent nothing (not even a MSG_PONG) for this long is disconnected.
+        # handshakeTimeout: a client must send its first message (normally MSG_HELLO) within this time (async mode).
+        # timers is the timerWheel of the async mode, lastRead and pinged track the threaded mode's client.
+        self.heartbeat = 30.0
+        self.idleTimeout = 90.0
+        self.handshakeTimeout = 10.0
+        self.timers = None
+        self.lastRead = 0
+        self.pinged = False
+
+        # Rate limits (see limits.py).
+        # limits applies to every client, roomLimits to every room (async mode, off unless set). limiter is the
+        #   threaded mode client's rateLimiter and roomLimiters holds the rateLimiter of each room.
+        # throttleLimit: a client throttled more than this many separate times a minute is disconnected.
+        self.limits = rateLimits(MESSAGE_RATE, BYTE_RATE)
+        self.roomLimits = rateLimits()
+        self.limiter = None
+        self.roomLimiters = {}
+        self.throttleLimit = THROTTLE_LIMIT
+
+        # Async mode only.
+        # backlog is the maximum number of queued connections (see listen() in connect()).
+        # clients maps the id of every connected client to its chatConnection.
+        self.backlog = 4096
+        self.clients = {}
+        self.connectionIds = itertools.count(1)
+        self.rooms = roomRegistry()
+        self.loop = None
+
+        # Room history (async mode only).
+        # histories holds a roomHistory ring buffer per room and sequences the last sequence number of each room.
+        # replayCount is how many of the latest messages a client gets when it joins a room.
+        # log is the messageLog on disk, None to keep the history in memory only.
+        self.histories = {}
+        self.sequences = {}
+        self.historyCount = 100
+        self.historyBytes = 256 * 1024
+        self.replayCount = 50
+        self.log = None
+        self.logFlushScheduled = False
+
+        # Prefork mode only.
+        # workerId is the number of this worker process, busSocket its end of the socket pair to the hub and bus
+        #   the busLink on top of it. bus is None in the single process mode.
+        self.workerId = None
+        self.busSocket = None
+        self.bus = None
+
+        # TLS (async mode only).
+        # tlsContext is the server's SSLContext, None without TLS. tlsPool runs the handshakes on tlsThreads threads.
+        self.tlsContext = None
+        self.tlsPool = None
+        self.tlsThreads = HANDSHAKE_THREADS
+
+        # Shutdown and hot restart (see stop(), drain() and handoff.py).
+        # drainTimeout: seconds the clients get to answer MSG_RECONNECT before their connections are closed anyway.
+        # reconnectWindow: seconds over which the clients spread their reconnections.
+        # handoffPath is the Unix socket a new server connects to for a hot restart (async mode), handoffSocket listens
+        #   on it. servers holds the asyncio servers accepting the clients (one per inherited listening socket).
+        # stopping is the asyncio.Event runAsync() waits on until stop() is called. draining is set once the server
+        #   stopped accepting, drained is resolved when its last client is gone and handedOff once a new server took
+        #   the listening socket over. closed is set when the threaded mode's client is gone.
+        self.drainTimeout = DRAIN_TIMEOUT
+        self.reconnectWindow = RECONNECT_WINDOW
+        self.handoffPath = None
+        self.handoffSocket = None
+        self.servers = []
+        self.stopping = None
+        self.draining = False
+        self.drained = None
+        self.handedOff = False
+        self.closed = threading.Event()
+        self.console = b''
+
+        # Metrics (see serveMetrics()).
+        self.metricsHost = 'localhost'
+        self.metricsPort = 0
+        self.metricsInterval = 0
+
+    #==
+    #| sendMessage()
+    #|
+    #| Description:
+    #| (1) Receives a message input by the server.
+    #| (2) If the message is '/q', calls drainClient() to stop the thread.
+    #| (3) Else tries to send the message to the client. If the client closed the connection, sets
+    #|   self.connected to False to indicate that receiveMessage() should also stop.
+    #|
+    #| Notes:
+    #| Remains active while client and server are still connected.
+    #|
+    #==
+    def sendMessage(self):
+
+        while self.connected:
+
+            # Get the message from the user. None: the console was closed.
+            serverMessage = self.readLine()
+            if serverMessage is None:
+                return
+            serverMessage = serverMessage.strip()
+
+            # '/q' asks the client to reconnect later and waits for it to go (see drainClient()), so
+            #   receiveMessage() also stops.
+            if serverMessage == "/q":
+                self.drainClient()
+                return
+            else:
+                # Use a try function b/c the client may have closed the connection.
+                # If that occurs call closeChat() and set self.connected to False so 
+                #   receiveMessage() also stops. 
+                try:
+                    frame = encodeFrame(MSG_CHAT, serverMessage.encode('utf-8'))
+                    if self.compressor is not None:
+                        frame = self.compressor.compressFrame(frame)
+                    start = time.perf_counter()
+                    self.sender.send(frame)
+                    sendSeconds.observe(time.perf_counter() - start)
+                    sendBatchBytes.observe(len(frame))
+                    messagesSent.inc()
+                    bytesSent.inc(len(frame))
+                except slowConsumerError:
+                    slowConsumers.inc()
+                    print("Disconnecting slow client")
+                    self.connected = False
+                    self.closeChat()
+                except OSError:
+                    connectionErrors.inc()
+                    self.connected = False
+                    self.closeChat()
+
+    #==
+    #| readLine()
+    #|
+    #| Description:
+    #| Returns the next line typed by the server user, or None once the console is closed (threaded mode).
+    #|
+    #| Notes:
+    #| Reads the file descriptor with os.read() instead of input(): a daemon thread still blocked in input() when the
+    #|   program exits holds the lock of sys.stdin, which makes the interpreter abort at shutdown.
+    #|
+    #==
+    def readLine(self):
+
+        while b'\n' not in self.console:
+            try:
+                data = os.read(sys.stdin.fileno(), 4096)
+            except OSError:
+                return None
+            if not data:
+                return None
+            self.console += data
+
+        line, self.console = self.console.split(b'\n', 1)
+        return str(line, 'utf-8', 'replace')
+
+    #==
+    #| drainClient()
+    #|
+    #| Description:
+    #| Sends the client a MSG_RECONNECT and waits up to self.drainTimeout seconds for its answer (threaded mode), then
+    #|   closes the connection.
+    #|
+    #==
+    def drainClient(self):
+
+        try:
+            self.sender.send(encodeFrame(MSG_RECONNECT, encodeReconnect(self.reconnectWindow)))
+        except OSError:
+            pass
+
+        # receiveMessage() stops once the client answered and the main thread sets closed. closeChat() wakes it up if
+        #   the client did not answer in time.
+        if not self.closed.wait(self.drainTimeout):
+            self.connected = False
+            self.closeChat()
+
+    #==
+    #| receiveMessage()
+    #|
+    #| Description:
+    #| Receives and prints messages from the client.
+    #|
+    #| Notes:
+    #| Remains active while client and server are still connected.
+    #|
+    #==
+    def receiveMessage(self):
+        while self.connected:
+
+            # Use a try function b/c the client may have closed the connection before this was able to run.
+            #  If that happens, break the loop. 
+            try:
+                # Receive data from the client socket straight into the decoder's buffer.
+                # recv_into() returns 0 once the client has closed the connection.
+                nbytes = self.clientSocket.recv_into(self.decoder.writableView())
+                if nbytes == 0:
+                    self.connected = False
+                    break
+                self.decoder.commit(nbytes)
+                bytesReceived.inc(nbytes)
+                self.lastRead = time.monotonic()
+                self.pinged = False
+                start = time.perf_counter()
+                slept = 0.0
+
+                # One recv may hold part of a message or several messages, so print every complete frame.
+                for msgType, payload in self.decoder.frames():
+                    # closeChat() was called meanwhile (e.g. '/q' while the client is throttled).
+                    if not self.connected:
+                        break
+
+                    # A client over its rate limit is not read from until it is within its limit again (the kernel
+                    #   then makes it wait too, once the socket buffers are full). The frame is taken, and decoded,
+                    #   only then.
+                    size = HEADER.size + len(payload)
+                    delay = self.limiter.take(size, time.monotonic()) if self.limiter else 0
+                    if delay:
+                        if self.limiter.throttle(delay, time.monotonic(), self.throttleLimit):
+                            rateLimited.inc()
+                            if not self.quiet:
+                                print("Disconnecting client: sending too fast")
+                            self.connected = False
+                            break
+                        throttledTotal.inc()
+                        while delay:
+                            time.sleep(delay)
+                            slept += delay
+                            delay = self.limiter.take(size, time.monotonic())
+                    messagesReceived.inc()
+
+                    msgType, payload = decompressFrame(self.compressor, msgType, payload)
+
+                    if msgType == MSG_CHAT:
+                        clientMessage = str(payload, 'utf-8', 'replace')
+                    elif msgType == MSG_ROOM:
+                        seq, room, sender, text = decodeRoomMessage(payload)
+                        clientMessage = f"[{room}] {text}"
+                    elif msgType == MSG_HELLO:
+                        # The answer goes out before the first compressed frame, so compressor is set after it.
+                        reply, compressor = self.compression.accept(payload, compressStats)
+                        self.sender.send(reply)
+                        self.compressor = compressor
+                        continue
+                    elif msgType == MSG_PING:
+                        self.sender.send(encodeFrame(MSG_PONG, payload))
+                        continue
+                    elif msgType == MSG_RECONNECT:
+                        # The client's answer to drainClient(): it sends nothing more.
+                        self.connected = False
+                        break
+                    else:
+                        continue
+
+                    if not self.quiet:
+                        print(f"Client: {clientMessage}")
+
+                    # This counter is used so receiveMessage can print an intro message (only once) to 
+                    #   the server user after the first message is received from the client. 
+                    self.clientMessageCount += 1
+
+                    # Print this on the first instance of the client sending a message. 
+                    if self.clientMessageCount == 1:
+                        print("Enter a message or /q to quit")
+
+                # The pauses of a throttled client are not part of the time spent handling the read.
+                receiveSeconds.observe(time.perf_counter() - start - slept)
+                    
+            # timeout: nothing was received for self.heartbeat seconds (see checkIdle()).
+            # slowConsumerError: a reply could not be queued because the client stopped reading.
+            # OSError: the connection was closed or reset. protocolError: the client sent a malformed frame.
+            except timeout:
+                if not self.checkIdle():
+                    self.connected = False
+                    break
+            except slowConsumerError:
+                slowConsumers.inc()
+                print("Disconnecting slow client")
+                self.connected = False
+                break
+            except OSError:
+                connectionErrors.inc()
+                self.connected = False
+                break
+            except protocolError as error:
+                protocolErrors.inc()
+                print(f"Disconnecting client: {error}")
+                self.connected = False
+                break
+
+    #==
+    #| checkIdle()
+    #|
+    #| Description:
+    #| Called by receiveMessage() when the client sent nothing for self.heartbeat seconds (threaded mode):
+    #| (1) Returns False if the client sent nothing for self.idleTimeout seconds, so it is disconnected.
+    #| (2) Else sends it a MSG_PING (once per silence), which a live client answers with a MSG_PONG.
+    #| (3) Returns False if the MSG_PING cannot be sent (the connection failed or the client stopped reading).
+    #|
+    #| Notes:
+    #| The threaded mode has one client, so a socket timeout is enough here. The async mode uses a timerWheel (see
+    #|   chatConnection.timerExpired()).
+    #|
+    #==
+    def checkIdle(self):
+
+        idle = time.monotonic() - self.lastRead
+        if self.idleTimeout and idle >= self.idleTimeout:
+            idleReaped.inc()
+            print(f"Disconnecting client: nothing received for {idle:.0f}s")
+            return False
+
+        # The socket's timeout also applies to sends, so a client that stopped reading makes this fail too.
+        if not self.pinged:
+            try:
+                self.sender.send(encodeFrame(MSG_PING, b''))
+            except slowConsumerError:
+                slowConsumers.inc()
+                return False
+            except OSError:
+                connectionErrors.inc()
+                return False
+            pingsSent.inc()
+            self.pinged = True
+        return True
+
+    #==
+    #| connect()
+    #|
+    #| Description:
+    #| (1) Bind the server to the host/port and listens for a connection from the client.
+    #| (2) Connects to the client socket.
+    #| (2) Initializes and starts threading for the sendMessage function.
+    #|
+    #| Notes:
+    #| Threading is used because we need the ability to send and receive multiple messages. To accommodate  this,
+    #|   each send and receive function needs to remain open at the same time. This can best be done using
+    #|   parallelism.
+    #|
+    #==
+    def connect(self):
+
+        try:
+
+            # Create the socket for the client.
+            # AF_INET: underlying network is using IPv4.
+            # SOCK_STREAM: use the TCP socket. 
+            # Use TCP because we're sending/receiving data which needs to be accurate. 
+            self.serverSocket = socket(AF_INET, SOCK_STREAM)
+
+            # Set a socket reuse option before binding the server.
+            self.serverSocket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+
+            # Bind/set the socket to the address and port above.
+            self.serverSocket.bind((self.host, self.port))
+
+            # Initialize server to start listening for connection requests from the client. 
+            # 1 sets the maximum number of queued connections.
+            self.serverSocket.listen(1)
+            print(f"\nServer listening on {self.host} port {self.port}")
+
+            # The metrics can be scraped while the server waits for its client.
+            self.serveMetrics()
+
+            # When the client sends the request, the server will create a new socket for it. 
+            # Then the client and server will complete the three-way handshake.
+            self.clientSocket, self.clientAddress = self.serverSocket.accept()
+            print(f"Connected to {self.clientAddress[0]} on port {self.clientAddress[1]}")
+            print("Waiting for message...")
+            connectionsTotal.inc()
+
+            self.connected = True
+            self.sender = queuedSender(self.clientSocket)
+            self.limiter = self.limits.limiter(time.monotonic())
+
+            # recv_into() times out after heartbeat seconds of silence, so receiveMessage() can call checkIdle().
+            self.lastRead = time.monotonic()
+            self.pinged = False
+            if self.heartbeat:
+                self.clientSocket.settimeout(self.heartbeat)
+
+            # Initialize and start threading the sendMessage function.
+            self.threadSend = threading.Thread(target=self.sendMessage, daemon=True)
+            self.threadSend.start()
+
+        except:
+           print("Cannot bind server") 
+
+    #==
+    #| closeChat()
+    #|
+    #| Description:
+    #| (1) Shuts down and closes the client socket.
+    #| (2) Closes the server socket.
+    #|
+    #| Notes:
+    #| shutdown() wakes up receiveMessage() if it is blocked in recv_into() (close() alone does not). closeChat() may
+    #|   be called by both threads, so the errors of a socket that is already closed are ignored.
+    #|
+    #==
+    def closeChat(self):
+
+        if self.clientSocket is not None:
+            try:
+                self.clientSocket.shutdown(SHUT_RDWR)
+            except OSError:
+                pass
+            self.clientSocket.close()
+
+        if self.serverSocket is not None:
+            self.serverSocket.close()
+
+    #==
+    #| broadcast()
+    #|
+    #| Description:
+    #| Queues data (a frame) for every connected client except the sender (async mode).
+    #|
+    #| Notes:
+    #| sender is None when the message was typed by the server user.
+    #| In the prefork mode a message from one of this worker's clients is also sent to the hub, which relays it to
+    #|   the other workers.
+    #|
+    #==
+    def broadcast(self, sender, data):
+
+        for client in self.clients.values():
+            if client is not sender:
+                client.send(data)
+
+        if self.bus is not None and sender is not None:
+            self.bus.send(encodeFrame(BUS_CHAT, data))
+
+    #==
+    #| sendToRoom()
+    #|
+    #| Description:
+    #| (1) Numbers and encodes a room message once, and records it in the room's history.
+    #| (2) Queues that same frame for every member of the room except the sender (async mode).
+    #|
+    #| Notes:
+    #| Only the room's members are visited, so the cost does not depend on how many clients are connected.
+    #| In the prefork mode the message is sent to the hub instead, which numbers it and sends it back (BUS_DELIVER)
+    #|   to every worker with members in the room.
+    #|
+    #==
+    def sendToRoom(self, sender, room, text):
+
+        if self.bus is not None:
+            self.bus.send(encodeFrame(BUS_PUBLISH, encodeRoomMessage(room, sender.name, text)))
+            return
+
+        if not self.rooms.membersOf(room):
+            return
+
+        seq = self.nextSeq(room)
+        payload = encodeRoomMessage(room, sender.name, text, seq)
+        frame = encodeFrame(MSG_ROOM, payload)
+        self.recordHistory(room, seq, payload, frame)
+        self.deliverToRoom(room, sender.name, frame)
+
+    #==
+    #| deliverToRoom()
+    #|
+    #| Description:
+    #| Queues a MSG_ROOM frame for every member of the room except the one that sent it.
+    #|
+    #==
+    def deliverToRoom(self, room, senderName, frame):
+
+        for member in self.rooms.membersOf(room):
+            if member.name != senderName:
+                member.send(frame)
+
+    #==
+    #| joinRoom()
+    #|
+    #| Description:
+    #| Adds a client to a room and replays the messages it asked for (see replay()).
+    #|
+    #| Notes:
+    #| In the prefork mode the hub keeps the history, so the worker subscribes to the room at the hub and the hub
+    #|   replays the history to the client (BUS_REPLAY).
+    #|
+    #==
+    def joinRoom(self, connection, room, since):
+
+        if not self.rooms.join(connection, room):
+            return
+
+        if self.bus is not None:
+            self.bus.send(encodeFrame(BUS_SUBSCRIBE, encodeSubscribe(connection.connId, since, room)))
+        else:
+            self.replay(connection, room, since)
+
+    #==
+    #| leaveRoom()
+    #|
+    #| Description:
+    #| Removes a client from a room. In the prefork mode the worker unsubscribes from the room at the hub once none
+    #|   of its clients are left in it.
+    #|
+    #==
+    def leaveRoom(self, connection, room):
+
+        if not self.rooms.leave(connection, room) or self.rooms.membersOf(room):
+            return
+
+        self.roomLimiters.pop(room, None)
+        if self.bus is not None:
+            self.bus.send(encodeFrame(BUS_UNSUBSCRIBE, encodeRoomName(room)))
+
+    #==
+    #| roomDelay()
+    #|
+    #| Description:
+    #| Takes a message of size bytes from the room's rateLimiter. Returns 0, or the number of seconds the sender
+    #|   should be paused because the room is over its limit (nothing is taken then, see rateLimiter.take()).
+    #|
+    #| Notes:
+    #| In the prefork mode each worker limits the messages of its own clients, so a room can get up to workers times
+    #|   the limit.
+    #|
+    #==
+    def roomDelay(self, room, size, now):
+
+        limiter = self.roomLimiters.get(room)
+        if limiter is None:
+            limiter = self.roomLimits.limiter(now)
+            if limiter is None:
+                return 0.0
+            self.roomLimiters[room] = limiter
+
+        return limiter.take(size, now)
+
+    #==
+    #| nextSeq()
+    #|
+    #| Description:
+    #| Returns the next sequence number of a room (1, 2, 3, ...).
+    #|
+    #| Notes:
+    #| With a messageLog the numbering continues from the last logged message, so it survives a restart.
+    #|
+    #==
+    def nextSeq(self, room):
+
+        seq = self.lastSeq(room) + 1
+        self.sequences[room] = seq
+        return seq
+
+    #==
+    #| lastSeq()
+    #|
+    #| Description:
+    #| Returns the sequence number of the last message sent to a room (0 if there is none).
+    #|
+    #==
+    def lastSeq(self, room):
+
+        seq = self.sequences.get(room)
+        if seq is None:
+            seq = self.sequences[room] = self.log.lastSeq(room) if self.log is not None else 0
+
+        return seq
+
+    #==
+    #| recordHistory()
+    #|
+    #| Description:
+    #| (1) Adds a room message to the room's ring buffer.
+    #| (2) Appends it to the messageLog (if any) and schedules one log flush for the end of the event loop iteration.
+    #|
+    #==
+    def recordHistory(self, room, seq, payload, frame):
+
+        history = self.histories.get(room)
+        if history is None:
+            history = self.histories[room] = roomHistory(self.historyCount, self.historyBytes)
+        history.append(seq, frame)
+
+        if self.log is not None:
+            self.log.append(room, seq, payload)
+            if not self.logFlushScheduled:
+                self.logFlushScheduled = True
+                self.loop.call_soon(self.flushLog)
+
+    #==
+    #| flushLog()
+    #|
+    #==
+    def flushLog(self):
+
+        self.logFlushScheduled = False
+        self.log.flush()
+
+    #==
+    #| replay()
+    #|
+    #| Description:
+    #| Sends a client that joined a room the messages it missed:
+    #| (1) since = 0: the latest replayCount messages.
+    #| (2) since = N: every message after sequence number N (at most REPLAY_COUNT messages / REPLAY_BYTES bytes,
+    #|     keeping the newest).
+    #|
+    #| Notes:
+    #| The frames come from the ring buffer when it still holds all of them, otherwise from the messageLog.
+    #|
+    #==
+    def replay(self, connection, room, since):
+
+        for frame in self.replayFrames(room, since):
+            connection.send(frame)
+
+    #==
+    #| replayFrames()
+    #|
+    #| Description:
+    #| Returns the frames replay() sends (oldest first).
+    #|
+    #==
+    def replayFrames(self, room, since):
+
+        lastSeq = self.lastSeq(room)
+        if since >= lastSeq:
+            return []
+
+        if since == 0:
+            since = max(0, lastSeq - self.replayCount)
+
+        history = self.histories.get(room)
+        frames = history.since(since) if history is not None else None
+
+        if frames is None:
+            if self.log is not None:
+                frames = self.log.readSince(room, since, REPLAY_COUNT, REPLAY_BYTES)
+            elif history is not None:
+                frames = history.last(REPLAY_COUNT)
+            else:
+                frames = []
+
+        return frames[-REPLAY_COUNT:]
+
+    #==
+    #| busFrame()
+    #|
+    #| Description:
+    #| Handles a message from the hub (prefork mode, see bus.py):
+    #| (1) BUS_DELIVER: a numbered room message for this worker's members of the room.
+    #| (2) BUS_REPLAY: a history message for one client that joined a room.
+    #| (3) BUS_CHAT: a message for every client.
+    #|
+    #==
+    def busFrame(self, link, msgType, payload):
+
+        if msgType == BUS_DELIVER:
+            frame = bytes(payload)
+            seq, room, sender, textStart = decodeRoomHeader(payload[HEADER.size:])
+            self.deliverToRoom(room, sender, frame)
+
+        elif msgType == BUS_REPLAY:
+            connId, = CONNECTION_ID.unpack_from(payload)
+            connection = self.clients.get(connId)
+            if connection is not None:
+                connection.send(bytes(payload[CONNECTION_ID.size:]))
+
+        elif msgType == BUS_CHAT:
+            frame = bytes(payload)
+            for client in self.clients.values():
+                client.send(frame)
+
+    #==
+    #| busClosed()
+    #|
+    #| Description:
+    #| The hub went away (the server is quitting), so this worker stops as well.
+    #|
+    #==
+    def busClosed(self, link):
+
+        self.bus = None
+        self.stop()
+
+    #==
+    #| consoleMessage()
+    #|
+    #| Description:
+    #| Broadcasts a line the server user typed to every client (async mode, see bus.watchConsole(), which also
+    #|   calls stop() on '/q').
+    #|
+    #| Notes:
+    #| Replaces the sendMessage() thread used by the threaded mode.
+    #|
+    #==
+    def consoleMessage(self, serverMessage):
+
+        self.broadcast(None, encodeFrame(MSG_CHAT, serverMessage.encode('utf-8')))
+
+    #==
+    #| runAsync()
+    #|
+    #| Description:
+    #| (1) Starts listening on the host/port with an asyncio server (one chatConnection per client).
+    #| (2) Watches the server user's console for messages and '/q'.
+    #| (3) Serves clients until '/q' is entered (or SIGTERM, or a new server took over), then drains them.
+    #|
+    #| Notes:
+    #| All clients are handled by one event loop on one thread.
+    #| With a handoffPath the listening socket of the server already running there is inherited instead of binding a
+    #|   new one (see handoff.py), and the next server can take it over in turn.
+    #|
+    #==
+    async def runAsync(self):
+
+        self.loop = asyncio.get_running_loop()
+
+        # Each client uses one file descriptor, so raise the soft limit up to the hard limit.
+        if resource is not None:
+            try:
+                soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+                resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            except (ValueError, OSError):
+                pass
+
+        self.serveMetrics()
+        self.timers = timerWheel()
+        self.timers.start(self.loop)
+        self.stopping = asyncio.Event()
+
+        # With TLS a chatConnection is only created once its client's handshake is done.
+        protocolFactory = lambda: chatConnection(self)
+        if self.tlsContext is not None:
+            self.tlsPool = handshakePool(self.tlsThreads)
+            plainFactory = protocolFactory
+            protocolFactory = lambda: tlsProtocol(self.tlsContext, self.tlsPool, plainFactory,
+                                                  self.handshakeTimeout or None, tlsMetrics)
+
+        # A hot restart serves the listening sockets of the running server, the accept queue included.
+        handoffConnection, inherited = None, []
+        if self.handoffPath is not None:
+            handoffConnection, inherited = inheritSockets(self.handoffPath)
+
+        # Workers of the prefork mode all bind the same port (SO_REUSEPORT).
+        if inherited:
+            self.servers = [await self.loop.create_server(protocolFactory, sock=sock, backlog=self.backlog)
+                            for sock in inherited]
+        else:
+            self.servers = [await self.loop.create_server(protocolFactory, self.host, self.port, reuse_address=True,
+                                                          reuse_port=self.busSocket is not None, backlog=self.backlog)]
+
+        # Only now may the old server stop accepting. The next server takes over from this one.
+        if handoffConnection is not None:
+            handoffConnection.sendall(HANDOFF_READY)
+            handoffConnection.close()
+            print("Took over the listening socket of the running server")
+        if self.handoffPath is not None:
+            self.handoffSocket = listenHandoff(self.handoffPath)
+            self.loop.add_reader(self.handoffSocket, self.acceptHandoff)
+
+        if self.busSocket is None:
+            print(f"\nServer listening on {self.host} port {self.port} (async mode)")
+            print("Enter a message or /q to quit")
+            watchConsole(self.loop, self)
+
+            # A process manager stops the server with SIGTERM, which drains the clients like '/q'.
+            try:
+                self.loop.add_signal_handler(signal.SIGTERM, self.stop)
+            except NotImplementedError:
+                pass
+        else:
+            # The hub reads the console, a worker only needs its bus connection and a way to be stopped.
+            transport, self.bus = await self.loop.connect_accepted_socket(lambda: busLink(self), self.busSocket)
+            self.loop.add_signal_handler(signal.SIGTERM, self.stop)
+            print(f"\nServer listening on {self.host} port {self.port} (async mode, worker {self.workerId})")
+
+        # The servers accept clients in the background until stop() is called (or Ctrl-C cancels this task).
+        # Server.wait_closed() waits for every client connection (Python 3.12+), so it only comes after drain().
+        try:
+            await self.stopping.wait()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.stop()
+            await self.drain()
+            try:
+                await asyncio.wait_for(asyncio.gather(*[server.wait_closed() for server in self.servers]),
+                                       self.drainTimeout)
+            except asyncio.TimeoutError:
+                pass
+            self.timers.stop()
+            if self.handoffSocket is not None:
+                self.handoffSocket.close()
+                if not self.handedOff:
+                    os.unlink(self.handoffPath)
+            if self.tlsPool is not None:
+                self.tlsPool.shutdown(wait=False, cancel_futures=True)
+            if self.log is not None:
+                self.log.close()
+
+    #==
+    #| stop()
+    #|
+    #| Description:
+    #| Stops accepting new clients (async mode) and wakes up runAsync(), which then drains the connected ones.
+    #|
+    #==
+    def stop(self):
+
+        for server in self.servers:
+            server.close()
+
+        if self.handoffSocket is not None:
+            self.loop.remove_reader(self.handoffSocket)
+
+        if self.stopping is not None:
+            self.stopping.set()
+
+    #==
+    #| drain()
+    #|
+    #| Description:
+    #| (1) Sends every client a MSG_RECONNECT with the window over which it should reconnect (async mode).
+    #| (2) Waits up to drainTimeout seconds for the clients to answer it, each one is closed once everything queued
+    #|     for it was written (see chatConnection.flush()).
+    #| (3) Closes the connections of the clients that did not answer in time.
+    #|
+    #| Notes:
+    #| Unlike closing every connection at once, the clients receive every message sent before the shutdown and do not
+    #|   all come back at the same moment.
+    #|
+    #==
+    async def drain(self):
+
+        self.draining = True
+
+        if self.clients:
+            print(f"Draining {len(self.clients)} client(s)")
+            self.drained = self.loop.create_future()
+            frame = encodeFrame(MSG_RECONNECT, encodeReconnect(self.reconnectWindow))
+            for client in list(self.clients.values()):
+                client.send(frame)
+            try:
+                await asyncio.wait_for(self.drained, self.drainTimeout)
+            except asyncio.TimeoutError:
+                pass
+
+        for client in list(self.clients.values()):
+            client.flush()
+            client.transport.close()
+
+    #==
+    #| acceptHandoff()
+    #|
+    #| Description:
+    #| Called by the event loop when a new server connects to the handoff socket: hands it the listening sockets and,
+    #|   once it serves them, stops this server (see handoff.py).
+    #|
+    #==
+    def acceptHandoff(self):
+
+        try:
+            connection, address = self.handoffSocket.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+
+        self.loop.create_task(self.handOffTo(connection))
+
+    #==
+    #| handOffTo()
+    #|
+    #| Description:
+    #| (1) Sends the listening sockets of every asyncio server to the new server on connection (see handoff.py).
+    #| (2) Once the new server is ready, stops this one: it no longer accepts, and its clients are drained (told to
+    #|     reconnect, which lands them on the new server).
+    #|
+    #| Notes:
+    #| handedOff keeps the shutdown from removing the handoff socket file, which the new server listens on by now.
+    #| If the new server fails or does not answer in time, this server keeps serving as if nothing happened.
+    #|
+    #==
+    async def handOffTo(self, connection):
+
+        sockets = [sock for server in self.servers for sock in server.sockets]
+        if not await handOff(connection, sockets):
+            print("Hot restart failed, still serving")
+            return
+
+        print("A new server took over the listening socket")
+        self.handedOff = True
+        self.stop()
+
+    #==
+    #| serveMetrics()
+    #|
+    #| Description:
+    #| (1) Adds the gauges that read the server's state (connected clients, rooms, outbound queues).
+    #| (2) Serves the metrics on metricsHost/metricsPort in the Prometheus text format (port 0: no endpoint).
+    #| (3) Writes a snapshot of the metrics to stderr every metricsInterval seconds (0: no snapshots).
+    #|
+    #| Notes:
+    #| Called by connect() and runAsync(), so each worker of the prefork mode serves its own metrics (on
+    #|   metricsPort + its worker number).
+    #|
+    #==
+    def serveMetrics(self):
+
+        if not self.metricsPort and not self.metricsInterval:
+            return
+
+        metrics.gauge('chat_connections_active', "Connected clients", lambda: len(self.queuedBytes()))
+        metrics.gauge('chat_rooms_active', "Rooms with at least one member", lambda: len(self.rooms.members))
+        metrics.gauge('chat_outbound_queue_bytes', "Bytes waiting to be sent (all clients)",
+                      lambda: sum(self.queuedBytes()))
+        metrics.gauge('chat_outbound_queue_max_bytes', "Bytes waiting to be sent to the client furthest behind",
+                      lambda: max(self.queuedBytes(), default=0))
+
+        port = self.metricsPort
+        if self.workerId is not None:
+            metrics.labels['worker'] = self.workerId
+            if port:
+                port += self.workerId
+
+        if port:
+            metrics.serve(self.metricsHost, port)
+            print(f"Metrics on http://{self.metricsHost}:{port}/metrics")
+        if self.metricsInterval:
+            metrics.logEvery(self.metricsInterval)
+
+    #==
+    #| queuedBytes()
+    #|
+    #| Description:
+    #| Returns the number of bytes waiting to be sent to each connected client (for the metrics gauges).
+    #|
+    #==
+    def queuedBytes(self):
+
+        if self.sender is not None and self.connected:
+            return [self.sender.queue.size]
+
+        return [client.outbound.size + client.transport.get_write_buffer_size()
+                for client in list(self.clients.values())]
+
+    #==
+    #| runPrefork()
+    #|
+    #| Description:
+    #| (1) Creates a Unix socket pair per worker and forks the worker processes. Each worker keeps its end of its
+    #|     own pair and runs runAsync().
+    #| (2) The parent runs the busHub on the other ends until '/q' (or until every worker has exited).
+    #| (3) Stops the workers (SIGTERM) and waits for them.
+    #|
+    #| Notes:
+    #| Needs os.fork() and SO_REUSEPORT (e.g. Linux).
+    #| The workers are forked before any event loop exists, so each one starts with a clean asyncio state.
+    #|
+    #==
+    def runPrefork(self, workers):
+
+        pairs = [socketpair() for _ in range(workers)]
+        pids = []
+
+        for workerId, (hubSocket, workerSocket) in enumerate(pairs):
+            pid = os.fork()
+
+            if pid == 0:
+                for otherHub, otherWorker in pairs:
+                    otherHub.close()
+                    if otherWorker is not workerSocket:
+                        otherWorker.close()
+
+                # The hub keeps the room history, so a worker does not write the log.
+                self.workerId = workerId
+                self.busSocket = workerSocket
+                self.log = None
+
+                # os._exit() makes sure the worker never returns into the parent's code below.
+                status = 0
+                try:
+                    asyncio.run(self.runAsync())
+                except KeyboardInterrupt:
+                    pass
+                except BaseException:
+                    traceback.print_exc()
+                    status = 1
+                finally:
+                    os._exit(status)
+
+            pids.append(pid)
+
+        for hubSocket, workerSocket in pairs:
+            workerSocket.close()
+
+        try:
+            asyncio.run(busHub(self).run([hubSocket for hubSocket, workerSocket in pairs]))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for pid in pids:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+            for pid in pids:
+                os.waitpid(pid, 0)
+
+#==
+#| chatConnection
+#|
+#| Description:
+#| One client connection of the async server mode.
+#|
+#| Notes:
+#| The event loop calls connection_made(), get_buffer()/buffer_updated() and connection_lost() as the client
+#| connects, sends data and disconnects. __slots__ keeps the memory used per connection small.
+#| BufferedProtocol lets the event loop receive straight into the frameDecoder's buffer (no copy per read).
+#|
+#| Sending:
+#| (1) send() puts the frame on the connection's outboundQueue and schedules flush() for the end of the current
+#|     event loop iteration, so every frame queued meanwhile is written with one writelines() call (one send per
+#|     client per batch instead of one per message).
+#| (2) When the transport's own buffer goes above HIGH_WATER the event loop calls pause_writing(). Frames then
+#|     wait on the outboundQueue until resume_writing() (buffer below LOW_WATER).
+#| (3) A client with more than MAX_QUEUED bytes waiting is a slow consumer and is disconnected, so it cannot make
+#|     the server buffer without limit.
+#|
+#| Heartbeats:
+#| (1) Each connection has one timer on the server's timerWheel, and buffer_updated() only records the time of the
+#|     read (lastRead, the loop's clock). No timer is touched per message.
+#| (2) When the timer expires, timerExpired() looks at how long the client has been silent: it disconnects a client
+#|     that never sent its first message (handshakeTimeout) or sent nothing for idleTimeout, sends a MSG_PING after
+#|     heartbeat seconds, and otherwise sets the timer again for when the client would next be due.
+#|
+#| Rate limits:
+#| (1) Every frame is checked against the connection's rateLimiter before it is decompressed or decoded, and a
+#|     room message against its room's before it is sent to the room.
+#| (2) A client over a limit is throttled: reading is paused until the client is within its limits again
+#|     (throttle()). A frame over the client's limits is put back in the decoder's buffer, a room message over its
+#|     room's limit waits in held (see sendHeld()). Either is handled first once the pause is over, and nothing
+#|     over a limit is decoded or sent on before.
+#| (3) A client that is throttled again after every break, more than throttleLimit times a minute, is disconnected.
+#|     A client that keeps sending while it is paused is only slowed down: TCP holds its data back.
+#|
+#| Shutdown:
+#| (1) A stopping server sends every client a MSG_RECONNECT (see serverChat.drain()). The client answers it with a
+#|     MSG_RECONNECT of its own as its last frame.
+#| (2) The answer sets closing: flush() writes what is still queued for the client, then closes the connection.
+#|
+#==
+class chatConnection(asyncio.BufferedProtocol):
+
+    __slots__ = ('server', 'transport', 'connId', 'address', 'name', 'rooms', 'decoder', 'outbound', 'flushScheduled',
+                 'writePaused', 'compressor', 'lastRead', 'greeted', 'pingedAt', 'timerSlot', 'limiter', 'throttled',
+                 'held', 'closing', 'connectedAt')
+
+    def __init__(self, server):
+
+        self.server = server
+        self.transport = None
+        self.connId = next(server.connectionIds)
+        self.address = None
+        self.name = ''
+        self.rooms = set()
+        self.decoder = frameDecoder()
+        self.outbound = outboundQueue()
+        self.flushScheduled = False
+        self.writePaused = False
+        self.compressor = None
+        self.lastRead = 0
+        self.greeted = False
+        self.pingedAt = -1
+        self.timerSlot = None
+        self.limiter = server.limits.limiter(server.loop.time())
+        self.throttled = False
+        self.held = None
+        self.closing = False
+        self.connectedAt = 0.0
+
+    def connection_made(self, transport):
+
+        self.transport = transport
+        self.transport.set_write_buffer_limits(high=HIGH_WATER, low=LOW_WATER)
+        self.address = transport.get_extra_info('peername')
+        self.name = f"{self.address[0]}:{self.address[1]}"
+        self.server.clients[self.connId] = self
+        connectionsTotal.inc()
+
+        # The first check is the handshake timeout (or the heartbeat when there is none).
+        server = self.server
+        self.connectedAt = self.lastRead = server.loop.time()
+        delay = server.handshakeTimeout or server.heartbeat or server.idleTimeout
+        if delay:
+            server.timers.schedule(self, delay)
+
+    def get_buffer(self, sizehint):
+
+        return self.decoder.writableView()
+
+    def buffer_updated(self, nbytes):
+
+        self.decoder.commit(nbytes)
+        bytesReceived.inc(nbytes)
+        self.lastRead = self.server.loop.time()
+
+        if not self.throttled:
+            self.handleFrames()
+
+    #==
+    #| handleFrames()
+    #|
+    #| Description:
+    #| Handles every complete frame in the decoder's buffer, until the client has to be throttled (see Rate limits
+    #|   above).
+    #|
+    #==
+    def handleFrames(self):
+
+        start = time.perf_counter()
+        now = self.server.loop.time()
+
+        # A client that breaks the protocol (e.g. an oversized frame) is disconnected.
+        try:
+            if self.held is not None and not self.sendHeld(now):
+                return
+
+            for msgType, payload in self.decoder.frames():
+                size = HEADER.size + len(payload)
+
+                # A frame over the client's limits goes back to the buffer, undecoded, until the pause is over.
+                delay = self.limiter.take(size, now) if self.limiter is not None else 0.0
+                if delay:
+                    self.decoder.unread(size)
+                    self.throttle(delay, 0.0, now)
+                    break
+
+                messagesReceived.inc()
+                msgType, payload = decompressFrame(self.compressor, msgType, payload)
+                self.greeted = True
+
+                if msgType == MSG_CHAT:
+                    if not self.server.quiet:
+                        print(f"Client {self.name}: {str(payload, 'utf-8', 'replace')}")
+                    self.server.broadcast(self, encodeFrame(MSG_CHAT, payload))
+
+                elif msgType == MSG_ROOM:
+                    seq, room, sender, text = decodeRoomMessage(payload)
+                    self.held = (room, text, size)
+                    if not self.sendHeld(now):
+                        break
+
+                elif msgType == MSG_JOIN:
+                    room, since = decodeJoin(payload)
+                    self.server.joinRoom(self, room, since)
+
+                elif msgType == MSG_LEAVE:
+                    self.server.leaveRoom(self, decodeRoomName(payload))
+
+                elif msgType == MSG_HELLO:
+                    reply, compressor = self.server.compression.accept(payload, compressStats)
+                    self.send(reply)
+                    self.compressor = compressor
+
+                elif msgType == MSG_PING:
+                    self.send(encodeFrame(MSG_PONG, payload))
+
+                elif msgType == MSG_RECONNECT:
+                    self.closing = True
+                    self.flush()
+                    break
+        except protocolError:
+            protocolErrors.inc()
+            self.transport.close()
+
+        receiveSeconds.observe(time.perf_counter() - start)
+
+    #==
+    #| sendHeld()
+    #|
+    #| Description:
+    #| Sends the room message in held to its room. Returns False if the room is over its limit: the message then stays
+    #|   in held and the client is throttled until the room is within its limit again.
+    #|
+    #| Notes:
+    #| The frame was already decompressed (which moves the connection's decompressor on), so it cannot go back to the
+    #|   decoder's buffer like a frame over the client's own limits: the decoded message waits in held instead.
+    #|
+    #==
+    def sendHeld(self, now):
+
+        room, text, size = self.held
+        if room in self.rooms:
+            roomWait = self.server.roomDelay(room, size, now)
+            if roomWait:
+                self.throttle(0.0, roomWait, now)
+                return False
+            self.server.sendToRoom(self, room, text)
+
+        self.held = None
+        return True
+
+    #==
+    #| throttle()
+    #|
+    #| Description:
+    #| Stops reading from the client until it is within its own limits (delay) and its room's (roomWait), or
+    #|   disconnects it if it has been throttled for too long.
+    #|
+    #| Notes:
+    #| Only the client's own delay counts towards how long it has been throttled: a client paused because its room is
+    #|   busy is never disconnected for it.
+    #|
+    #==
+    def throttle(self, delay, roomWait, now):
+
+        if delay and self.limiter.throttle(delay, now, self.server.throttleLimit):
+            rateLimited.inc()
+            if not self.server.quiet:
+                print(f"Disconnecting client {self.name}: sending too fast")
+            self.transport.abort()
+            return
+
+        throttledTotal.inc()
+        self.throttled = True
+        self.transport.pause_reading()
+        self.server.loop.call_later(max(delay, roomWait), self.unthrottle)
+
+    #==
+    #| unthrottle()
+    #|
+    #| Description:
+    #| Handles the frames that waited in the buffer, then reads from the client again (unless it has to be
+    #|   throttled again right away).
+    #|
+    #==
+    def unthrottle(self):
+
+        self.throttled = False
+        if self.transport.is_closing():
+            return
+
+        self.handleFrames()
+        if not self.throttled and not self.transport.is_closing():
+            self.transport.resume_reading()
+
+    def connection_lost(self, exc):
+
+        if exc is not None:
+            connectionErrors.inc()
+
+        self.server.timers.cancel(self)
+
+        self.server.clients.pop(self.connId, None)
+        for room in list(self.rooms):
+            self.server.leaveRoom(self, room)
+        self.outbound.drain()
+
+        server = self.server
+        if server.drained is not None and not server.clients and not server.drained.done():
+            server.drained.set_result(None)
+
+    def pause_writing(self):
+
+        self.writePaused = True
+
+    def resume_writing(self):
+
+        self.writePaused = False
+        self.flush()
+
+    #==
+    #| timerExpired()
+    #|
+    #| Description:
+    #| Called by the timerWheel, see Heartbeats above.
+    #|
+    #==
+    def timerExpired(self):
+
+        server = self.server
+        if self.transport.is_closing():
+            return
+
+        # The wheel may expire a timer up to one tick early, so the times are measured on the loop's clock.
+        now = server.loop.time()
+
+        if not self.greeted and server.handshakeTimeout:
+            waited = now - self.connectedAt
+            if waited < server.handshakeTimeout:
+                server.timers.schedule(self, server.handshakeTimeout - waited)
+                return
+            handshakeTimeouts.inc()
+            print(f"Disconnecting client {self.name}: no message within {server.handshakeTimeout:.0f}s")
+            self.transport.abort()
+            return
+
+        idle = now - self.lastRead
+
+        if server.idleTimeout and idle >= server.idleTimeout:
+            idleReaped.inc()
+            print(f"Disconnecting client {self.name}: nothing received for {idle:.0f}s")
+            self.transport.abort()
+            return
+
+        # pingedAt is the time of the last MSG_PING: one ping per silence, a new one once the client answered.
+        if server.heartbeat and idle >= server.heartbeat:
+            if self.pingedAt <= self.lastRead:
+                self.pingedAt = now
+                pingsSent.inc()
+                self.send(encodeFrame(MSG_PING, b''))
+            server.timers.schedule(self, server.idleTimeout - idle if server.idleTimeout else server.heartbeat)
+            return
+
+        if server.heartbeat:
+            server.timers.schedule(self, server.heartbeat - idle)
+        elif server.idleTimeout:
+            server.timers.schedule(self, server.idleTimeout - idle)
+
+    #==
+    #| send()
+    #|
+    #| Description:
+    #| Queues a frame for this client and schedules flush(). Disconnects the client if it is a slow consumer.
+    #|
+    #| Notes:
+    #| With compression every client's copy of a frame is compressed with its own stream, which is why only payloads
+    #|   above the threshold are compressed.
+    #|
+    #==
+    def send(self, frame):
+
+        if self.transport.is_closing():
+            return
+
+        if self.compressor is not None:
+            frame = self.compressor.compressFrame(frame)
+
+        self.outbound.put(frame)
+        messagesSent.inc()
+
+        if self.outbound.size + self.transport.get_write_buffer_size() > MAX_QUEUED:
+            slowConsumers.inc()
+            print(f"Disconnecting slow client {self.name}")
+            self.outbound.drain()
+            self.transport.abort()
+            return
+
+        if not self.flushScheduled and not self.writePaused:
+            self.flushScheduled = True
+            self.server.loop.call_soon(self.flush)
+
+    #==
+    #| flush()
+    #|
+    #| Description:
+    #| Writes every queued frame to the transport at once, then closes the connection if the client is closing.
+    #|
+    #==
+    def flush(self):
+
+        self.flushScheduled = False
+
+        if self.writePaused or self.transport.is_closing():
+            return
+
+        if self.outbound.buffers:
+            size = self.outbound.size
+            start = time.perf_counter()
+            self.transport.writelines(self.outbound.drain())
+            sendSeconds.observe(time.perf_counter() - start)
+            sendBatchBytes.observe(size)
+            bytesSent.inc(size)
+
+        # close() still sends what the transport holds.
+        if self.closing:
+            self.transport.close()
+
+#==
+#| Run program
+#|
+#==
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Client-Server Chat (server)")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=15777)
+    parser.add_argument('--mode', choices=['threaded', 'async'], default='threaded',
+                        help="threaded: one client (default), async: any number of clients on one event loop")
+    parser.add_argument('--quiet', action='store_true',
+                        help="do not print the messages received from clients, nor the clients disconnected for "
+                             "sending too fast")
+    parser.add_argument('--history', type=int, default=100, help="messages kept in memory per room (async mode)")
+    parser.add_argument('--history-bytes', type=int, default=256 * 1024, help="bytes kept in memory per room")
+    parser.add_argument('--replay', type=int, default=50, help="latest messages sent to a client that joins a room")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="async mode: number of worker processes sharing the port (SO_REUSEPORT)")
+    parser.add_argument('--log-dir', help="keep every room message in an append-only log in this directory")
+    parser.add_argument('--compress', action='store_true', help="compress large payloads for clients that ask for it")
+    parser.add_argument('--compress-dict', help="file of common text shared with the clients (zlib dictionary)")
+    parser.add_argument('--compress-threshold', type=int, default=COMPRESS_THRESHOLD,
+                        help="only compress payloads of at least this many bytes")
+    parser.add_argument('--heartbeat', type=float, default=30.0,
+                        help="send a ping to a client that sent nothing for this many seconds (0: never)")
+    parser.add_argument('--idle-timeout', type=float, default=90.0,
+                        help="disconnect a client that sent nothing for this many seconds (0: never)")
+    parser.add_argument('--handshake-timeout', type=float, default=10.0,
+                        help="async mode: disconnect a client that sends no first message within this time (0: never)")
+    parser.add_argument('--rate-messages', type=float, default=MESSAGE_RATE,
+                        help="messages per second a client may send (0: no limit)")
+    parser.add_argument('--rate-bytes', type=float, default=BYTE_RATE,
+                        help="bytes per second a client may send (0: no limit)")
+    parser.add_argument('--room-rate-messages', type=float, default=0,
+                        help="async mode: messages per second all clients together may send to one room (0: no limit)")
+    parser.add_argument('--room-rate-bytes', type=float, default=0,
+                        help="async mode: bytes per second all clients together may send to one room (0: no limit)")
+    parser.add_argument('--rate-burst', type=float, default=BURST_SECONDS,
+                        help="seconds worth of the rate limits that may be sent at once")
+    parser.add_argument('--throttle-limit', type=int, default=THROTTLE_LIMIT,
+                        help="disconnect a client throttled this many separate times a minute (0: never)")
+    parser.add_argument('--tls-cert', help="async mode: certificate (PEM) to encrypt the connections with TLS")
+    parser.add_argument('--tls-key', help="private key (PEM) of --tls-cert")
+    parser.add_argument('--tls-threads', type=int, default=HANDSHAKE_THREADS,
+                        help="threads that run the TLS handshakes (per worker)")
+    parser.add_argument('--drain-timeout', type=float, default=DRAIN_TIMEOUT,
+                        help="seconds the clients get to reconnect elsewhere when the server stops")
+    parser.add_argument('--reconnect-window', type=float, default=RECONNECT_WINDOW,
+                        help="seconds over which the clients spread their reconnections when the server stops")
+    parser.add_argument('--handoff', metavar='PATH',
+                        help="async mode: Unix socket a new server started with the same PATH takes the listening "
+                             "socket over from (hot restart)")
+    parser.add_argument('--metrics-host', default='localhost')
+    parser.add_argument('--metrics-port', type=int, default=0,
+                        help="serve Prometheus metrics on this port (prefork workers use port + worker number)")
+    parser.add_argument('--metrics-interval', type=float, default=0,
+                        help="write a JSON snapshot of the metrics to stderr every this many seconds")
+    args = parser.parse_args()
+
+    chat = serverChat()
+    chat.host = args.host
+    chat.port = args.port
+    chat.quiet = args.quiet
+    chat.historyCount = args.history
+    chat.historyBytes = args.history_bytes
+    chat.replayCount = args.replay
+    if args.log_dir:
+        chat.log = messageLog(args.log_dir)
+    chat.compression = compressionOptions(args.compress, loadDictionary(args.compress_dict), args.compress_threshold)
+    chat.heartbeat = args.heartbeat
+    chat.idleTimeout = args.idle_timeout
+    chat.handshakeTimeout = args.handshake_timeout
+    chat.limits = rateLimits(args.rate_messages, args.rate_bytes, args.rate_burst)
+    chat.roomLimits = rateLimits(args.room_rate_messages, args.room_rate_bytes, args.rate_burst)
+    chat.throttleLimit = args.throttle_limit
+    if args.tls_cert:
+        # The threaded mode reads and writes its client's socket from two threads, which one SSL object cannot do.
+        if args.mode != 'async':
+            parser.error("--tls-cert needs --mode async")
+        if ssl is None:
+            parser.error("this Python has no ssl module")
+        chat.tlsContext = serverContext(args.tls_cert, args.tls_key or args.tls_cert)
+        chat.tlsThreads = args.tls_threads
+    chat.drainTimeout = args.drain_timeout
+    chat.reconnectWindow = args.reconnect_window
+    if args.handoff:
+        # The prefork workers each have their own listening socket (SO_REUSEPORT), which one handoff cannot pass on.
+        if args.mode != 'async' or args.workers > 1:
+            parser.error("--handoff needs --mode async with one worker")
+        chat.handoffPath = args.handoff
+    chat.metricsHost = args.metrics_host
+    chat.metricsPort = args.metrics_port
+    chat.metricsInterval = args.metrics_interval
+
+    if args.mode == 'async' and args.workers > 1:
+        chat.runPrefork(args.workers)
+    elif args.mode == 'async':
+        try:
+            asyncio.run(chat.runAsync())
+        except KeyboardInterrupt:
+            pass
+    else:
+        chat.connect()
+        chat.receiveMessage()
+        chat.closeChat()
+        chat.closed.set()
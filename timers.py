@@ -0,0 +1,152 @@
+# Student name: Michael Hrenko
+# Student OSU ID: 934396070
+# Course: CS 372
+# Programming Project: Client-Server Chat
+
+#==
+#| Sources
+#|
+#==
+
+# "Hashed and Hierarchical Timing Wheels", George Varghese and Tony Lauck, SOSP 1987,
+#   http://www.cs.columbia.edu/~nahum/w6998/papers/sosp87-timing-wheels.pdf
+# "loop.call_later", python.org, https://docs.python.org/3/library/asyncio-eventloop.html#asyncio.loop.call_later
+
+#==
+#| Import packages
+#|
+#==
+
+# Math rounds delays up to whole ticks
+import math
+
+#==
+#| Timer wheel
+#|
+#| Description:
+#| TICK: seconds between two ticks of the wheel (the precision of the timers).
+#| WHEEL_SIZE: number of slots. A timer up to TICK * WHEEL_SIZE seconds away is looked at only once, when it is due.
+#|
+#==
+
+TICK = 1.0
+WHEEL_SIZE = 512
+
+#==
+#| timerWheel
+#|
+#| Description:
+#| One timer per owner (e.g. per connection) without a heap or a thread per timer.
+#|
+#| My approach:
+#| (1) slots is a ring of dictionaries. A timer due at tick N goes into slot N % WHEEL_SIZE, so schedule() and
+#|     cancel() are O(1) whatever the number of timers.
+#| (2) Every TICK seconds advance() moves to the next slot and calls owner.timerExpired() for the timers of that
+#|     slot that are due. Timers more than one turn away stay in their slot until a later turn.
+#| (3) The owner remembers its slot (owner.timerSlot), so rescheduling removes the old timer directly.
+#| (4) ticks counts the ticks so far. Owners can store it as a cheap timestamp (e.g. the tick of the last read) and
+#|     decide what to do when their timer expires, instead of rescheduling on every event.
+#|
+#| Notes:
+#| Timers are only as precise as TICK, which is plenty for heartbeats and idle timeouts.
+#|
+#==
+class timerWheel:
+
+    #==
+    #| __init__()
+    #|
+    #==
+    def __init__(self, tick=TICK, size=WHEEL_SIZE):
+
+        self.tick = tick
+        self.size = size
+        self.slots = [{} for _ in range(size)]
+        self.ticks = 0
+        self.loop = None
+        self.started = None
+        self.handle = None
+
+    #==
+    #| schedule()
+    #|
+    #| Description:
+    #| Calls owner.timerExpired() in delay seconds (rounded up to whole ticks), replacing the owner's previous timer.
+    #|
+    #==
+    def schedule(self, owner, delay):
+
+        self.cancel(owner)
+
+        due = self.ticks + max(1, math.ceil(delay / self.tick))
+        slot = due % self.size
+        self.slots[slot][owner] = due
+        owner.timerSlot = slot
+
+    #==
+    #| cancel()
+    #|
+    #| Description:
+    #| Removes the owner's timer, if it has one.
+    #|
+    #==
+    def cancel(self, owner):
+
+        if owner.timerSlot is not None:
+            self.slots[owner.timerSlot].pop(owner, None)
+            owner.timerSlot = None
+
+    #==
+    #| advance()
+    #|
+    #| Description:
+    #| Moves the wheel one tick forward and expires the timers that are due.
+    #|
+    #==
+    def advance(self):
+
+        self.ticks += 1
+        slot = self.slots[self.ticks % self.size]
+        if not slot:
+            return
+
+        due = [owner for owner, tick in slot.items() if tick <= self.ticks]
+        for owner in due:
+            del slot[owner]
+            owner.timerSlot = None
+            owner.timerExpired()
+
+    #==
+    #| start()
+    #|
+    #| Description:
+    #| Advances the wheel from an asyncio event loop every tick seconds.
+    #|
+    #| Notes:
+    #| The ticks owed are computed from the loop's clock, so a busy loop catches up instead of letting the timers
+    #|   drift.
+    #|
+    #==
+    def start(self, loop):
+
+        self.loop = loop
+        self.started = loop.time()
+        self.handle = loop.call_later(self.tick, self.onTick)
+
+    def onTick(self):
+
+        owed = int((self.loop.time() - self.started) / self.tick)
+        while self.ticks < owed:
+            self.advance()
+
+        self.handle = self.loop.call_at(self.started + (self.ticks + 1) * self.tick, self.onTick)
+
+    #==
+    #| stop()
+    #|
+    #==
+    def stop(self):
+
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
@@ -0,0 +1,461 @@
+# Student name: Michael Hrenko
+# Student OSU ID: 934396070
+# Course: CS 372
+# Programming Project: Client-Server Chat
+
+#==
+#| Sources
+#|
+#==
+
+# "ssl — TLS/SSL wrapper for socket objects", python.org, https://docs.python.org/3/library/ssl.html
+# "Memory BIO Support", python.org, https://docs.python.org/3/library/ssl.html#memory-bio-support
+# "The Transport Layer Security (TLS) Protocol Version 1.3", RFC 8446, Section 2.2 "Resumption and Pre-Shared Key",
+#   https://www.rfc-editor.org/rfc/rfc8446#section-2.2
+# "loop.run_in_executor", python.org,
+#   https://docs.python.org/3/library/asyncio-eventloop.html#asyncio.loop.run_in_executor
+
+#==
+#| Import packages
+#|
+#==
+
+# Asyncio runs the TLS layer of the async server mode
+import asyncio
+
+# Os finds the certificate files and the number of CPU cores
+import os
+
+# Subprocess runs the openssl command that makes the self-signed test certificate
+import subprocess
+
+# Sys reads the certificate directory from the command line
+import sys
+
+# Time measures how long the handshakes take
+import time
+
+# Concurrent.futures provides the thread pool the handshakes run on
+from concurrent.futures import ThreadPoolExecutor
+
+# Ssl is missing from some Python builds, TLS is then unavailable
+try:
+    import ssl
+except ImportError:
+    ssl = None
+
+#==
+#| TLS
+#|
+#| Description:
+#| HANDSHAKE_TIMEOUT: seconds a client has to complete its TLS handshake.
+#| HANDSHAKE_THREADS: threads of the handshake pool (the key exchange and signature of a full handshake are the
+#|   expensive part of TLS).
+#| SESSION_TICKETS: TLS 1.3 session tickets the server sends after each full handshake. A client that reconnects
+#|   presents one and resumes the session without the certificate and signature (see RFC 8446 above).
+#|
+#==
+
+HANDSHAKE_TIMEOUT = 10.0
+HANDSHAKE_THREADS = min(4, os.cpu_count() or 1)
+SESSION_TICKETS = 2
+
+# A non-blocking TLS socket that cannot read or write yet raises SSLWantReadError/SSLWantWriteError instead of
+#   BlockingIOError.
+if ssl is not None:
+    WOULD_BLOCK = (BlockingIOError, InterruptedError, ssl.SSLWantReadError, ssl.SSLWantWriteError)
+else:
+    WOULD_BLOCK = (BlockingIOError, InterruptedError)
+
+#==
+#| serverContext()
+#|
+#| Description:
+#| Returns the server's SSLContext for a certificate and its private key (PEM files).
+#|
+#| Notes:
+#| The session ticket keys belong to the context, so the prefork mode creates it before forking and every worker
+#|   can resume sessions started on another worker.
+#|
+#==
+def serverContext(certFile, keyFile):
+
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(certFile, keyFile)
+    context.num_tickets = SESSION_TICKETS
+    return context
+
+#==
+#| clientContext()
+#|
+#| Description:
+#| Returns the client's SSLContext. caFile is the certificate to trust (e.g. the self-signed test certificate),
+#|   None for the system's certificate authorities. verify=False skips checking the certificate (testing only).
+#|
+#==
+def clientContext(caFile=None, verify=True):
+
+    context = ssl.create_default_context(cafile=caFile)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    if not verify:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    return context
+
+#==
+#| makeSelfSigned()
+#|
+#| Description:
+#| Makes a self-signed certificate for host (and 127.0.0.1) in directory with the openssl command, unless it is
+#|   already there. Returns (certFile, keyFile).
+#|
+#| Notes:
+#| For local testing only: clients have to be given the certificate to trust (client.py --tls-ca).
+#|
+#==
+def makeSelfSigned(directory, host='localhost'):
+
+    certFile = os.path.join(directory, 'cert.pem')
+    keyFile = os.path.join(directory, 'key.pem')
+
+    if not (os.path.exists(certFile) and os.path.exists(keyFile)):
+        os.makedirs(directory, exist_ok=True)
+        subprocess.run(['openssl', 'req', '-x509', '-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1',
+                        '-nodes', '-days', '365', '-subj', f'/CN={host}',
+                        '-addext', f'subjectAltName=DNS:{host},IP:127.0.0.1',
+                        '-keyout', keyFile, '-out', certFile], check=True, capture_output=True)
+
+    return certFile, keyFile
+
+#==
+#| tlsStats
+#|
+#| Description:
+#| The TLS metrics of the server (see metrics.py): full and resumed handshakes, failed handshakes and the
+#|   handshake time.
+#|
+#==
+class tlsStats:
+
+    def __init__(self, registry):
+
+        self.handshakes = registry.counter('chat_tls_handshakes_total', "TLS handshakes completed")
+        self.resumed = registry.counter('chat_tls_resumed_total', "TLS handshakes that resumed a session")
+        self.failures = registry.counter('chat_tls_handshake_failures_total', "TLS handshakes that failed or timed out")
+        self.seconds = registry.histogram('chat_tls_handshake_seconds', "Time from connect to handshake done")
+
+#==
+#| handshakePool()
+#|
+#| Description:
+#| Returns the thread pool that runs the handshakes.
+#|
+#==
+def handshakePool(threads=HANDSHAKE_THREADS):
+
+    return ThreadPoolExecutor(max_workers=threads, thread_name_prefix='tls-handshake')
+
+#==
+#| tlsProtocol
+#|
+#| Description:
+#| TLS layer between an asyncio TCP transport and a chat protocol (chatConnection), for the async server mode.
+#|
+#| My approach:
+#| (1) TLS runs on memory BIOs (ssl.SSLObject): bytes received from the client go into incoming, bytes to send to
+#|     the client come out of outgoing, so the SSLObject never touches the socket.
+#| (2) Each handshake step (do_handshake()) runs on the handshake pool, which keeps the key exchange and signature
+#|     off the event loop: a burst of new TLS clients does not delay the messages of the connected ones. Python
+#|     releases the GIL while OpenSSL works, so the pool's threads run in parallel.
+#| (3) Bytes received during a step are kept in pending and only written to incoming between steps, so a BIO is
+#|     never used by two threads at once.
+#| (4) Once the handshake is done the chat protocol is created with a tlsTransport. From then on records are
+#|     encrypted and decrypted on the event loop (cheap symmetric crypto), and decrypted bytes go straight into
+#|     the protocol's buffer (get_buffer()/buffer_updated()).
+#|
+#==
+class tlsProtocol(asyncio.Protocol):
+
+    #==
+    #| __init__()
+    #|
+    #==
+    def __init__(self, context, pool, protocolFactory, handshakeTimeout=HANDSHAKE_TIMEOUT, stats=None):
+
+        self.context = context
+        self.pool = pool
+        self.protocolFactory = protocolFactory
+        self.handshakeTimeout = handshakeTimeout
+        self.stats = stats
+
+        self.loop = None
+        self.raw = None
+        self.incoming = None
+        self.outgoing = None
+        self.sslobj = None
+        self.app = None
+        self.pending = []
+        self.waiter = None
+        self.handshakeTask = None
+        self.started = 0
+
+    def connection_made(self, transport):
+
+        self.loop = asyncio.get_running_loop()
+        self.raw = transport
+        self.started = time.perf_counter()
+
+        self.incoming = ssl.MemoryBIO()
+        self.outgoing = ssl.MemoryBIO()
+        self.sslobj = self.context.wrap_bio(self.incoming, self.outgoing, server_side=True)
+        self.handshakeTask = self.loop.create_task(self.handshake())
+
+    def data_received(self, data):
+
+        if self.app is None:
+            self.pending.append(data)
+            self.wake()
+            return
+
+        self.incoming.write(data)
+        self.readRecords()
+
+    def eof_received(self):
+
+        if self.app is None:
+            self.pending.append(None)
+            self.wake()
+            return True
+
+        self.incoming.write_eof()
+        self.readRecords()
+        return False
+
+    def connection_lost(self, exc):
+
+        if self.handshakeTask is not None:
+            self.handshakeTask.cancel()
+        if self.app is not None:
+            self.app.connection_lost(exc)
+
+    def pause_writing(self):
+
+        if self.app is not None:
+            self.app.pause_writing()
+
+    def resume_writing(self):
+
+        if self.app is not None:
+            self.app.resume_writing()
+
+    def wake(self):
+
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    #==
+    #| handshake()
+    #|
+    #| Description:
+    #| Runs the handshake (see handshakeSteps()) within handshakeTimeout, then hands the connection to the chat
+    #|   protocol. A client that fails or is too slow is disconnected.
+    #|
+    #==
+    async def handshake(self):
+
+        try:
+            await asyncio.wait_for(self.handshakeSteps(), self.handshakeTimeout or None)
+        except asyncio.CancelledError:
+            return
+        except (asyncio.TimeoutError, OSError, ValueError):
+            if self.stats is not None:
+                self.stats.failures.inc()
+            self.raw.abort()
+            return
+
+        self.handshakeTask = None
+        if self.stats is not None:
+            self.stats.handshakes.inc()
+            self.stats.seconds.observe(time.perf_counter() - self.started)
+            if self.sslobj.session_reused:
+                self.stats.resumed.inc()
+
+        self.app = self.protocolFactory()
+        self.app.connection_made(tlsTransport(self))
+
+        # Records that arrived with the end of the handshake (e.g. the client's first message).
+        self.moveDataIn()
+        self.readRecords()
+
+    #==
+    #| handshakeSteps()
+    #|
+    #| Description:
+    #| Runs do_handshake() on the pool until it completes, sending its output to the client after each step and
+    #|   waiting for the client's answer when OpenSSL needs more data.
+    #|
+    #==
+    async def handshakeSteps(self):
+
+        while True:
+            self.moveDataIn()
+            try:
+                await self.loop.run_in_executor(self.pool, self.sslobj.do_handshake)
+                done = True
+            except ssl.SSLWantReadError:
+                done = False
+
+            self.flushOutgoing()
+            if done:
+                return
+
+            if not self.pending:
+                self.waiter = self.loop.create_future()
+                await self.waiter
+                self.waiter = None
+
+    #==
+    #| moveDataIn()
+    #|
+    #| Description:
+    #| Writes the bytes received during the handshake to the incoming BIO (None marks the end of the stream).
+    #|
+    #==
+    def moveDataIn(self):
+
+        for data in self.pending:
+            if data is None:
+                self.incoming.write_eof()
+            else:
+                self.incoming.write(data)
+        self.pending.clear()
+
+    #==
+    #| readRecords()
+    #|
+    #| Description:
+    #| Decrypts every complete record straight into the chat protocol's buffer, until the protocol pauses reading.
+    #|
+    #==
+    def readRecords(self):
+
+        while self.raw.is_reading():
+            buffer = self.app.get_buffer(-1)
+            try:
+                nbytes = self.sslobj.read(len(buffer), buffer)
+            except ssl.SSLWantReadError:
+                break
+            except (ssl.SSLZeroReturnError, ssl.SSLEOFError):
+                self.raw.close()
+                break
+            except ssl.SSLError:
+                self.raw.abort()
+                break
+
+            if nbytes == 0:
+                self.raw.close()
+                break
+            self.app.buffer_updated(nbytes)
+
+        # Reading may produce records to send (e.g. an alert), so flush them.
+        self.flushOutgoing()
+
+    #==
+    #| flushOutgoing()
+    #|
+    #| Description:
+    #| Sends everything the SSLObject has written to the outgoing BIO with one write.
+    #|
+    #==
+    def flushOutgoing(self):
+
+        if self.outgoing.pending and not self.raw.is_closing():
+            self.raw.write(self.outgoing.read())
+
+#==
+#| tlsTransport
+#|
+#| Description:
+#| The transport a chat protocol gets from tlsProtocol: writes are encrypted and everything else (flow control,
+#|   closing, peername, ...) is passed to the TCP transport.
+#|
+#==
+class tlsTransport(asyncio.Transport):
+
+    def __init__(self, protocol):
+
+        super().__init__()
+        self.protocol = protocol
+        self.raw = protocol.raw
+
+    def write(self, data):
+
+        self.protocol.sslobj.write(data)
+        self.protocol.flushOutgoing()
+
+    # Every buffer is encrypted into the outgoing BIO first, so the records go out with one write.
+    def writelines(self, buffers):
+
+        sslobj = self.protocol.sslobj
+        for buffer in buffers:
+            sslobj.write(buffer)
+        self.protocol.flushOutgoing()
+
+    def close(self):
+
+        if self.raw.is_closing():
+            return
+
+        # Send close_notify, the client's own close_notify is not waited for.
+        try:
+            self.protocol.sslobj.unwrap()
+        except (ssl.SSLError, ValueError):
+            pass
+        self.protocol.flushOutgoing()
+        self.raw.close()
+
+    def abort(self):
+
+        self.raw.abort()
+
+    def is_closing(self):
+
+        return self.raw.is_closing()
+
+    def get_extra_info(self, name, default=None):
+
+        if name == 'ssl_object':
+            return self.protocol.sslobj
+        return self.raw.get_extra_info(name, default)
+
+    def get_write_buffer_size(self):
+
+        return self.raw.get_write_buffer_size()
+
+    def set_write_buffer_limits(self, high=None, low=None):
+
+        self.raw.set_write_buffer_limits(high, low)
+
+    def pause_reading(self):
+
+        self.raw.pause_reading()
+
+    # Records received before the pause may still wait in the incoming BIO.
+    def resume_reading(self):
+
+        self.raw.resume_reading()
+        self.protocol.readRecords()
+
+    def is_reading(self):
+
+        return self.raw.is_reading()
+
+#==
+#| Make a test certificate
+#|
+#==
+if __name__ == '__main__':
+
+    certFile, keyFile = makeSelfSigned(sys.argv[1] if len(sys.argv) > 1 else 'certs')
+    print(f"Certificate: {certFile}\nKey: {keyFile}")